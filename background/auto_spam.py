@@ -7,7 +7,9 @@ from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 from keyboards.inline import get_avatar_info_menu, get_helps_menu, get_reviews_menu, get_tariffs_menu
 from core.config import TEXTS, IMAGES, REVIEWS_IMAGES
 from core.database import db
+from core.user_context import get_user_context
 from utils.message_utils import send_split_message
+from core.telegram_sender import current_priority, PRIORITY_FUNNEL
 import logging
 
 logger = logging.getLogger(__name__)
@@ -30,7 +32,12 @@ def update_user_activity(user_id: int):
     user_last_activity[user_id] = current_time
     
     # НАВСЕГДА отключаем автоспам для этого пользователя в БД
-    db.mark_spam_completed(user_id)
+    # (в апдейте - одной записью в конце и только если он еще не отключен)
+    context = get_user_context(user_id)
+    if context is not None:
+        context.mark_spam_completed()
+    else:
+        db.mark_spam_completed(user_id)
 
 def update_user_activity_start_only(user_id: int):
     """
@@ -294,6 +301,9 @@ async def start_auto_spam_task(bot: Bot):
     Args:
         bot: экземпляр бота
     """
+    # Автоспам уступает очередь интерактивным ответам (задача работает в своем контексте)
+    current_priority.set(PRIORITY_FUNNEL)
+    
     while True:
         try:
             current_time = datetime.now()
@@ -1,8 +1,9 @@
 import asyncio
 import logging
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
 import pytz
 from core.database import db
+from core.thread_pool import thread_pool
 
 logger = logging.getLogger(__name__)
 
@@ -16,32 +17,25 @@ async def daily_thread_reset_task():
     
     while True:
         try:
-            # Получаем текущее время в Москве
-            now_moscow = datetime.now(moscow_tz)
-            
-            # Определяем время следующего сброса (00:00)
-            from datetime import timedelta
-            
-            next_reset_time = now_moscow.replace(
-                hour=0, minute=0, second=0, microsecond=0
-            )
-            
-            # Если уже прошло 00:00 сегодня, планируем на завтра
-            if now_moscow.time() >= time(0, 1):  # Если прошла минута после полуночи
-                next_reset_time = next_reset_time + timedelta(days=1)
-            
-            # Вычисляем время ожидания до следующего сброса
-            wait_seconds = (next_reset_time - now_moscow).total_seconds()
+            # Следующий сброс - ближайшая полночь по Москве
+            next_reset_time = get_next_reset_time()
+            wait_seconds = (next_reset_time - datetime.now(moscow_tz)).total_seconds()
             
             logger.info(f"⏰ Следующий сброс threads запланирован на {next_reset_time.strftime('%Y-%m-%d %H:%M:%S %Z')} (через {wait_seconds/3600:.1f} часов)")
             
-            # Ждем до времени сброса
-            await asyncio.sleep(wait_seconds)
+            # Ждем до времени сброса (с запасом в секунду, чтобы не проснуться до полуночи)
+            await asyncio.sleep(max(0, wait_seconds) + 1)
+            
+            # Обновляем текущий день по Москве, по нему сообщения определяют устаревшие thread'ы
+            db.refresh_moscow_day()
             
             # Выполняем ежедневный сброс
             logger.info("🔄 Выполняется ежедневный сброс OpenAI threads...")
             deleted_count = db.reset_all_threads_daily()
             
+            # Сброшенные threads - это активные за прошлый день пользователи, по ним считаем размер пула
+            thread_pool.resize(deleted_count)
+            
             if deleted_count > 0:
                 logger.info(f"✅ Ежедневный сброс завершен: удалено {deleted_count} threads")
             else:
@@ -59,13 +53,8 @@ def get_next_reset_time():
     moscow_tz = pytz.timezone('Europe/Moscow')
     now_moscow = datetime.now(moscow_tz)
     
-    # Следующий сброс в 00:00
-    if now_moscow.time() < time(0, 1):  # Если еще не прошла минута после полуночи
-        next_reset = now_moscow.replace(hour=0, minute=0, second=0, microsecond=0)
-    else:
-        # Сброс завтра в 00:00
-        tomorrow = now_moscow.replace(hour=0, minute=0, second=0, microsecond=0)
-        from datetime import timedelta
-        next_reset = tomorrow + timedelta(days=1)
+    # Следующий сброс - ближайшая полночь (завтра в 00:00)
+    tomorrow = now_moscow.date() + timedelta(days=1)
+    next_reset = moscow_tz.localize(datetime.combine(tomorrow, time(0, 0)))
     
     return next_reset
\ No newline at end of file
@@ -8,6 +8,8 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from core.database import db
 from keyboards.inline import get_kupi_video_menu
 from utils.message_utils import send_split_message
+from core.telegram_sender import current_priority, PRIORITY_FUNNEL
+from core.sharding import owns_user
 
 logger = logging.getLogger(__name__)
 
@@ -232,7 +234,8 @@ async def process_kupi_video_queue(bot: Bot):
         reset_kupi_history_if_needed()
         
         # Получаем пользователей, которым нужно отправить купи-видео
-        users_to_send = db.get_users_for_kupi_video()
+        # В многопроцессном режиме каждый воркер отправляет только своим пользователям
+        users_to_send = [user_id for user_id in db.get_users_for_kupi_video() if owns_user(user_id)]
         
         if not users_to_send:
             logger.debug("Нет пользователей для отправки купи-видео")
@@ -279,6 +282,9 @@ async def kupi_video_background_task(bot: Bot):
     """
     logger.info("Запущена фоновая задача купи-видео")
     
+    # Купи-видео уступает очередь интерактивным ответам (задача работает в своем контексте)
+    current_priority.set(PRIORITY_FUNNEL)
+    
     while True:
         try:
             await process_kupi_video_queue(bot)
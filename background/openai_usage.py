@@ -0,0 +1,22 @@
+import asyncio
+import logging
+
+from core.config import OPENAI_USAGE_FLUSH_INTERVAL
+from services.usage_ledger import usage_ledger
+
+logger = logging.getLogger(__name__)
+
+async def openai_usage_flush_task():
+    """
+    Фоновая запись накопленного в памяти расхода OpenAI в БД.
+    Запускается в каждом процессе, обрабатывающем ИИ-чат; при остановке
+    несохраненный расход записывается сразу.
+    """
+    logger.info("📈 Фоновая запись расхода OpenAI запущена")
+
+    try:
+        while True:
+            await asyncio.sleep(OPENAI_USAGE_FLUSH_INTERVAL)
+            usage_ledger.flush()
+    finally:
+        usage_ledger.flush()
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+from core.config import (
+    REFERRAL_SETTLEMENT_INTERVAL, REFERRAL_SETTLEMENT_BATCH_SIZE, REFERRAL_SETTLEMENT_CONCURRENCY,
+    REFERRAL_SETTLEMENT_RETRY_BASE, REFERRAL_SETTLEMENT_RETRY_MAX, REFERRAL_SETTLEMENT_MAX_ATTEMPTS
+)
+from core.database import db
+from services.referral_getcourse import send_referral_data_to_getcourse
+
+logger = logging.getLogger(__name__)
+
+async def settle_referral_balances() -> tuple:
+    """
+    Отправляет в GetCourse текущие балансы рефереров с новыми начислениями.
+    Несколько начислений одному рефереру за интервал дают одну отправку,
+    неудачные отправки повторяются с растущей паузой.
+
+    Returns:
+        tuple: (отправлено, с ошибкой)
+    """
+    pending = db.get_pending_referral_settlements(REFERRAL_SETTLEMENT_BATCH_SIZE, REFERRAL_SETTLEMENT_MAX_ATTEMPTS)
+    if not pending:
+        return 0, 0
+
+    semaphore = asyncio.Semaphore(REFERRAL_SETTLEMENT_CONCURRENCY)
+
+    async def settle(referrer_user_id: int, version: int, email: str, balance: int):
+        if not email:
+            # Баланс уйдет в GetCourse при регистрации email реферером
+            logger.warning(f"Email не найден для рефера {referrer_user_id}")
+            return referrer_user_id, version, True, None
+        async with semaphore:
+            if await send_referral_data_to_getcourse(email, balance or 0):
+                return referrer_user_id, version, True, None
+            return referrer_user_id, version, False, "GetCourse не принял баланс"
+
+    results = await asyncio.gather(*(settle(*row) for row in pending))
+    parked = db.complete_referral_settlements(
+        results, REFERRAL_SETTLEMENT_RETRY_BASE, REFERRAL_SETTLEMENT_RETRY_MAX, REFERRAL_SETTLEMENT_MAX_ATTEMPTS
+    )
+    for referrer_user_id in parked:
+        logger.warning(
+            f"Баланс рефера {referrer_user_id} не отправлен в GetCourse после "
+            f"{REFERRAL_SETTLEMENT_MAX_ATTEMPTS} попыток, повтор - после нового начисления"
+        )
+
+    failed = sum(1 for _, _, success, _ in results if not success)
+    return len(results) - failed, failed
+
+async def referral_settlement_background_task():
+    """
+    Фоновая отправка реферальных балансов в GetCourse.
+    Очередь хранится в БД, поэтому начисления не теряются при перезапуске.
+    """
+    logger.info("🎁 Фоновая отправка реферальных балансов запущена")
+
+    while True:
+        try:
+            sent, failed = await settle_referral_balances()
+            if sent or failed:
+                logger.info(f"🎁 Реферальные балансы отправлены в GetCourse: {sent}, с ошибкой: {failed}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки реферальных балансов: {e}")
+
+        await asyncio.sleep(REFERRAL_SETTLEMENT_INTERVAL)
@@ -0,0 +1,25 @@
+import asyncio
+import logging
+
+from core.config import SEGMENT_RECONCILE_INTERVAL
+from core.database import db
+
+logger = logging.getLogger(__name__)
+
+async def segment_reconcile_background_task():
+    """
+    Фоновая сверка счетчиков сегментов аудитории с исходными таблицами.
+    Счетчики меняются при каждой записи; сверка исправляет расхождения, например
+    из-за истекших подписок или правок базы вручную.
+    """
+    logger.info("🔢 Фоновая сверка счетчиков сегментов запущена")
+
+    while True:
+        try:
+            drift = db.reconcile_segment_counters()
+            if drift:
+                logger.warning(f"🔢 Расхождения счетчиков сегментов исправлены: {drift}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка сверки счетчиков сегментов: {e}")
+
+        await asyncio.sleep(SEGMENT_RECONCILE_INTERVAL)
@@ -0,0 +1,64 @@
+import functools
+import logging
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from core.config import (
+    TEXTS, PERMANENT_ACCESS_IDS, SUBSCRIPTION_EXPIRY_REMINDERS, EXPIRY_REMINDER_MAX_AGE
+)
+from core.database import db
+from core.expiry_scheduler import expiry_scheduler
+from core.telegram_sender import current_priority, PRIORITY_NOTIFICATION
+from keyboards.inline import get_kupi_video_menu
+
+logger = logging.getLogger(__name__)
+
+async def send_expiry_reminders(bot: Bot, expired: list):
+    """
+    Напоминает о продлении пользователям, у которых только что закончилась подписка
+
+    Args:
+        bot: экземпляр бота
+        expired: [(user_id, expires_at)] истекших подписок
+    """
+    now = datetime.now()
+    sent = 0
+
+    for user_id, expires_at in expired:
+        if user_id in PERMANENT_ACCESS_IDS:
+            continue
+        # Подписки, истекшие давно (например, до первого запуска планировщика), пропускаем
+        if (now - datetime.fromisoformat(expires_at)).total_seconds() > EXPIRY_REMINDER_MAX_AGE:
+            continue
+
+        try:
+            if db.is_user_blocked(user_id):
+                continue
+            await bot.send_message(user_id, TEXTS["subscription_expired"], reply_markup=get_kupi_video_menu())
+            sent += 1
+        except TelegramForbiddenError:
+            db.mark_user_blocked(user_id, "Bot blocked by user")
+        except Exception as e:
+            logger.warning(f"Не удалось отправить напоминание о продлении пользователю {user_id}: {e}")
+
+    if sent:
+        logger.info(f"⏳ Напоминаний о продлении отправлено: {sent}")
+
+async def subscription_expiry_task(bot: Bot = None):
+    """
+    Фоновая задача снятия истекших подписок (с напоминаниями о продлении, если они включены)
+
+    Args:
+        bot: экземпляр бота для напоминаний
+    """
+    logger.info("⏱️ Планировщик окончаний подписок запущен")
+    # Напоминания уступают очередь ответам пользователям, но опережают автоворонки
+    current_priority.set(PRIORITY_NOTIFICATION)
+
+    on_expired = None
+    if bot is not None and SUBSCRIPTION_EXPIRY_REMINDERS:
+        on_expired = functools.partial(send_expiry_reminders, bot)
+
+    await expiry_scheduler.run(on_expired)
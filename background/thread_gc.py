@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+from core.config import (
+    THREAD_GC_BATCH_SIZE, THREAD_GC_CONCURRENCY,
+    THREAD_GC_MAX_ATTEMPTS, THREAD_GC_IDLE_INTERVAL
+)
+from core.database import db
+from core.openai_client import openai_client
+
+logger = logging.getLogger(__name__)
+
+async def reclaim_threads_batch() -> tuple:
+    """
+    Удаляет в OpenAI одну пачку сброшенных thread'ов из очереди openai_thread_gc
+
+    Returns:
+        tuple: (обработано, удалено, байт освобождено)
+    """
+    thread_ids = db.get_threads_to_reclaim(THREAD_GC_BATCH_SIZE, THREAD_GC_MAX_ATTEMPTS)
+    if not thread_ids:
+        return 0, 0, 0
+
+    semaphore = asyncio.Semaphore(THREAD_GC_CONCURRENCY)
+
+    async def reclaim(thread_id: str):
+        async with semaphore:
+            try:
+                size = await openai_client.delete_remote_thread(thread_id)
+                return thread_id, True, size, None
+            except Exception as e:
+                logger.warning(f"Не удалось удалить thread {thread_id} в OpenAI: {e}")
+                return thread_id, False, 0, str(e)[:500]
+
+    results = await asyncio.gather(*(reclaim(thread_id) for thread_id in thread_ids))
+    db.save_thread_reclaim_results(results, THREAD_GC_MAX_ATTEMPTS)
+
+    deleted = sum(1 for _, success, _, _ in results if success)
+    reclaimed_bytes = sum(size for _, _, size, _ in results)
+    return len(results), deleted, reclaimed_bytes
+
+async def thread_gc_background_task():
+    """
+    Фоновая задача удаления сброшенных OpenAI threads на стороне OpenAI.
+    Очередь хранится в БД, поэтому после перезапуска работа продолжается с того же места.
+    """
+    logger.info("🧹 Фоновая задача удаления OpenAI threads запущена")
+
+    while True:
+        try:
+            processed, deleted, reclaimed_bytes = await reclaim_threads_batch()
+
+            if processed == 0:
+                await asyncio.sleep(THREAD_GC_IDLE_INTERVAL)
+                continue
+
+            stats = db.get_thread_gc_stats()
+            logger.info(
+                f"🧹 Удалено threads в OpenAI: {deleted}/{processed} ({reclaimed_bytes / 1024:.1f} KB). "
+                f"Всего: {stats['deleted']} ({stats['bytes_reclaimed'] / 1024 / 1024:.1f} MB), "
+                f"в очереди: {stats['pending']}, с ошибками: {stats['failed']}"
+            )
+
+            # Пачка целиком не удалась (например, OpenAI недоступен) - ждем дольше
+            await asyncio.sleep(60 if deleted == 0 else 1)
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка в задаче удаления threads: {e}")
+            await asyncio.sleep(THREAD_GC_IDLE_INTERVAL)
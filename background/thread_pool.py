@@ -0,0 +1,25 @@
+import asyncio
+import logging
+
+from core.config import THREAD_POOL_REFILL_INTERVAL
+from core.database import db
+from core.openai_client import openai_client
+from core.thread_pool import thread_pool
+
+logger = logging.getLogger(__name__)
+
+async def thread_pool_background_task():
+    """
+    Фоновая задача пополнения пула заранее созданных OpenAI threads
+    """
+    logger.info("🧵 Фоновая задача пула threads запущена")
+    
+    # До первого сброса оцениваем активность по текущему числу threads
+    thread_pool.resize(db.get_active_threads_count())
+    
+    while True:
+        try:
+            await thread_pool.run(openai_client.create_remote_thread, THREAD_POOL_REFILL_INTERVAL)
+        except Exception as e:
+            logger.error(f"❌ Ошибка в задаче пула threads: {e}")
+            await asyncio.sleep(THREAD_POOL_REFILL_INTERVAL)
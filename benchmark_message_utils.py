@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк разбивки длинных сообщений на входах по 100 KB
+Запускать: python3 benchmark_message_utils.py
+"""
+
+import random
+import re
+import time
+
+from utils.message_utils import split_text_message, StreamingTextSplitter, TELEGRAM_MAX_LENGTH
+
+INPUT_SIZE = 100 * 1024
+ROUNDS = 20
+
+WORDS = [
+    "энергия", "любовь", "изобилие", "ясность", "отношения", "доход", "проявленность",
+    "практика", "медитация", "поддержка", "дыхание", "сердце", "путь", "ресурс"
+]
+
+
+def build_plain_text(size: int) -> str:
+    """Обычный ответ ИИ: абзацы из предложений"""
+    rnd = random.Random(42)
+    paragraphs = []
+    total = 0
+    while total < size:
+        sentences = []
+        for _ in range(rnd.randint(2, 8)):
+            sentence = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 20)))
+            sentences.append(sentence.capitalize() + ".")
+        paragraph = " ".join(sentences)
+        paragraphs.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:size]
+
+
+def build_html_text(size: int) -> str:
+    """Текст с HTML разметкой, включая теги на несколько абзацев"""
+    rnd = random.Random(7)
+    chunks = []
+    total = 0
+    while total < size:
+        words = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 60)))
+        kind = rnd.random()
+        if kind < 0.2:
+            chunk = f"<b>{words}</b> &amp; {words}."
+        elif kind < 0.3:
+            chunk = f'<a href="https://solotatiana.getcourse.ru/avatarself">{words}</a>.'
+        elif kind < 0.35:
+            # Длинный курсив на несколько абзацев - обязательно будет разрезан
+            long_words = " ".join(rnd.choice(WORDS) for _ in range(900))
+            chunk = f"<i>{long_words}.\n\n{long_words}</i>"
+        else:
+            chunk = words.capitalize() + "."
+        chunks.append(chunk)
+        total += len(chunk) + 2
+    return "\n\n".join(chunks)
+
+
+def check_parts(parts: list) -> None:
+    """Проверяет лимит длины и сбалансированность тегов в каждой части"""
+    tag_re = re.compile(r"<(/?)(b|i|a)(?:\s[^>]*)?>")
+    for part in parts:
+        assert len(part) <= TELEGRAM_MAX_LENGTH, f"Часть длиннее лимита: {len(part)}"
+        depth = {}
+        for m in tag_re.finditer(part):
+            name = m.group(2)
+            depth[name] = depth.get(name, 0) + (-1 if m.group(1) else 1)
+            assert depth[name] >= 0, "Закрывающий тег без открывающего"
+        assert all(v == 0 for v in depth.values()), "Незакрытый тег в части"
+
+
+def bench(name: str, func, text: str) -> None:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        parts = func(text)
+    elapsed = (time.perf_counter() - start) / ROUNDS
+    check_parts(parts)
+    mb_per_sec = len(text) / elapsed / 1024 / 1024
+    print(f"  {name:<28} {elapsed * 1000:8.2f} ms  {mb_per_sec:8.1f} MB/s  частей: {len(parts)}")
+
+
+def split_streaming(text: str, piece_size: int = 50) -> list:
+    """Имитация потокового ответа: текст приходит кусками по piece_size символов"""
+    splitter = StreamingTextSplitter()
+    parts = []
+    for i in range(0, len(text), piece_size):
+        parts.extend(splitter.feed(text[i:i + piece_size]))
+    parts.extend(splitter.close())
+    return parts
+
+
+def main():
+    print("📊 БЕНЧМАРК РАЗБИВКИ СООБЩЕНИЙ")
+    print("=" * 50)
+
+    for label, text in (
+        ("Обычный текст", build_plain_text(INPUT_SIZE)),
+        ("HTML разметка", build_html_text(INPUT_SIZE)),
+    ):
+        print(f"{label} ({len(text) / 1024:.0f} KB):")
+        bench("split_text_message", split_text_message, text)
+        bench("StreamingTextSplitter", split_streaming, text)
+
+
+if __name__ == "__main__":
+    main()
@@ -34,12 +34,134 @@ NEWS_ADMIN_IDS = [
 TARIFF_BASIC_PRICE = 5555
 TARIFF_VIP_PRICE = 7777
 
+# Лимиты исходящих запросов к Telegram (сообщений в секунду и размер пачки)
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_GLOBAL_BURST = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 4
+TELEGRAM_RETRY_ATTEMPTS = 3
+
+# Голосовые и аудио для расшифровки: файлы до порога держим в памяти, крупнее - во временном файле
+AUDIO_MAX_SIZE = 20 * 1024 * 1024  # лимит скачивания Bot API (у Whisper - 25 MB)
+AUDIO_SPOOL_THRESHOLD = 2 * 1024 * 1024
+
+# Пул расшифровки аудио и кэш расшифровок по file_unique_id
+TRANSCRIPTION_WORKERS = 4
+TRANSCRIPTION_QUEUE_SIZE = 100
+TRANSCRIPT_CACHE_SIZE = 5000
+TRANSCRIPT_CACHE_TTL = 24 * 60 * 60  # 24 часа
+
+# Кэш UTM меток пользователей в памяти (services/utm_manager.py)
+UTM_CACHE_SIZE = 10000
+UTM_CACHE_TTL = 6 * 60 * 60  # 6 часов
+
+# Снимок подписки и реферального баланса для клавиатур (keyboards/inline.py); TTL нужен,
+# чтобы подхватить окончание подписки, которое не меняет версию пользователя
+USER_STATE_CACHE_SIZE = 10000
+USER_STATE_CACHE_TTL = 5 * 60
+
+# Кэш ответов ИИ на похожие вопросы (включается переменной окружения ANSWER_CACHE_ENABLED=1)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "0").lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIZE = 2000
+ANSWER_CACHE_TTL = 24 * 60 * 60  # 24 часа
+ANSWER_CACHE_SIMILARITY = 0.85  # минимальное сходство вопросов (Жаккар по символьным 3-граммам)
+ANSWER_CACHE_MIN_LENGTH = 20  # короткие реплики ("привет", "спасибо") зависят от контекста диалога
+ANSWER_CACHE_MAX_LENGTH = 500
+
+# Цены OpenAI в долларах за 1M токенов - для оценки сэкономленных расходов
+OPENAI_INPUT_PRICE_PER_1M = float(os.getenv("OPENAI_INPUT_PRICE_PER_1M", "2.5"))
+OPENAI_OUTPUT_PRICE_PER_1M = float(os.getenv("OPENAI_OUTPUT_PRICE_PER_1M", "10"))
+OPENAI_WHISPER_PRICE_PER_MINUTE = float(os.getenv("OPENAI_WHISPER_PRICE_PER_MINUTE", "0.006"))
+
+# Учет расхода OpenAI по пользователям за день (по Москве) и дневные квоты по тарифу
+OPENAI_USAGE_FLUSH_INTERVAL = 30  # накопленный в памяти расход записывается в БД раз в интервал
+# Квоты только учитываются, пока не включены OPENAI_QUOTAS_ENABLED=1 (после сверки с реальным расходом)
+OPENAI_QUOTAS_ENABLED = os.getenv("OPENAI_QUOTAS_ENABLED", "0").lower() in ("1", "true", "yes")
+OPENAI_DAILY_QUOTAS = {
+    "basic": {"tokens": 300000, "audio_seconds": 30 * 60},
+    "vip": {"tokens": 600000, "audio_seconds": 60 * 60},
+    "course": {"tokens": 600000, "audio_seconds": 60 * 60},
+}
+OPENAI_DAILY_QUOTA_DEFAULT = "basic"  # для неизвестных тарифов
+
+# Удаление сброшенных OpenAI thread'ов на стороне OpenAI
+THREAD_GC_BATCH_SIZE = 50
+THREAD_GC_CONCURRENCY = 4
+THREAD_GC_MAX_ATTEMPTS = 5
+THREAD_GC_IDLE_INTERVAL = 10 * 60  # пауза, когда очередь пуста
+
+# Пул заранее созданных OpenAI thread'ов: размер - доля активных за прошлый день пользователей
+THREAD_POOL_FRACTION = 0.2
+THREAD_POOL_MIN_SIZE = 5
+THREAD_POOL_MAX_SIZE = 200
+THREAD_POOL_CONCURRENCY = 2
+THREAD_POOL_REFILL_INTERVAL = 30
+
+# Бюджет контекста OpenAI в токенах (оценка до запуска ассистента)
+OPENAI_CONTEXT_TOKEN_BUDGET = int(os.getenv("OPENAI_CONTEXT_TOKEN_BUDGET", "24000"))  # ниже лимита TPM модели
+OPENAI_MESSAGE_TOKEN_LIMIT = int(os.getenv("OPENAI_MESSAGE_TOKEN_LIMIT", "4000"))  # одно сообщение пользователя
+OPENAI_CONTEXT_OVERHEAD_TOKENS = 6000  # инструкции и база знаний до первой калибровки по run.usage
+
+# Ограничение частоты сообщений ИИ-чату по тарифу: не больше messages за window секунд
+# и не больше concurrency одновременно обрабатываемых сообщений (вечный доступ - без ограничений)
+AI_RATE_LIMITS = {
+    "basic": {"messages": 10, "window": 60, "concurrency": 1},
+    "vip": {"messages": 20, "window": 60, "concurrency": 2},
+    "course": {"messages": 20, "window": 60, "concurrency": 2},
+}
+AI_RATE_LIMIT_DEFAULT = "basic"  # для неизвестных тарифов
+AI_THROTTLE_CACHE_SIZE = 50000
+
+# Многопроцессный режим (sharded.py): число воркеров и координация через SQLite
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "4"))
+SHARD_QUEUE_SIZE = 1000  # апдейтов в очереди воркера, при заполнении координатор ждет
+SHARD_WORKER_CONCURRENCY = 50  # одновременно обрабатываемых апдейтов в воркере
+JOB_LEASE_TTL = 30  # секунд; лидер фоновой задачи продлевает аренду каждые TTL/3
+BLOCKED_USERS_RELOAD_INTERVAL = 300  # как часто перечитывать блокировки из БД (их пишут и другие процессы)
+
+# Прием апдейтов Telegram: polling (по умолчанию) или webhook на aiohttp-сервере вместе с GetCourse
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")  # публичный https-адрес сервера, без него остается polling
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+TELEGRAM_WEBHOOK_PATH = "/webhook/telegram"
+WEBHOOK_MAX_CONNECTIONS = 40  # одновременных соединений от Telegram (параметр setWebhook)
+WEBHOOK_QUEUE_SIZE = 1000  # принятых, но еще не обработанных апдейтов
+WEBHOOK_CONCURRENCY = 50  # одновременно обрабатываемых апдейтов
+WEBHOOK_ENQUEUE_TIMEOUT = 5  # секунд ожидания места в очереди, затем 503 и повтор от Telegram
+
+# Каноничная таблица users: last_seen обновляется не чаще раза в интервал на пользователя
+USER_TOUCH_INTERVAL = 10 * 60
+USER_TOUCH_CACHE_SIZE = 50000
+SEGMENT_RECONCILE_INTERVAL = 60 * 60  # сверка счетчиков сегментов аудитории с исходными таблицами
+
+# Состояния FSM (рассылка, регистрация в реферальной программе) хранятся в БД и переживают перезапуск
+FSM_FLUSH_INTERVAL = 1  # секунд накопления изменений перед записью одной транзакцией
+FSM_CACHE_SIZE = 10000
+FSM_STATE_TTL = 7 * 24 * 60 * 60  # незавершенные состояния старше этого удаляются
+FSM_CLEANUP_INTERVAL = 60 * 60
+
+# Планировщик окончаний подписок: ближайшие окончания держатся в куче в памяти
+EXPIRY_LOOKAHEAD = 1000  # сколько ближайших окончаний загружать из БД
+EXPIRY_BATCH_SIZE = 200  # подписок, снимаемых одной транзакцией
+EXPIRY_RELOAD_INTERVAL = 60 * 60  # перечитывание БД (подписки, сохраненные другими процессами)
+# Напоминание о продлении при окончании подписки (SUBSCRIPTION_EXPIRY_REMINDERS=1)
+SUBSCRIPTION_EXPIRY_REMINDERS = os.getenv("SUBSCRIPTION_EXPIRY_REMINDERS", "0").lower() in ("1", "true", "yes")
+EXPIRY_REMINDER_MAX_AGE = 24 * 60 * 60  # давно истекшим подпискам (например, при первом запуске) не напоминаем
+
 # Служба поддержки
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "@zabotasolo")
 
 # Реферальная система
 REFERRAL_BONUS = 500  # Бонус в рублях за приглашение
 GETCOURSE_REFERRAL_WEBHOOK = "https://solotatiana.getcourse.ru/chtm/ai-referal/refferal"
+REFERRAL_SETTLEMENT_INTERVAL = 60  # балансы рефереров отправляются в GetCourse раз в интервал
+REFERRAL_SETTLEMENT_BATCH_SIZE = 100
+REFERRAL_SETTLEMENT_CONCURRENCY = 4
+REFERRAL_SETTLEMENT_RETRY_BASE = 60  # задержка после первой неудачной отправки, удваивается с каждой следующей
+REFERRAL_SETTLEMENT_RETRY_MAX = 6 * 60 * 60
+REFERRAL_SETTLEMENT_MAX_ATTEMPTS = 10  # после стольких неудач подряд баланс не отправляется до нового начисления
 
 # Пути к изображениям
 IMAGES = {
@@ -154,6 +276,18 @@ TEXTS = {
     
     "disclaimer": """Онлайн-аватар не является медицинской или психологической помощью. Все ответы даются на базе материалов Татьяны Соло и не являются индивидуальной рекомендацией или диагностикой.""",
     
+    "subscription_expired": """⏳ <b>Ваша подписка закончилась</b>
+
+Доступ к онлайн-аватару Татьяны Соло приостановлен. Продлите подписку, чтобы продолжить общение 👇🏻""",
+    
+    "ai_rate_limited": """🌸 Милая, ты пишешь быстрее, чем я успеваю думать! Дай мне чуть-чуть передохнуть и напиши снова через {seconds} сек. 💕""",
+    
+    "ai_quota_exceeded": """🌙 Милая, на сегодня мы с тобой наговорились вдоволь! Лимит общения по твоему тарифу обновится в полночь по Москве - буду ждать тебя завтра 💕""",
+    
+    "ai_audio_quota_exceeded": """🎙 Милая, лимит голосовых сообщений на сегодня закончился. Напиши мне текстом - я с радостью отвечу, а голосовые снова смогу слушать после полуночи по Москве 💕""",
+    
+    "ai_busy": """⏳ Я еще думаю над твоим предыдущим сообщением. Сначала отвечу на него, а потом с радостью продолжим 💕""",
+    
     "payment_success": """🎉 <b>Поздравляем! Ваша оплата прошла успешно!</b>
 
 ✅ Доступ к онлайн-аватару Татьяны Соло активирован
@@ -1,24 +1,115 @@
 import sqlite3
 import asyncio
 import logging
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 
+import pytz
+
+from core.config import BLOCKED_USERS_RELOAD_INTERVAL
+from utils.cache import LRUCache
+
 logger = logging.getLogger(__name__)
 
 # Путь к базе данных
 DB_PATH = "bot_database.db"
 
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+# Кэш OpenAI thread'ов пользователей (сбрасывается вместе с thread'ами в полночь)
+THREAD_CACHE_SIZE = 50000
+
+# Сегменты аудитории со счетчиками в segment_counters (совпадают с аудиториями рассылки)
+SEGMENT_ALL_USERS = "all_users"
+SEGMENT_ACTIVE_SUBSCRIBERS = "active_subscribers"
+SEGMENT_PAID_SUBSCRIBERS = "paid_subscribers"
+SEGMENT_VIP_USERS = "vip_users"
+SEGMENT_COURSE_USERS = "course_users"
+SEGMENT_BLOCKED_USERS = "blocked_users"
+
+# Срок подписки после одной оплаты
+SUBSCRIPTION_DAYS = 30
+
 class Database:
     def __init__(self):
         self.db_path = DB_PATH
+        # Версии подписки/реферального профиля пользователей для инвалидации кэшей (клавиатуры и т.п.)
+        self.user_versions = {}
+        self._version_counter = 0
+        self.version_listeners = []
+        # Вызываются с (user_id, expires_at) после сохранения подписки (планировщик окончаний)
+        self.subscription_listeners = []
+        # Текущий день по Москве и момент его окончания (time.time()), обновляется планировщиком сброса
+        self._moscow_day = None
+        self._moscow_day_until = 0.0
+        # user_id -> {'thread_id', 'last_reset_date'} или None, если thread'а нет
+        self.thread_cache = LRUCache(maxsize=THREAD_CACHE_SIZE)
+        # Копия blocked_users в памяти: проверка блокировки без обращения к БД
+        self._blocked_users = set()
+        self._blocked_loaded_at = None
         self.init_db()
+        self.load_blocked_users()
+    
+    def refresh_moscow_day(self) -> str:
+        """
+        Пересчитывает текущий день по Москве и время до следующей полуночи
+        
+        Returns:
+            str: дата в формате YYYY-MM-DD
+        """
+        now_moscow = datetime.now(MOSCOW_TZ)
+        next_midnight = MOSCOW_TZ.localize(
+            datetime.combine(now_moscow.date() + timedelta(days=1), datetime.min.time())
+        )
+        self._moscow_day = now_moscow.strftime('%Y-%m-%d')
+        self._moscow_day_until = next_midnight.timestamp()
+        return self._moscow_day
+    
+    def get_moscow_day(self) -> str:
+        """
+        Текущий день по Москве без обращения к pytz на каждый вызов
+        
+        Returns:
+            str: дата в формате YYYY-MM-DD
+        """
+        if self._moscow_day is None or time.time() >= self._moscow_day_until:
+            return self.refresh_moscow_day()
+        return self._moscow_day
+    
+    def get_user_version(self, user_id: int) -> int:
+        """
+        Возвращает версию подписки и реферального профиля пользователя.
+        Версия меняется при каждой оплате, начислении или списании бонусов.
+        
+        Args:
+            user_id: ID пользователя
+            
+        Returns:
+            int: версия (0 - изменений с момента запуска не было)
+        """
+        return self.user_versions.get(user_id, 0)
+    
+    def _bump_user_version(self, user_id: int, notify: bool = True):
+        """Отмечает изменение подписки или реферального профиля пользователя"""
+        self._version_counter += 1
+        self.user_versions[user_id] = self._version_counter
+        # В многопроцессном режиме изменение передается процессу, который обслуживает пользователя
+        if notify:
+            for listener in self.version_listeners:
+                try:
+                    listener(user_id)
+                except Exception as e:
+                    logger.error(f"Ошибка уведомления об изменении пользователя {user_id}: {e}")
     
     def init_db(self):
         """Инициализация базы данных"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
+        # WAL: чтения не блокируются записью, в том числе из других процессов бота
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # Таблица для отслеживания автоспама
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS auto_spam_history (
@@ -57,6 +148,12 @@ class Database:
             )
         ''')
         
+        # Ближайшие окончания активных подписок (планировщик окончаний, информация при запуске)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_user_subscriptions_active_expires
+            ON user_subscriptions (is_active, expires_at)
+        ''')
+        
         # Таблица для OpenAI threads
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS openai_threads (
@@ -102,6 +199,166 @@ class Database:
             )
         ''')
         
+        # Бонус за приглашенного начисляется рефереру один раз
+        try:
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_bonuses_pair
+                ON referral_bonuses (referrer_user_id, referred_user_id)
+            ''')
+        except sqlite3.IntegrityError:
+            logger.error("В referral_bonuses есть повторные начисления, уникальный индекс не создан")
+        
+        # Рефереры, чей баланс нужно отправить в GetCourse (version растет при каждом начислении).
+        # После неудачи следующая попытка откладывается (next_attempt_at), после
+        # REFERRAL_SETTLEMENT_MAX_ATTEMPTS неудач подряд запись остается в таблице, но не отправляется
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS referral_settlements (
+                referrer_user_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 1,
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        try:
+            cursor.execute("ALTER TABLE referral_settlements ADD COLUMN next_attempt_at TIMESTAMP")
+            cursor.execute("UPDATE referral_settlements SET next_attempt_at = queued_at")
+            logger.info("Добавлена колонка next_attempt_at в referral_settlements")
+        except sqlite3.OperationalError:
+            pass  # Колонка уже существует
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_referral_settlements_next_attempt
+            ON referral_settlements (next_attempt_at)
+        ''')
+        
+        # Таблица для хранения file_id медиафайлов (также создается migrate_database.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_file_ids (
+                file_path TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                file_type TEXT NOT NULL,
+                file_size INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Таблица для отслеживания отправленного стартового видео
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS start_video_sent (
+                user_id INTEGER PRIMARY KEY,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Пользователи, заблокировавшие бота (также создается migrate_database.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                user_id INTEGER PRIMARY KEY,
+                blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                reason TEXT
+            )
+        ''')
+        
+        # Очередь удаления OpenAI thread'ов на стороне OpenAI (прогресс сохраняется между перезапусками)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS openai_thread_gc (
+                thread_id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                bytes_reclaimed INTEGER DEFAULT 0,
+                last_error TEXT,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                processed_at TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_openai_thread_gc_status
+            ON openai_thread_gc (status, queued_at)
+        ''')
+        
+        # Заранее созданные пустые OpenAI threads для первых сообщений после сброса
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS openai_thread_pool (
+                thread_id TEXT PRIMARY KEY,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Состояния FSM aiogram (core/fsm_storage.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage (updated_at)")
+        
+        # Расход OpenAI по пользователям за день (services/usage_ledger.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS openai_usage (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                requests INTEGER DEFAULT 0,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                chat_latency_ms INTEGER DEFAULT 0,
+                transcriptions INTEGER DEFAULT 0,
+                audio_seconds INTEGER DEFAULT 0,
+                transcription_latency_ms INTEGER DEFAULT 0,
+                PRIMARY KEY (day, user_id)
+            )
+        ''')
+        
+        # Аренда фоновых задач между процессами (многопроцессный режим)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        
+        # Каноничная таблица пользователей: все, кто когда-либо обращался к боту, и флаги аудиторий рассылок
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'")
+        users_table_exists = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_blocked BOOLEAN DEFAULT FALSE,
+                is_paid BOOLEAN DEFAULT FALSE,
+                is_vip BOOLEAN DEFAULT FALSE,
+                is_course BOOLEAN DEFAULT FALSE
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_paid ON users (user_id) WHERE is_paid = 1")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_vip ON users (user_id) WHERE is_vip = 1")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_course ON users (user_id) WHERE is_course = 1")
+        if not users_table_exists:
+            self._backfill_users(cursor)
+        
+        # Счетчики сегментов аудитории: обновляются при каждом изменении, сверяются фоновой задачей
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'segment_counters'")
+        segment_counters_exist = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS segment_counters (
+                segment TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        if not segment_counters_exist:
+            self._store_segment_counts(cursor, self._count_segments(cursor))
+        
         # Таблица для логов рассылок новостей
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS news_broadcasts (
@@ -148,6 +405,182 @@ class Database:
         conn.close()
         logger.info("База данных инициализирована")
 
+    def _backfill_users(self, cursor):
+        """
+        Заполняет таблицу users по существующим таблицам (миграция при ее создании).
+        Повторный запуск безопасен: существующие записи не перезаписываются, флаги только выставляются.
+        """
+        cursor.execute('''
+            INSERT OR IGNORE INTO users (user_id, first_seen, last_seen)
+            SELECT user_id, MIN(seen_at), MAX(seen_at) FROM (
+                SELECT user_id, created_at AS seen_at FROM auto_spam_history
+                UNION ALL
+                SELECT user_id, created_at FROM user_utm
+                UNION ALL
+                SELECT user_id, created_at FROM user_subscriptions
+                UNION ALL
+                SELECT user_id, created_at FROM openai_threads
+                UNION ALL
+                SELECT user_id, registered_at FROM referral_users
+            )
+            WHERE user_id IS NOT NULL
+            GROUP BY user_id
+        ''')
+        added = cursor.rowcount
+        
+        cursor.execute('''
+            UPDATE users SET is_paid = 1 WHERE user_id IN (
+                SELECT user_id FROM user_subscriptions
+                WHERE tariff_type IN ('basic', 'vip') OR basic_count > 0 OR vip_count > 0
+            )
+        ''')
+        cursor.execute('''
+            UPDATE users SET is_vip = 1 WHERE user_id IN (
+                SELECT user_id FROM user_subscriptions WHERE tariff_type = 'vip' OR vip_count > 0
+            )
+        ''')
+        cursor.execute('''
+            UPDATE users SET is_course = 1 WHERE user_id IN (
+                SELECT user_id FROM user_subscriptions WHERE tariff_type = 'course' OR course_count > 0
+            )
+        ''')
+        cursor.execute("UPDATE users SET is_blocked = 1 WHERE user_id IN (SELECT user_id FROM blocked_users)")
+        
+        logger.info(f"Таблица users заполнена по существующим данным: {added} пользователей")
+    
+    def touch_user(self, user_id: int, username: str = None, first_name: str = None):
+        """
+        Добавляет пользователя при первом обращении или обновляет время последнего визита
+        
+        Args:
+            user_id: ID пользователя
+            username: username в Telegram
+            first_name: имя в Telegram
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+            (user_id, username, first_name)
+        )
+        if cursor.rowcount:
+            self._apply_segment_deltas(cursor, {SEGMENT_ALL_USERS: 1})
+        else:
+            cursor.execute('''
+                UPDATE users SET
+                    username = COALESCE(?, username),
+                    first_name = COALESCE(?, first_name),
+                    last_seen = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            ''', (username, first_name, user_id))
+        
+        conn.commit()
+        conn.close()
+    
+    def _ensure_user(self, cursor, user_id: int, deltas: dict):
+        """Добавляет пользователя в users, если его там нет, и учитывает это в deltas"""
+        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        if cursor.rowcount:
+            deltas[SEGMENT_ALL_USERS] = deltas.get(SEGMENT_ALL_USERS, 0) + 1
+    
+    def _set_user_flag(self, cursor, user_id: int, column: str, segment: str, deltas: dict):
+        """Выставляет флаг пользователя; счетчик сегмента растет, только если флаг изменился"""
+        cursor.execute(f"UPDATE users SET {column} = 1 WHERE user_id = ? AND NOT {column}", (user_id,))
+        if cursor.rowcount:
+            deltas[segment] = deltas.get(segment, 0) + 1
+    
+    def _apply_segment_deltas(self, cursor, deltas: dict):
+        """Изменяет счетчики сегментов в той же транзакции, что и данные"""
+        for segment, delta in deltas.items():
+            if delta:
+                cursor.execute('''
+                    INSERT INTO segment_counters (segment, value) VALUES (?, ?)
+                    ON CONFLICT(segment) DO UPDATE SET
+                        value = value + excluded.value,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (segment, delta))
+    
+    def _count_segments(self, cursor) -> dict:
+        """Точные размеры сегментов по исходным таблицам"""
+        counts = {}
+        for segment, where in (
+            (SEGMENT_ALL_USERS, ""),
+            (SEGMENT_PAID_SUBSCRIBERS, " WHERE is_paid = 1"),
+            (SEGMENT_VIP_USERS, " WHERE is_vip = 1"),
+            (SEGMENT_COURSE_USERS, " WHERE is_course = 1"),
+            (SEGMENT_BLOCKED_USERS, " WHERE is_blocked = 1"),
+        ):
+            cursor.execute(f"SELECT COUNT(*) FROM users{where}")
+            counts[segment] = cursor.fetchone()[0]
+        
+        # is_active снимает планировщик окончаний в момент истечения подписки
+        cursor.execute("SELECT COUNT(*) FROM user_subscriptions WHERE is_active = TRUE")
+        counts[SEGMENT_ACTIVE_SUBSCRIBERS] = cursor.fetchone()[0]
+        return counts
+    
+    def _store_segment_counts(self, cursor, counts: dict):
+        cursor.executemany('''
+            INSERT OR REPLACE INTO segment_counters (segment, value, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', list(counts.items()))
+    
+    def get_segment_count(self, segment: str) -> int:
+        """
+        Размер сегмента аудитории из счетчика (без пересчета по таблицам)
+        
+        Args:
+            segment: одна из констант SEGMENT_*
+            
+        Returns:
+            int: количество пользователей в сегменте
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("SELECT value FROM segment_counters WHERE segment = ?", (segment,))
+            result = cursor.fetchone()
+            return max(0, result[0]) if result else 0
+        except Exception as e:
+            logger.error(f"Ошибка чтения счетчика сегмента {segment}: {e}")
+            return 0
+        finally:
+            conn.close()
+    
+    def reconcile_segment_counters(self) -> dict:
+        """
+        Сверяет счетчики сегментов с исходными таблицами и исправляет расхождения
+        
+        Returns:
+            dict: {сегмент: (было, стало)} для сегментов с расхождением
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            # Пересчет и запись в одной транзакции, чтобы не потерять параллельные изменения
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT segment, value FROM segment_counters")
+            stored = dict(cursor.fetchall())
+            counts = self._count_segments(cursor)
+            self._store_segment_counts(cursor, counts)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        drift = {
+            segment: (stored.get(segment, 0), value)
+            for segment, value in counts.items()
+            if stored.get(segment, 0) != value
+        }
+        if drift:
+            logger.info(f"Счетчики сегментов исправлены: {drift}")
+        return drift
+    
     def is_spam_completed(self, user_id: int) -> bool:
         """
         Проверяет, был ли уже отправлен автоспам пользователю
@@ -194,6 +627,280 @@ class Database:
         conn.close()
         logger.info(f"Автоспам отмечен как завершенный для пользователя {user_id}")
     
+    def load_user_context(self, user_id: int) -> dict:
+        """
+        Загружает одним запросом все, что нужно хендлерам о пользователе:
+        подписку, реферальный профиль, UTM метки и статус автоспама
+        
+        Args:
+            user_id: ID пользователя
+            
+        Returns:
+            dict: {'subscription': dict, 'referral': dict или None, 'utm': dict,
+                   'spam_completed': bool}
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT
+                s.tariff_type, s.payment_date, s.expires_at, s.is_active, s.payment_id,
+                s.basic_count, s.vip_count, s.course_count,
+                r.user_id, r.email, r.referrer_user_id, r.referral_balance, r.registered_at,
+                t.user_id, t.utm_source, t.utm_medium, t.utm_campaign,
+                a.spam_completed
+            FROM (SELECT ? AS user_id) AS me
+            LEFT JOIN user_subscriptions s ON s.user_id = me.user_id
+            LEFT JOIN referral_users r ON r.user_id = me.user_id
+            LEFT JOIN user_utm t ON t.user_id = me.user_id
+            LEFT JOIN auto_spam_history a ON a.user_id = me.user_id
+        ''', (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        
+        subscription = {}
+        if row[0] is not None:
+            expires_at = datetime.fromisoformat(row[2])
+            is_expired = datetime.now() > expires_at
+            subscription = {
+                'tariff_type': row[0],
+                'payment_date': row[1],
+                'expires_at': row[2],
+                'is_active': bool(row[3]) and not is_expired,
+                'is_expired': is_expired,
+                'payment_id': row[4],
+                'basic_count': row[5] or 0,
+                'vip_count': row[6] or 0,
+                'course_count': row[7] or 0,
+                'days_left': max(0, (expires_at - datetime.now()).days)
+            }
+        
+        referral = None
+        if row[8] is not None:
+            referral = {
+                'email': row[9],
+                'referrer_user_id': row[10],
+                'referral_balance': row[11],
+                'registered_at': row[12]
+            }
+        
+        utm = {}
+        if row[13] is not None:
+            utm = {
+                'utm_source': row[14] or '',
+                'utm_medium': row[15] or '',
+                'utm_campaign': row[16] or ''
+            }
+        
+        return {
+            'subscription': subscription,
+            'referral': referral,
+            'utm': utm,
+            'spam_completed': bool(row[17])
+        }
+    
+    def get_fsm_record(self, key: str) -> Optional[tuple]:
+        """
+        Получает состояние FSM по ключу
+        
+        Args:
+            key: ключ хранилища
+            
+        Returns:
+            tuple: (state, data в JSON) или None
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT state, data FROM fsm_storage WHERE key = ?", (key,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        return result
+    
+    def save_fsm_records(self, records: list):
+        """
+        Сохраняет накопленные изменения состояний FSM одной транзакцией
+        
+        Args:
+            records: список (key, state, data в JSON или None); запись без состояния
+                и данных удаляется
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany(
+                "DELETE FROM fsm_storage WHERE key = ?",
+                [(key,) for key, state, data in records if state is None and data is None]
+            )
+            cursor.executemany('''
+                INSERT INTO fsm_storage (key, state, data, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', [record for record in records if record[1] is not None or record[2] is not None])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    def delete_stale_fsm_records(self, max_age: int) -> int:
+        """
+        Удаляет состояния FSM, не менявшиеся дольше max_age секунд
+        
+        Returns:
+            int: количество удаленных записей
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            "DELETE FROM fsm_storage WHERE updated_at < datetime('now', ?)",
+            (f"-{int(max_age)} seconds",)
+        )
+        deleted = cursor.rowcount
+        conn.commit()
+        conn.close()
+        
+        return deleted
+    
+    def add_openai_usage(self, records: list):
+        """
+        Прибавляет накопленный расход OpenAI одной транзакцией
+        
+        Args:
+            records: список (day, user_id, requests, prompt_tokens, completion_tokens, chat_latency_ms,
+                transcriptions, audio_seconds, transcription_latency_ms)
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany('''
+                INSERT INTO openai_usage (
+                    day, user_id, requests, prompt_tokens, completion_tokens, chat_latency_ms,
+                    transcriptions, audio_seconds, transcription_latency_ms
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(day, user_id) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    chat_latency_ms = chat_latency_ms + excluded.chat_latency_ms,
+                    transcriptions = transcriptions + excluded.transcriptions,
+                    audio_seconds = audio_seconds + excluded.audio_seconds,
+                    transcription_latency_ms = transcription_latency_ms + excluded.transcription_latency_ms
+            ''', records)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    def get_openai_usage(self, day: str, user_id: int) -> dict:
+        """
+        Расход OpenAI пользователя за день (нули, если расхода не было)
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT requests, prompt_tokens, completion_tokens, chat_latency_ms,
+                   transcriptions, audio_seconds, transcription_latency_ms
+            FROM openai_usage WHERE day = ? AND user_id = ?
+        ''', (day, user_id))
+        result = cursor.fetchone() or (0, 0, 0, 0, 0, 0, 0)
+        conn.close()
+        
+        return {
+            'requests': result[0],
+            'prompt_tokens': result[1],
+            'completion_tokens': result[2],
+            'chat_latency_ms': result[3],
+            'transcriptions': result[4],
+            'audio_seconds': result[5],
+            'transcription_latency_ms': result[6]
+        }
+    
+    def get_top_openai_consumers(self, day: str, limit: int = 10) -> list:
+        """
+        Пользователи с наибольшим расходом токенов за день
+        
+        Returns:
+            list: словари с user_id, тарифом и расходом
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT o.user_id, s.tariff_type, o.requests, o.prompt_tokens, o.completion_tokens,
+                   o.chat_latency_ms, o.transcriptions, o.audio_seconds
+            FROM openai_usage o
+            LEFT JOIN user_subscriptions s ON s.user_id = o.user_id
+            WHERE o.day = ?
+            ORDER BY o.prompt_tokens + o.completion_tokens DESC, o.audio_seconds DESC
+            LIMIT ?
+        ''', (day, limit))
+        results = cursor.fetchall()
+        conn.close()
+        
+        return [
+            {
+                'user_id': row[0],
+                'tariff_type': row[1],
+                'requests': row[2],
+                'prompt_tokens': row[3],
+                'completion_tokens': row[4],
+                'chat_latency_ms': row[5],
+                'transcriptions': row[6],
+                'audio_seconds': row[7]
+            }
+            for row in results
+        ]
+    
+    def get_openai_usage_by_tariff(self, day: str) -> list:
+        """
+        Расход OpenAI за день по тарифам
+        
+        Returns:
+            list: словари с тарифом (None - без подписки), числом пользователей и суммарным расходом
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT s.tariff_type, COUNT(*), SUM(o.requests), SUM(o.prompt_tokens),
+                   SUM(o.completion_tokens), SUM(o.chat_latency_ms), SUM(o.transcriptions), SUM(o.audio_seconds)
+            FROM openai_usage o
+            LEFT JOIN user_subscriptions s ON s.user_id = o.user_id
+            WHERE o.day = ?
+            GROUP BY s.tariff_type
+            ORDER BY SUM(o.prompt_tokens + o.completion_tokens) DESC
+        ''', (day,))
+        results = cursor.fetchall()
+        conn.close()
+        
+        return [
+            {
+                'tariff_type': row[0],
+                'users': row[1],
+                'requests': row[2],
+                'prompt_tokens': row[3],
+                'completion_tokens': row[4],
+                'chat_latency_ms': row[5],
+                'transcriptions': row[6],
+                'audio_seconds': row[7]
+            }
+            for row in results
+        ]
+    
     def reset_spam_status(self, user_id: int):
         """
         Сбрасывает статус автоспама для пользователя (для тестирования)
@@ -303,6 +1010,8 @@ class Database:
         """
         Сохраняет подписку пользователя на 30 дней и увеличивает счетчик покупок.
         Если у пользователя уже есть активная подписка, продлевает её, а не перезаписывает.
+        Продление и счетчики считаются в SQL одной транзакцией, поэтому параллельные
+        вебхуки одного пользователя не теряют оплаты.
         
         Args:
             user_id: ID пользователя
@@ -312,63 +1021,83 @@ class Database:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
-        payment_date = datetime.now()
-        
-        # Проверяем, есть ли у пользователя активная подписка
-        current_subscription = self.get_user_subscription(user_id)
-        
-        if current_subscription and current_subscription.get('is_active', False):
-            # Если есть активная подписка, продлеваем с момента её окончания
-            current_expires = datetime.fromisoformat(current_subscription['expires_at'])
-            # Продлеваем с момента окончания текущей подписки или с текущего момента (если подписка уже истекла)
-            start_date = max(current_expires, payment_date)
-            expires_at = start_date + timedelta(days=30)
-            logger.info(f"Продление существующей подписки для пользователя {user_id}: с {start_date.strftime('%d.%m.%Y %H:%M')} до {expires_at.strftime('%d.%m.%Y %H:%M')}")
-        else:
-            # Если нет активной подписки, начинаем с текущего момента
-            expires_at = payment_date + timedelta(days=30)
-            logger.info(f"Новая подписка для пользователя {user_id}: с {payment_date.strftime('%d.%m.%Y %H:%M')} до {expires_at.strftime('%d.%m.%Y %H:%M')}")
-        
-        # Получаем текущие счетчики или инициализируем нулями для нового пользователя
-        cursor.execute("SELECT basic_count, vip_count, course_count FROM user_subscriptions WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            # Пользователь уже существует - увеличиваем соответствующий счетчик
-            basic_count, vip_count, course_count = result
-            if tariff_type == "basic":
-                basic_count += 1
-            elif tariff_type == "vip":
-                vip_count += 1
-            elif tariff_type == "course":
-                course_count += 1
-            logger.info(f"Продление подписки для пользователя {user_id}, увеличиваем счетчик {tariff_type}")
-        else:
-            # Новый пользователь - устанавливаем счетчик в 1 для купленного тарифа
-            basic_count = 1 if tariff_type == "basic" else 0
-            vip_count = 1 if tariff_type == "vip" else 0
-            course_count = 1 if tariff_type == "course" else 0
-            logger.info(f"Создаем новую подписку для пользователя {user_id}")
+        payment_date = datetime.now().isoformat()
+        new_expires_at = (datetime.now() + timedelta(days=SUBSCRIPTION_DAYS)).isoformat()
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_subscriptions 
-            (user_id, tariff_type, payment_date, expires_at, is_active, payment_id, basic_count, vip_count, course_count)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            tariff_type,
-            payment_date.isoformat(),
-            expires_at.isoformat(),
-            True,
-            payment_id,
-            basic_count,
-            vip_count,
-            course_count
-        ))
+        try:
+            # Блокировка записи с начала транзакции: состояние до оплаты и обновление согласованы
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(
+                "SELECT is_active, expires_at FROM user_subscriptions WHERE user_id = ?",
+                (user_id,)
+            )
+            previous = cursor.fetchone()
+            was_active = bool(previous and previous[0] and previous[1] > payment_date)
+            
+            # Активная подписка продлевается с момента окончания, истекшая - с текущего момента
+            cursor.execute(f'''
+                INSERT INTO user_subscriptions
+                (user_id, tariff_type, payment_date, expires_at, is_active, payment_id, basic_count, vip_count, course_count)
+                VALUES (:user_id, :tariff_type, :payment_date, :expires_at, TRUE, :payment_id, :basic, :vip, :course)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    tariff_type = excluded.tariff_type,
+                    payment_date = excluded.payment_date,
+                    expires_at = CASE
+                        WHEN is_active AND expires_at > excluded.payment_date
+                        THEN strftime('%Y-%m-%dT%H:%M:%f', expires_at, '+{SUBSCRIPTION_DAYS} days')
+                        ELSE excluded.expires_at
+                    END,
+                    is_active = TRUE,
+                    payment_id = excluded.payment_id,
+                    basic_count = COALESCE(basic_count, 0) + excluded.basic_count,
+                    vip_count = COALESCE(vip_count, 0) + excluded.vip_count,
+                    course_count = COALESCE(course_count, 0) + excluded.course_count
+            ''', {
+                'user_id': user_id,
+                'tariff_type': tariff_type,
+                'payment_date': payment_date,
+                'expires_at': new_expires_at,
+                'payment_id': payment_id,
+                'basic': int(tariff_type == "basic"),
+                'vip': int(tariff_type == "vip"),
+                'course': int(tariff_type == "course"),
+            })
+            
+            # Флаги аудиторий рассылок в таблице users и счетчики сегментов
+            deltas = {}
+            self._ensure_user(cursor, user_id, deltas)
+            if tariff_type in ("basic", "vip"):
+                self._set_user_flag(cursor, user_id, "is_paid", SEGMENT_PAID_SUBSCRIBERS, deltas)
+            if tariff_type == "vip":
+                self._set_user_flag(cursor, user_id, "is_vip", SEGMENT_VIP_USERS, deltas)
+            if tariff_type == "course":
+                self._set_user_flag(cursor, user_id, "is_course", SEGMENT_COURSE_USERS, deltas)
+            if not (previous and previous[0]):
+                # Счетчик активных учитывает подписки, с которых планировщик еще не снял is_active
+                deltas[SEGMENT_ACTIVE_SUBSCRIBERS] = 1
+            self._apply_segment_deltas(cursor, deltas)
+            
+            cursor.execute(
+                "SELECT expires_at, basic_count, vip_count, course_count FROM user_subscriptions WHERE user_id = ?",
+                (user_id,)
+            )
+            expires_at, basic_count, vip_count, course_count = cursor.fetchone()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         
-        conn.commit()
-        conn.close()
-        logger.info(f"Подписка сохранена для пользователя {user_id}, тариф {tariff_type}, до {expires_at.strftime('%d.%m.%Y %H:%M')}")
+        expires_at = datetime.fromisoformat(expires_at)
+        self._bump_user_version(user_id)
+        for listener in self.subscription_listeners:
+            try:
+                listener(user_id, expires_at)
+            except Exception as e:
+                logger.error(f"Ошибка уведомления о подписке пользователя {user_id}: {e}")
+        action = "Продление существующей" if was_active else "Новая"
+        logger.info(f"{action} подписка сохранена для пользователя {user_id}, тариф {tariff_type}, до {expires_at.strftime('%d.%m.%Y %H:%M')}")
         logger.info(f"Счетчики: basic={basic_count}, vip={vip_count}, course={course_count}")
     
     def get_user_subscription(self, user_id: int) -> dict:
@@ -401,7 +1130,7 @@ class Database:
                 'tariff_type': result[0],
                 'payment_date': result[1],
                 'expires_at': result[2],
-                'is_active': result[3] and not is_expired,
+                'is_active': bool(result[3]) and not is_expired,
                 'is_expired': is_expired,
                 'payment_id': result[4],
                 'basic_count': result[5] or 0,
@@ -548,7 +1277,14 @@ class Database:
         cursor = conn.cursor()
         
         current_time = datetime.now().isoformat()
-        current_date = datetime.now().strftime('%Y-%m-%d')
+        # Дата сброса по Москве - так же ее сравнивает ежедневный сброс
+        current_date = self.get_moscow_day()
+        
+        # Прежний thread пользователя (если заменяется) уходит в очередь удаления в OpenAI
+        cursor.execute('''
+            INSERT OR IGNORE INTO openai_thread_gc (thread_id, user_id, queued_at)
+            SELECT thread_id, user_id, ? FROM openai_threads WHERE user_id = ? AND thread_id != ?
+        ''', (current_time, user_id, thread_id))
         
         cursor.execute('''
             INSERT OR REPLACE INTO openai_threads 
@@ -558,6 +1294,7 @@ class Database:
         
         conn.commit()
         conn.close()
+        self.thread_cache.set(user_id, {'thread_id': thread_id, 'last_reset_date': current_date})
         logger.info(f"OpenAI thread сохранен для пользователя {user_id}: {thread_id}")
     
     def get_openai_thread(self, user_id: int) -> Optional[dict]:
@@ -570,6 +1307,9 @@ class Database:
         Returns:
             dict: {'thread_id': str, 'last_reset_date': str} или None
         """
+        if user_id in self.thread_cache:
+            return self.thread_cache.get(user_id)
+        
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
@@ -580,12 +1320,14 @@ class Database:
         result = cursor.fetchone()
         conn.close()
         
+        thread_info = None
         if result:
-            return {
+            thread_info = {
                 'thread_id': result[0],
-                'last_reset_date': result[1] or datetime.now().strftime('%Y-%m-%d')
+                'last_reset_date': result[1] or self.get_moscow_day()
             }
-        return None
+        self.thread_cache.set(user_id, thread_info)
+        return thread_info
     
     def is_kupi_video_sent(self, user_id: int) -> bool:
         """
@@ -632,6 +1374,41 @@ class Database:
         conn.close()
         logger.info(f"Купи-видео отмечено как отправленное для пользователя {user_id}")
     
+    def mark_start_video_sent(self, user_id: int):
+        """
+        Отмечает, что стартовое видео отправлено пользователю
+        
+        Args:
+            user_id: ID пользователя
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            "INSERT OR IGNORE INTO start_video_sent (user_id, sent_at) VALUES (?, ?)",
+            (user_id, datetime.now().isoformat())
+        )
+        
+        conn.commit()
+        conn.close()
+    
+    def get_start_video_sent_users(self) -> set:
+        """
+        Получает всех пользователей, которым уже отправлено стартовое видео
+        
+        Returns:
+            set: множество user_id
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT user_id FROM start_video_sent")
+        user_ids = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        
+        logger.info(f"Загружено {len(user_ids)} пользователей с отправленным стартовым видео")
+        return user_ids
+    
     def get_users_for_kupi_video(self) -> list:
         """
         Получает список пользователей, которым нужно отправить купи-видео:
@@ -711,28 +1488,98 @@ class Database:
     
     def get_active_subscribers(self) -> list:
         """
-        Получает список всех пользователей с активной подпиской
+        Получает список всех пользователей с активной подпиской
+        
+        Returns:
+            list: список user_id пользователей с активной подпиской
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        # is_active снимает планировщик окончаний, сравнивать даты не нужно
+        cursor.execute("SELECT user_id FROM user_subscriptions WHERE is_active = TRUE")
+        
+        results = cursor.fetchall()
+        conn.close()
+        
+        user_ids = [result[0] for result in results]
+        logger.info(f"Найдено {len(user_ids)} пользователей с активной подпиской")
+        
+        return user_ids
+    
+    def get_active_subscribers_count(self) -> int:
+        """Получает количество пользователей с активной подпиской"""
+        return self.get_segment_count(SEGMENT_ACTIVE_SUBSCRIBERS)
+    
+    def get_next_expirations(self, limit: int) -> list:
+        """
+        Ближайшие окончания активных подписок, включая уже наступившие
+        
+        Args:
+            limit: сколько записей вернуть
+            
+        Returns:
+            list: [(expires_at, user_id)] по возрастанию expires_at
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT expires_at, user_id FROM user_subscriptions
+            WHERE is_active = TRUE
+            ORDER BY expires_at
+            LIMIT ?
+        ''', (limit,))
+        results = cursor.fetchall()
+        conn.close()
+        
+        return results
+    
+    def expire_subscriptions(self, user_ids: list) -> list:
+        """
+        Снимает is_active с истекших подписок одной транзакцией.
+        Подписки, продленные после постановки в очередь, не трогает.
         
+        Args:
+            user_ids: пользователи, у которых подписка должна была закончиться
+            
         Returns:
-            list: список user_id пользователей с активной подпиской
+            list: [(user_id, expires_at)] действительно истекших подписок
         """
+        if not user_ids:
+            return []
+        
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        placeholders = ",".join("?" * len(user_ids))
+        now = datetime.now().isoformat()
         
-        current_time = datetime.now().isoformat()
-        
-        cursor.execute('''
-            SELECT user_id FROM user_subscriptions 
-            WHERE expires_at > ? AND is_active = TRUE
-        ''', (current_time,))
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        user_ids = [result[0] for result in results]
-        logger.info(f"Найдено {len(user_ids)} пользователей с активной подпиской")
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f'''
+                SELECT user_id, expires_at FROM user_subscriptions
+                WHERE user_id IN ({placeholders}) AND is_active = TRUE AND expires_at <= ?
+            ''', (*user_ids, now))
+            expired = cursor.fetchall()
+            
+            if expired:
+                cursor.executemany(
+                    "UPDATE user_subscriptions SET is_active = FALSE WHERE user_id = ?",
+                    [(user_id,) for user_id, _ in expired]
+                )
+                self._apply_segment_deltas(cursor, {SEGMENT_ACTIVE_SUBSCRIBERS: -len(expired)})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         
-        return user_ids
+        for user_id, _ in expired:
+            self._bump_user_version(user_id)
+        if expired:
+            logger.info(f"Истекли подписки: {len(expired)} пользователей")
+        return expired
     
     # Реферальная система
     def register_referral_user(self, user_id: int, email: str, referrer_user_id: int = None):
@@ -748,6 +1595,7 @@ class Database:
             ''', (user_id, email, referrer_user_id, datetime.now().isoformat()))
             
             conn.commit()
+            self._bump_user_version(user_id)
             logger.info(f"Пользователь {user_id} зарегистрирован в реферальной системе")
             
         except Exception as e:
@@ -782,35 +1630,150 @@ class Database:
         finally:
             conn.close()
     
-    def add_referral_bonus(self, referrer_user_id: int, referred_user_id: int, bonus_amount: int):
-        """Добавляет реферальный бонус"""
+    def credit_referral_bonus(self, referred_user_id: int, bonus_amount: int) -> Optional[dict]:
+        """
+        Начисляет рефереру бонус за оплату приглашенного пользователя одной транзакцией:
+        запись в referral_bonuses (не больше одной на пару), баланс и очередь отправки в GetCourse
+        
+        Args:
+            referred_user_id: ID оплатившего приглашенного пользователя
+            bonus_amount: сумма бонуса
+            
+        Returns:
+            dict: {'referrer_user_id', 'referral_balance'} или None, если пользователь
+                  не приглашен или бонус за него уже начислен
+        """
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
         try:
-            # Добавляем запись о бонусе
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(
+                "SELECT referrer_user_id FROM referral_users WHERE user_id = ?",
+                (referred_user_id,)
+            )
+            result = cursor.fetchone()
+            if not result or not result[0]:
+                conn.rollback()
+                return None
+            referrer_user_id = result[0]
+            
             cursor.execute('''
-                INSERT INTO referral_bonuses 
+                INSERT OR IGNORE INTO referral_bonuses 
                 (referrer_user_id, referred_user_id, bonus_amount, created_at)
                 VALUES (?, ?, ?, ?)
             ''', (referrer_user_id, referred_user_id, bonus_amount, datetime.now().isoformat()))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                logger.info(f"Бонус уже был начислен реферу {referrer_user_id} за пользователя {referred_user_id}")
+                return None
             
-            # Обновляем баланс реферера
             cursor.execute('''
                 UPDATE referral_users 
                 SET referral_balance = referral_balance + ?
                 WHERE user_id = ?
             ''', (bonus_amount, referrer_user_id))
+            cursor.execute('''
+                INSERT INTO referral_settlements (referrer_user_id, next_attempt_at) VALUES (?, CURRENT_TIMESTAMP)
+                ON CONFLICT(referrer_user_id) DO UPDATE SET version = version + 1, attempts = 0
+            ''', (referrer_user_id,))
             
+            cursor.execute("SELECT referral_balance FROM referral_users WHERE user_id = ?", (referrer_user_id,))
+            result = cursor.fetchone()
             conn.commit()
-            logger.info(f"Добавлен реферальный бонус {bonus_amount} для пользователя {referrer_user_id}")
-            return True
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        self._bump_user_version(referrer_user_id)
+        logger.info(f"Добавлен реферальный бонус {bonus_amount} для пользователя {referrer_user_id}")
+        return {
+            'referrer_user_id': referrer_user_id,
+            'referral_balance': result[0] if result else 0
+        }
+    
+    def get_pending_referral_settlements(self, limit: int = 100, max_attempts: int = 10) -> list:
+        """
+        Рефереры, чей баланс еще не отправлен в GetCourse и чья очередная попытка уже наступила
+        
+        Args:
+            limit: размер пачки
+            max_attempts: записи с большим числом неудач подряд пропускаются
             
-        except Exception as e:
-            logger.error(f"Ошибка добавления реферального бонуса: {e}")
-            return False
+        Returns:
+            list: [(referrer_user_id, version, email, referral_balance)]
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT s.referrer_user_id, s.version, r.email, r.referral_balance
+            FROM referral_settlements s
+            LEFT JOIN referral_users r ON r.user_id = s.referrer_user_id
+            WHERE s.next_attempt_at <= CURRENT_TIMESTAMP AND s.attempts < ?
+            ORDER BY s.next_attempt_at
+            LIMIT ?
+        ''', (max_attempts, limit))
+        results = cursor.fetchall()
+        conn.close()
+        
+        return results
+    
+    def complete_referral_settlements(self, results: list, retry_base: int = 60, retry_max: int = 6 * 3600,
+                                      max_attempts: int = 10) -> list:
+        """
+        Сохраняет итоги отправки балансов одной транзакцией.
+        Запись удаляется, только если после чтения не было новых начислений.
+        После неудачи следующая попытка откладывается на retry_base * 2^(attempts - 1) секунд,
+        но не больше retry_max.
+        
+        Args:
+            results: [(referrer_user_id, version, success, error)]
+            retry_base: задержка после первой неудачи, секунд
+            retry_max: наибольшая задержка, секунд
+            max_attempts: после стольких неудач подряд запись больше не отправляется
+            
+        Returns:
+            list: ID рефереров, чьи записи исчерпали попытки в этой пачке
+        """
+        if not results:
+            return []
+        
+        failed = [(referrer_user_id, error) for referrer_user_id, _, success, error in results if not success]
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany(
+                "DELETE FROM referral_settlements WHERE referrer_user_id = ? AND version = ?",
+                [(referrer_user_id, version) for referrer_user_id, version, success, _ in results if success]
+            )
+            cursor.executemany('''
+                UPDATE referral_settlements
+                SET attempts = attempts + 1, last_error = ?,
+                    next_attempt_at = datetime('now', '+' || MIN(?, ? * (1 << MIN(attempts, 20))) || ' seconds')
+                WHERE referrer_user_id = ?
+            ''', [(error, retry_max, retry_base, referrer_user_id) for referrer_user_id, error in failed])
+            
+            parked = []
+            for referrer_user_id, _ in failed:
+                cursor.execute(
+                    "SELECT 1 FROM referral_settlements WHERE referrer_user_id = ? AND attempts >= ?",
+                    (referrer_user_id, max_attempts)
+                )
+                if cursor.fetchone():
+                    parked.append(referrer_user_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             conn.close()
+        
+        return parked
     
     def use_referral_balance(self, user_id: int, amount: int):
         """Использует реферальный баланс"""
@@ -826,6 +1789,7 @@ class Database:
             
             if cursor.rowcount > 0:
                 conn.commit()
+                self._bump_user_version(user_id)
                 logger.info(f"Использован реферальный баланс {amount} пользователем {user_id}")
                 return True
             else:
@@ -909,20 +1873,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            # Собираем пользователей из всех таблиц
-            cursor.execute('''
-                SELECT DISTINCT user_id FROM (
-                    SELECT user_id FROM auto_spam_history
-                    UNION
-                    SELECT user_id FROM user_utm  
-                    UNION
-                    SELECT user_id FROM user_subscriptions
-                    UNION
-                    SELECT user_id FROM openai_threads
-                    UNION
-                    SELECT user_id FROM referral_users
-                )
-            ''')
+            cursor.execute("SELECT user_id FROM users")
             
             results = cursor.fetchall()
             user_ids = [result[0] for result in results]
@@ -938,7 +1889,7 @@ class Database:
     
     def get_all_users_count(self) -> int:
         """Получает количество всех пользователей бота"""
-        return len(self.get_all_users())
+        return self.get_segment_count(SEGMENT_ALL_USERS)
     
     def get_course_users(self) -> list:
         """Получает пользователей с подпиской course (активной или была)"""
@@ -946,10 +1897,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            cursor.execute('''
-                SELECT DISTINCT user_id FROM user_subscriptions 
-                WHERE tariff_type = 'course' OR course_count > 0
-            ''')
+            cursor.execute("SELECT user_id FROM users WHERE is_course = 1")
             
             results = cursor.fetchall()
             user_ids = [result[0] for result in results]
@@ -965,7 +1913,7 @@ class Database:
     
     def get_course_users_count(self) -> int:
         """Получает количество пользователей курса"""
-        return len(self.get_course_users())
+        return self.get_segment_count(SEGMENT_COURSE_USERS)
     
     def get_paid_subscribers(self) -> list:
         """Получает пользователей с платными подписками (basic или vip)"""
@@ -973,12 +1921,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            cursor.execute('''
-                SELECT DISTINCT user_id FROM user_subscriptions 
-                WHERE tariff_type IN ('basic', 'vip') 
-                   OR basic_count > 0 
-                   OR vip_count > 0
-            ''')
+            cursor.execute("SELECT user_id FROM users WHERE is_paid = 1")
             
             results = cursor.fetchall()
             user_ids = [result[0] for result in results]
@@ -994,7 +1937,7 @@ class Database:
     
     def get_paid_subscribers_count(self) -> int:
         """Получает количество платных подписчиков"""
-        return len(self.get_paid_subscribers())
+        return self.get_segment_count(SEGMENT_PAID_SUBSCRIBERS)
     
     def get_vip_users(self) -> list:
         """Получает VIP пользователей (активных или бывших)"""
@@ -1002,10 +1945,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            cursor.execute('''
-                SELECT DISTINCT user_id FROM user_subscriptions 
-                WHERE tariff_type = 'vip' OR vip_count > 0
-            ''')
+            cursor.execute("SELECT user_id FROM users WHERE is_vip = 1")
             
             results = cursor.fetchall()
             user_ids = [result[0] for result in results]
@@ -1021,7 +1961,7 @@ class Database:
     
     def get_vip_users_count(self) -> int:
         """Получает количество VIP пользователей"""
-        return len(self.get_vip_users())
+        return self.get_segment_count(SEGMENT_VIP_USERS)
     
     def create_news_broadcast(self, admin_id: int, audience_type: str, message_text: str, media_type: str, total_recipients: int) -> int:
         """Создает запись о рассылке новостей"""
@@ -1107,7 +2047,8 @@ class Database:
     
     def should_reset_thread_daily(self, user_id: int) -> bool:
         """
-        Проверяет, нужно ли сбросить thread пользователя (ежедневный сброс)
+        Проверяет, нужно ли сбросить thread пользователя (ежедневный сброс).
+        Работает по кэшу thread'ов и заранее вычисленному дню по Москве, без запросов к БД.
         
         Args:
             user_id: ID пользователя
@@ -1115,41 +2056,19 @@ class Database:
         Returns:
             bool: True если нужно сбросить thread
         """
-        import pytz
+        thread_info = self.get_openai_thread(user_id)
+        if not thread_info:
+            # Нет записи о thread
+            return False
         
-        # Московская временная зона
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        current_moscow_date = datetime.now(moscow_tz).strftime('%Y-%m-%d')
+        # Если дата последнего сброса не сегодня по МСК, нужно сбросить
+        current_moscow_date = self.get_moscow_day()
+        need_reset = thread_info['last_reset_date'] != current_moscow_date
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if need_reset:
+            logger.info(f"Thread для пользователя {user_id} нуждается в ежедневном сбросе. Последний сброс: {thread_info['last_reset_date']}, сегодня: {current_moscow_date}")
         
-        try:
-            cursor.execute(
-                "SELECT last_reset_date FROM openai_threads WHERE user_id = ?",
-                (user_id,)
-            )
-            result = cursor.fetchone()
-            
-            if not result:
-                # Нет записи о thread
-                return False
-            
-            last_reset_date = result[0]
-            
-            # Если дата последнего сброса не сегодня по МСК, нужно сбросить
-            need_reset = last_reset_date != current_moscow_date
-            
-            if need_reset:
-                logger.info(f"Thread для пользователя {user_id} нуждается в ежедневном сбросе. Последний сброс: {last_reset_date}, сегодня: {current_moscow_date}")
-            
-            return need_reset
-                
-        except Exception as e:
-            logger.error(f"Ошибка проверки ежедневного сброса для {user_id}: {e}")
-            return False
-        finally:
-            conn.close()
+        return need_reset
     
     def delete_openai_thread(self, user_id: int):
         """
@@ -1162,8 +2081,13 @@ class Database:
         cursor = conn.cursor()
         
         try:
+            cursor.execute('''
+                INSERT OR IGNORE INTO openai_thread_gc (thread_id, user_id, queued_at)
+                SELECT thread_id, user_id, ? FROM openai_threads WHERE user_id = ?
+            ''', (datetime.now().isoformat(), user_id))
             cursor.execute('DELETE FROM openai_threads WHERE user_id = ?', (user_id,))
             conn.commit()
+            self.thread_cache.set(user_id, None)
             logger.info(f"Thread удален для пользователя {user_id}")
         except Exception as e:
             logger.error(f"Ошибка удаления thread для пользователя {user_id}: {e}")
@@ -1181,10 +2105,15 @@ class Database:
             cursor.execute('SELECT COUNT(*) FROM openai_threads')
             count_before = cursor.fetchone()[0]
             
+            cursor.execute('''
+                INSERT OR IGNORE INTO openai_thread_gc (thread_id, user_id, queued_at)
+                SELECT thread_id, user_id, ? FROM openai_threads
+            ''', (datetime.now().isoformat(),))
             cursor.execute('DELETE FROM openai_threads')
             deleted_count = cursor.rowcount
             
             conn.commit()
+            self.thread_cache.clear()
             
             logger.info(f"Удалено {deleted_count} thread'ов из {count_before} (всего было в базе)")
             print(f"✅ Удалено {deleted_count} OpenAI thread'ов из базы данных")
@@ -1201,11 +2130,7 @@ class Database:
         """
         Ежедневный сброс всех OpenAI threads в 00:00 МСК
         """
-        import pytz
-        
-        # Московская временная зона
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        current_moscow_date = datetime.now(moscow_tz).strftime('%Y-%m-%d')
+        current_moscow_date = self.refresh_moscow_day()
         
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
@@ -1223,6 +2148,13 @@ class Database:
                 logger.info("Нет threads для ежедневного сброса")
                 return 0
             
+            # Сброшенные threads удаляются и в OpenAI фоновой задачей
+            cursor.execute('''
+                INSERT OR IGNORE INTO openai_thread_gc (thread_id, user_id, queued_at)
+                SELECT thread_id, user_id, ? FROM openai_threads
+                WHERE last_reset_date != ? OR last_reset_date IS NULL
+            ''', (datetime.now().isoformat(), current_moscow_date))
+            
             # Удаляем все threads, которые нужно сбросить
             cursor.execute('''
                 DELETE FROM openai_threads 
@@ -1232,6 +2164,9 @@ class Database:
             deleted_count = cursor.rowcount
             conn.commit()
             
+            # Кэш заполнится заново при следующих сообщениях
+            self.thread_cache.clear()
+            
             logger.info(f"Ежедневный сброс: удалено {deleted_count} thread'ов")
             print(f"🔄 Ежедневный сброс: удалено {deleted_count} thread'ов ({current_moscow_date})")
             
@@ -1244,6 +2179,214 @@ class Database:
         finally:
             conn.close()
     
+    def get_threads_to_reclaim(self, limit: int = 50, max_attempts: int = 5) -> list:
+        """
+        Получает thread'ы, ожидающие удаления в OpenAI
+        
+        Args:
+            limit: размер пачки
+            max_attempts: thread'ы с большим числом неудачных попыток пропускаются
+            
+        Returns:
+            list: список thread_id, от самых старых
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT thread_id FROM openai_thread_gc
+            WHERE status = 'pending' AND attempts < ?
+            ORDER BY queued_at
+            LIMIT ?
+        ''', (max_attempts, limit))
+        thread_ids = [row[0] for row in cursor.fetchall()]
+        
+        conn.close()
+        return thread_ids
+    
+    def save_thread_reclaim_results(self, results: list, max_attempts: int = 5):
+        """
+        Сохраняет результаты удаления пачки thread'ов одной транзакцией
+        
+        Args:
+            results: список (thread_id, success, bytes_reclaimed, error)
+            max_attempts: после стольких неудач thread помечается как failed
+        """
+        if not results:
+            return
+        
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        now = datetime.now().isoformat()
+        
+        try:
+            for thread_id, success, bytes_reclaimed, error in results:
+                if success:
+                    cursor.execute('''
+                        UPDATE openai_thread_gc
+                        SET status = 'deleted', attempts = attempts + 1, bytes_reclaimed = ?,
+                            last_error = NULL, processed_at = ?
+                        WHERE thread_id = ?
+                    ''', (bytes_reclaimed, now, thread_id))
+                else:
+                    cursor.execute('''
+                        UPDATE openai_thread_gc
+                        SET attempts = attempts + 1, last_error = ?, processed_at = ?,
+                            status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                        WHERE thread_id = ?
+                    ''', (error, now, max_attempts, thread_id))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения результатов удаления thread'ов: {e}")
+        finally:
+            conn.close()
+    
+    def get_thread_gc_stats(self) -> dict:
+        """
+        Статистика удаления thread'ов в OpenAI
+        
+        Returns:
+            dict: {'pending': int, 'deleted': int, 'failed': int, 'bytes_reclaimed': int}
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        stats = {'pending': 0, 'deleted': 0, 'failed': 0, 'bytes_reclaimed': 0}
+        try:
+            cursor.execute('''
+                SELECT status, COUNT(*), COALESCE(SUM(bytes_reclaimed), 0)
+                FROM openai_thread_gc GROUP BY status
+            ''')
+            for status, count, bytes_reclaimed in cursor.fetchall():
+                stats[status] = count
+                stats['bytes_reclaimed'] += bytes_reclaimed
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики удаления thread'ов: {e}")
+        finally:
+            conn.close()
+        
+        return stats
+    
+    def get_pooled_threads(self) -> list:
+        """
+        Получает заранее созданные threads из пула
+        
+        Returns:
+            list: thread_id от самых старых
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT thread_id FROM openai_thread_pool ORDER BY created_at")
+        thread_ids = [row[0] for row in cursor.fetchall()]
+        
+        conn.close()
+        return thread_ids
+    
+    def add_pooled_thread(self, thread_id: str):
+        """
+        Добавляет созданный thread в пул
+        
+        Args:
+            thread_id: ID thread в OpenAI
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            "INSERT OR IGNORE INTO openai_thread_pool (thread_id, created_at) VALUES (?, ?)",
+            (thread_id, datetime.now().isoformat())
+        )
+        
+        conn.commit()
+        conn.close()
+    
+    def remove_pooled_thread(self, thread_id: str) -> bool:
+        """
+        Удаляет thread из пула (выдан пользователю)
+        
+        Args:
+            thread_id: ID thread в OpenAI
+            
+        Returns:
+            bool: True если thread был в пуле (его не забрал другой процесс)
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("DELETE FROM openai_thread_pool WHERE thread_id = ?", (thread_id,))
+        removed = cursor.rowcount == 1
+        
+        conn.commit()
+        conn.close()
+        return removed
+    
+    def acquire_job_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        Получает или продлевает аренду фоновой задачи
+        
+        Args:
+            name: имя задачи
+            owner: идентификатор процесса
+            ttl: время жизни аренды в секундах
+            
+        Returns:
+            bool: True если аренда принадлежит owner
+        """
+        now = time.time()
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        cursor = conn.cursor()
+        
+        try:
+            # Одним запросом: захватываем свободную/просроченную аренду или продлеваем свою
+            cursor.execute('''
+                INSERT INTO job_leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE job_leases.owner = excluded.owner OR job_leases.expires_at < ?
+            ''', (name, owner, now + ttl, now))
+            conn.commit()
+            return cursor.rowcount == 1
+        except Exception as e:
+            logger.error(f"Ошибка аренды задачи {name}: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    def release_job_lease(self, name: str, owner: str):
+        """
+        Освобождает аренду задачи, если она принадлежит owner
+        
+        Args:
+            name: имя задачи
+            owner: идентификатор процесса
+        """
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("DELETE FROM job_leases WHERE name = ? AND owner = ?", (name, owner))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка освобождения аренды задачи {name}: {e}")
+        finally:
+            conn.close()
+    
+    def get_active_threads_count(self) -> int:
+        """
+        Количество пользователей с thread'ом - оценка дневной активности чата до первого сброса
+        
+        Returns:
+            int: количество thread'ов
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT COUNT(*) FROM openai_threads")
+        count = cursor.fetchone()[0]
+        
+        conn.close()
+        return count
+    
     # ========== НОВЫЕ МЕТОДЫ ДЛЯ ОПТИМИЗАЦИИ ТРАФИКА ==========
     
     def get_media_file_id(self, file_path: str) -> Optional[str]:
@@ -1285,24 +2428,57 @@ class Database:
             (user_id, blocked_at, reason)
             VALUES (?, CURRENT_TIMESTAMP, ?)
         ''', (user_id, reason))
+        deltas = {}
+        self._ensure_user(cursor, user_id, deltas)
+        self._set_user_flag(cursor, user_id, "is_blocked", SEGMENT_BLOCKED_USERS, deltas)
+        self._apply_segment_deltas(cursor, deltas)
         
         conn.commit()
         conn.close()
+        self._blocked_users.add(user_id)
         logger.info(f"Пользователь {user_id} отмечен как заблокированный: {reason}")
     
-    def is_user_blocked(self, user_id: int) -> bool:
-        """Проверяет, заблокировал ли пользователь бота"""
+    def unblock_user(self, user_id: int) -> bool:
+        """
+        Снимает отметку о блокировке (пользователь снова пишет боту)
+        
+        Args:
+            user_id: ID пользователя
+            
+        Returns:
+            bool: True, если пользователь был отмечен как заблокированный
+        """
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
-        cursor.execute(
-            "SELECT 1 FROM blocked_users WHERE user_id = ?",
-            (user_id,)
-        )
-        result = cursor.fetchone()
+        cursor.execute("DELETE FROM blocked_users WHERE user_id = ?", (user_id,))
+        removed = cursor.rowcount > 0
+        cursor.execute("UPDATE users SET is_blocked = 0 WHERE user_id = ? AND is_blocked", (user_id,))
+        if cursor.rowcount:
+            self._apply_segment_deltas(cursor, {SEGMENT_BLOCKED_USERS: -1})
+        
+        conn.commit()
         conn.close()
+        self._blocked_users.discard(user_id)
+        if removed:
+            logger.info(f"Пользователь {user_id} снова пишет боту, блокировка снята")
+        return removed
+    
+    def load_blocked_users(self):
+        """Перечитывает заблокированных пользователей из БД в память"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
         
-        return result is not None
+        cursor.execute("SELECT user_id FROM blocked_users")
+        self._blocked_users = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        self._blocked_loaded_at = time.monotonic()
+    
+    def is_user_blocked(self, user_id: int) -> bool:
+        """Проверяет, заблокировал ли пользователь бота (по копии в памяти)"""
+        if time.monotonic() - self._blocked_loaded_at > BLOCKED_USERS_RELOAD_INTERVAL:
+            self.load_blocked_users()
+        return user_id in self._blocked_users
     
     def log_traffic(self, operation: str, user_id: int = None, data_type: str = None, 
                     data_size: int = 0, file_path: str = None, status: str = "success", 
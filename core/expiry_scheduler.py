@@ -0,0 +1,134 @@
+"""
+Планировщик окончаний подписок
+
+Вместо сравнения expires_at при каждой проверке доступа ближайшие окончания загружаются
+из БД в кучу (min-heap). Планировщик спит до ближайшего окончания, пачкой снимает
+is_active с истекших подписок, уменьшает счетчик активных подписчиков и сбрасывает
+кэши пользователей. Новые подписки попадают в кучу через уведомление из save_subscription,
+подписки из других процессов - при периодическом перечитывании БД.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+
+from core.config import EXPIRY_LOOKAHEAD, EXPIRY_BATCH_SIZE, EXPIRY_RELOAD_INTERVAL
+from core.database import db
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """
+    Куча ближайших окончаний подписок и фоновое снятие истекших
+    """
+
+    def __init__(self, lookahead: int = EXPIRY_LOOKAHEAD, batch_size: int = EXPIRY_BATCH_SIZE,
+                 reload_interval: float = EXPIRY_RELOAD_INTERVAL):
+        self.lookahead = lookahead
+        self.batch_size = batch_size
+        self.reload_interval = reload_interval
+        self.heap = []  # (expires_at, user_id)
+        # Окончание последней загруженной подписки; None - в кучу загружены все активные
+        self.horizon = None
+        self.loaded_at = None  # time.monotonic() последней загрузки
+        self.loop = None
+        self.wakeup = None
+        self.reminder_tasks = set()
+        self.stats = {"expired": 0, "stale": 0, "batches": 0, "reloads": 0}
+
+    def load(self):
+        """Загружает ближайшие окончания из БД"""
+        rows = db.get_next_expirations(self.lookahead)
+        self.heap = [(datetime.fromisoformat(expires_at), user_id) for expires_at, user_id in rows]
+        heapq.heapify(self.heap)
+        self.horizon = max(expires_at for expires_at, _ in self.heap) if len(rows) >= self.lookahead else None
+        self.loaded_at = time.monotonic()
+        self.stats["reloads"] += 1
+
+    def notify(self, user_id: int, expires_at: datetime):
+        """
+        Учитывает новую или продленную подписку (может вызываться из другого потока)
+
+        Args:
+            user_id: ID пользователя
+            expires_at: новое время окончания
+        """
+        if self.loop is None:
+            return  # Планировщик не запущен - подписка попадет в кучу при загрузке
+        self.loop.call_soon_threadsafe(self._push, user_id, expires_at)
+
+    def _push(self, user_id: int, expires_at: datetime):
+        # Окончания за горизонтом загрузятся позже, когда куча опустеет
+        if self.horizon is not None and expires_at > self.horizon:
+            return
+        heapq.heappush(self.heap, (expires_at, user_id))
+        if self.heap[0][1] == user_id:
+            self.wakeup.set()
+
+    def _pop_due(self, now: datetime) -> list:
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    async def run(self, on_expired=None):
+        """
+        Фоновое снятие истекших подписок
+
+        Args:
+            on_expired: корутина (список (user_id, expires_at)), вызывается для истекших подписок
+        """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    if self.loaded_at is None or (not self.heap and self.horizon is not None) or \
+                            time.monotonic() - self.loaded_at >= self.reload_interval:
+                        self.load()
+
+                    due = self._pop_due(datetime.now())
+                    if due:
+                        expired = db.expire_subscriptions(list(set(due)))
+                        self.stats["batches"] += 1
+                        self.stats["expired"] += len(expired)
+                        # Подписки, продленные после загрузки в кучу, остаются активными
+                        self.stats["stale"] += len(due) - len(expired)
+                        if expired and on_expired is not None:
+                            task = asyncio.create_task(on_expired(expired))
+                            self.reminder_tasks.add(task)
+                            task.add_done_callback(self.reminder_tasks.discard)
+                        continue
+
+                    timeout = self.reload_interval
+                    if self.heap:
+                        timeout = min(timeout, (self.heap[0][0] - datetime.now()).total_seconds())
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0))
+                    except asyncio.TimeoutError:
+                        pass
+
+                except Exception as e:
+                    logger.error(f"Ошибка планировщика окончаний подписок: {e}")
+                    # Перечитаем БД после паузы - потерянные из кучи окончания вернутся
+                    self.loaded_at = None
+                    await asyncio.sleep(60)
+        finally:
+            self.loop = None
+
+    def format_stats(self) -> str:
+        """Текстовый отчет планировщика"""
+        next_expiry = self.heap[0][0].strftime('%d.%m.%Y %H:%M') if self.heap else "нет"
+        return (
+            f"⏱️ Окончания подписок: в очереди {len(self.heap)}, ближайшее {next_expiry}, "
+            f"истекло {self.stats['expired']} ({self.stats['batches']} пачек), "
+            f"продлены до окончания {self.stats['stale']}, загрузок из БД {self.stats['reloads']}"
+        )
+
+
+# Глобальный планировщик окончаний подписок
+expiry_scheduler = ExpiryScheduler()
+db.subscription_listeners.append(expiry_scheduler.notify)
@@ -0,0 +1,130 @@
+"""
+Постоянное хранилище состояний FSM aiogram в SQLite
+
+Стандартное MemoryStorage теряет состояния при перезапуске: админ посреди рассылки
+(NewsStates) и пользователь посреди регистрации (ReferralStates) начинали заново.
+Здесь чтение идет из кэша в памяти (в БД - только при первом обращении к ключу),
+а изменения сразу видны в кэше и записываются в БД пачкой раз в FSM_FLUSH_INTERVAL.
+Незавершенные состояния старше FSM_STATE_TTL удаляются.
+
+В многопроцессном режиме апдейты пользователя всегда обрабатывает один воркер (шард по
+user_id), поэтому кэши воркеров не пересекаются, а общая БД сохраняет состояния между запусками.
+"""
+import asyncio
+import copy
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from core.config import FSM_FLUSH_INTERVAL, FSM_CACHE_SIZE, FSM_STATE_TTL, FSM_CLEANUP_INTERVAL
+from core.database import db
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage: кэш в памяти + отложенная пакетная запись в таблицу fsm_storage
+    """
+
+    def __init__(self, flush_interval: float = FSM_FLUSH_INTERVAL, cache_size: int = FSM_CACHE_SIZE,
+                 state_ttl: int = FSM_STATE_TTL, cleanup_interval: float = FSM_CLEANUP_INTERVAL,
+                 key_builder: Optional[KeyBuilder] = None):
+        self.flush_interval = flush_interval
+        self.state_ttl = state_ttl
+        self.cleanup_interval = cleanup_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> (state, data)
+        self.cache = LRUCache(maxsize=cache_size, ttl=state_ttl)
+        # Изменения, еще не записанные в БД (не вытесняются из памяти до записи)
+        self.pending = {}
+        self.flush_handle = None
+        self.last_cleanup = None
+        self.stats = {"reads": 0, "db_reads": 0, "writes": 0, "flushes": 0, "errors": 0, "cleaned": 0}
+
+    def _load(self, key: str) -> tuple:
+        self.stats["reads"] += 1
+        record = self.pending.get(key)
+        if record is None:
+            record = self.cache.get(key)
+        if record is None:
+            self.stats["db_reads"] += 1
+            row = db.get_fsm_record(key)
+            record = (row[0], json.loads(row[1]) if row[1] else {}) if row else (None, {})
+            self.cache.set(key, record)
+        return record
+
+    def _store(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        record = (state, data)
+        self.cache.set(key, record)
+        self.pending[key] = record
+        self.stats["writes"] += 1
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Записывает накопленные изменения в БД и удаляет устаревшие состояния"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.pending:
+            records, self.pending = self.pending, {}
+            try:
+                db.save_fsm_records([
+                    (key, state, json.dumps(data, ensure_ascii=False) if state is not None or data else None)
+                    for key, (state, data) in records.items()
+                ])
+                self.stats["flushes"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка записи состояний FSM ({len(records)}): {e}")
+                # Более свежие изменения тех же ключей важнее несохраненных
+                for key, record in records.items():
+                    self.pending.setdefault(key, record)
+                try:
+                    self.flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+                except RuntimeError:
+                    pass  # Event loop уже остановлен
+
+        now = time.monotonic()
+        if self.last_cleanup is None or now - self.last_cleanup > self.cleanup_interval:
+            self.last_cleanup = now
+            try:
+                self.stats["cleaned"] += db.delete_stale_fsm_records(self.state_ttl)
+            except Exception as e:
+                logger.error(f"Ошибка удаления устаревших состояний FSM: {e}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        _, data = self._load(storage_key)
+        self._store(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        state, _ = self._load(storage_key)
+        self._store(storage_key, state, copy.deepcopy(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = self._load(self.key_builder.build(key))
+        return copy.deepcopy(data)
+
+    async def close(self) -> None:
+        """Сохраняет несохраненные изменения (вызывается и повторно - безопасно)"""
+        self.flush()
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по хранилищу"""
+        return (
+            f"💾 Состояния FSM: чтений {self.stats['reads']} (из БД {self.stats['db_reads']}), "
+            f"изменений {self.stats['writes']}, записей в БД {self.stats['flushes']}, "
+            f"ошибок записи {self.stats['errors']}, удалено устаревших {self.stats['cleaned']}"
+        )
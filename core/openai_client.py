@@ -1,10 +1,16 @@
 import asyncio
 from typing import Optional
 import logging
+import time
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+from core.thread_pool import thread_pool
+from services.answer_cache import answer_cache
+from services.context_budget import context_budget, ACTION_REJECT, ACTION_ROTATE, ACTION_TRUNCATE
+from services.usage_ledger import usage_ledger
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -20,6 +26,11 @@ if not OPENAI_API_KEY:
 if not ASSISTANT_ID:
     logger.error("OPENAI_ASSISTANT_ID не найден в переменных окружения!")
 
+# Опрос статуса run: первый запрос через 200 мс, далее интервал растет до 2 секунд
+RUN_POLL_INITIAL_DELAY = 0.2
+RUN_POLL_BACKOFF = 1.5
+RUN_POLL_MAX_DELAY = 2.0
+
 # Дата начала доступа к OpenAI для подписчиков
 OPENAI_ACCESS_START_DATE = datetime(2025, 7, 30, 15, 0, 0)  # 30 июля 2025 15:00 МСК
 
@@ -31,6 +42,8 @@ class OpenAIClient:
         self.client = None
         self.request_queue = asyncio.Queue(maxsize=10)  # Очередь запросов
         self.processing = False
+        # Статистика опроса статуса run: сколько run дождались и сколько запросов retrieve на это ушло
+        self.poll_stats = {'runs': 0, 'polls': 0}
     
     def _get_client(self):
         """Lazy initialization OpenAI клиента"""
@@ -68,22 +81,38 @@ class OpenAIClient:
         return db.is_user_subscribed(user_id)
     
     async def create_thread(self, user_id: int) -> Optional[str]:
-        """Создает новый thread для пользователя"""
+        """Выдает пользователю thread: готовый из пула или создает новый"""
         if not self.has_openai_access(user_id):
             logger.warning(f"Пользователь {user_id} не имеет доступа к OpenAI")
             return None
         
+        # Готовый thread из пула - без ожидания ответа OpenAI
+        thread_id = thread_pool.take()
+        if thread_id:
+            context_budget.mark_new(thread_id)
+            return thread_id
+        
         client = self._get_client()
         if not client:
             logger.error(f"Не удалось инициализировать OpenAI клиент для пользователя {user_id}")
             return None
             
         try:
-            thread = await asyncio.to_thread(client.beta.threads.create)
-            return thread.id
+            thread_id = await self.create_remote_thread()
         except Exception as e:
             print(f"DEBUG: Ошибка создания thread: {e}")
             return None
+        if thread_id:
+            context_budget.mark_new(thread_id)
+        return thread_id
+    
+    async def create_remote_thread(self) -> Optional[str]:
+        """Создает пустой thread в OpenAI (для пользователя или для пула)"""
+        client = self._get_client()
+        if not client:
+            return None
+        thread = await asyncio.to_thread(client.beta.threads.create)
+        return thread.id
     
     async def send_message(self, user_id: int, thread_id: str, message: str) -> Optional[str]:
         """Отправляет сообщение в thread и получает ответ от ассистента"""
@@ -98,24 +127,39 @@ class OpenAIClient:
         start_time = datetime.now()
         from core.database import db
         
+        question = message
         request_size = len(message.encode('utf-8'))
         db.log_traffic("openai_request_start", user_id, "text", request_size, "openai_message")
         
-        # Проверяем, нужно ли сбросить thread (ежедневный сброс в 00:00 МСК)
-        from core.database import db
-        thread_info = db.get_openai_thread(user_id)
-        if thread_info and db.should_reset_thread_daily(user_id):
+        # Проверяем, нужно ли сбросить thread (ежедневный сброс в 00:00 МСК).
+        # Thread и текущий день по Москве берутся из памяти, без запросов к БД.
+        if db.should_reset_thread_daily(user_id):
             logger.info(f"Ежедневный сброс thread для пользователя {user_id}")
-            await self._reset_user_thread(user_id)
-            # Создаем новый thread
-            new_thread_id = await self.create_thread(user_id)
-            if new_thread_id:
-                db.save_openai_thread(user_id, new_thread_id)
-                thread_id = new_thread_id
-            else:
+            thread_id = await self._rotate_user_thread(user_id)
+            if not thread_id:
                 # Возвращаем обычную ошибку без упоминания сброса
                 return "😔 Что-то пошло не так... Попробуй написать еще раз через минутку 💕"
         
+        # Оцениваем размер контекста до запуска, чтобы не получить "Request too large"
+        budget_plan = context_budget.plan(thread_id, question)
+        if budget_plan['action'] == ACTION_REJECT:
+            return "🔄 Извини, милая, твое сообщение слишком длинное для обработки. Попробуй разделить его на несколько коротких вопросов - так я смогу лучше тебе помочь! ✨"
+        if budget_plan['action'] == ACTION_ROTATE:
+            thread_id = await self._rotate_user_thread(user_id)
+            if not thread_id:
+                return "😔 Что-то пошло не так... Попробуй написать еще раз через минутку 💕"
+        
+        # Кэш ответов используется только для первого вопроса в пустом thread'е: ответ,
+        # полученный в диалоге другого пользователя, может зависеть от его контекста
+        fresh_thread = context_budget.is_new(thread_id)
+        if fresh_thread:
+            cached_answer = answer_cache.lookup(ASSISTANT_ID, question)
+            if cached_answer:
+                db.log_traffic("openai_cache_hit", user_id, "text", len(cached_answer.encode('utf-8')), "openai_response")
+                await self._append_cached_exchange(client, user_id, thread_id, question, cached_answer,
+                                                   budget_plan['message_tokens'])
+                return cached_answer
+        
         # Добавляем задержку для rate limit
         await asyncio.sleep(2)
             
@@ -133,15 +177,7 @@ class OpenAIClient:
                 logger.info(f"Ждем завершения активного run для пользователя {user_id}")
                 
                 # Ждем до 30 секунд
-                wait_time = 0
-                while active_run.status in ['queued', 'in_progress', 'cancelling'] and wait_time < 30:
-                    await asyncio.sleep(2)
-                    wait_time += 2
-                    active_run = await asyncio.to_thread(
-                        client.beta.threads.runs.retrieve,
-                        thread_id=thread_id,
-                        run_id=active_run.id
-                    )
+                active_run, _ = await self._wait_for_run(client, thread_id, active_run, max_wait=30)
                 
                 # Если так и не завершился - отменяем
                 if active_run.status in ['queued', 'in_progress', 'cancelling']:
@@ -162,38 +198,48 @@ class OpenAIClient:
                 role="user",
                 content=message
             )
+            context_budget.mark_used(thread_id)
             
-            # Запускаем ассистента
+            # Запускаем ассистента (при переполнении бюджета - только с последними сообщениями)
+            run_params = {}
+            if budget_plan['action'] == ACTION_TRUNCATE:
+                run_params['truncation_strategy'] = {
+                    'type': 'last_messages',
+                    'last_messages': budget_plan['last_messages']
+                }
             run = await asyncio.to_thread(
                 client.beta.threads.runs.create,
                 thread_id=thread_id,
-                assistant_id=ASSISTANT_ID
+                assistant_id=ASSISTANT_ID,
+                **run_params
             )
             
-            # Ждем завершения с timeout
-            wait_time = 0
-            max_wait = 60  # максимум 60 секунд
+            # Ждем завершения с timeout (максимум 60 секунд)
+            run, timed_out = await self._wait_for_run(client, thread_id, run, max_wait=60)
             
-            while run.status in ['queued', 'in_progress', 'cancelling'] and wait_time < max_wait:
-                await asyncio.sleep(2)
-                wait_time += 2
-                run = await asyncio.to_thread(
-                    client.beta.threads.runs.retrieve,
-                    thread_id=thread_id,
-                    run_id=run.id
+            # Токены списываются и за неудачные run'ы - учитываем любой run с usage
+            usage = getattr(run, 'usage', None)
+            if usage is not None:
+                usage_ledger.record_chat(
+                    user_id,
+                    prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                    completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+                    latency_ms=int((datetime.now() - start_time).total_seconds() * 1000)
                 )
             
             if run.status == 'completed':
-                # Получаем сообщения
+                # Получаем только последнее сообщение ассистента, созданное этим run
                 messages = await asyncio.to_thread(
-                    client.beta.threads.messages.list,  
-                    thread_id=thread_id
+                    client.beta.threads.messages.list,
+                    thread_id=thread_id,
+                    run_id=run.id,
+                    limit=1,
+                    order="desc"
                 )
                 
-                # Возвращаем последнее сообщение ассистента
-                for message in messages.data:
-                    if message.role == 'assistant':
-                        response_text = message.content[0].text.value
+                for assistant_message in messages.data:
+                    if assistant_message.role == 'assistant':
+                        response_text = assistant_message.content[0].text.value
                         
                         # Логируем успешный ответ
                         end_time = datetime.now()
@@ -205,13 +251,25 @@ class OpenAIClient:
                         
                         logger.info(f"OpenAI запрос успешен для {user_id}, время: {duration_ms}ms, размер ответа: {response_size} байт")
                         
+                        context_budget.record_run(
+                            thread_id, budget_plan['message_tokens'], response_text,
+                            prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                            last_messages=budget_plan['last_messages']
+                        )
+                        if fresh_thread:
+                            answer_cache.store(
+                                ASSISTANT_ID, question, response_text,
+                                prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                                completion_tokens=getattr(usage, 'completion_tokens', 0) or 0
+                            )
+                        
                         return response_text
                 
                 logger.error(f"❌ No assistant message found for user {user_id}")
                 db.log_traffic("openai_error", user_id, "error", 0, None, "error", "No assistant message found")
             
             # Если timeout - отменяем run
-            if wait_time >= max_wait:
+            if timed_out:
                 try:
                     await asyncio.to_thread(
                         client.beta.threads.runs.cancel,
@@ -286,23 +344,139 @@ class OpenAIClient:
             logger.error(f"Ошибка отправки сообщения для пользователя {user_id}: {e}")
             return None
     
+    async def _append_cached_exchange(self, client, user_id: int, thread_id: str, question: str,
+                                      answer: str, message_tokens: int):
+        """
+        Добавляет вопрос и ответ из кэша в thread пользователя, чтобы ассистент
+        видел их в контексте следующих сообщений
+        """
+        try:
+            for role, content in (("user", question), ("assistant", answer)):
+                await asyncio.to_thread(
+                    client.beta.threads.messages.create,
+                    thread_id=thread_id,
+                    role=role,
+                    content=content
+                )
+        except Exception as e:
+            logger.warning(f"Не удалось добавить ответ из кэша в thread пользователя {user_id}: {e}")
+        context_budget.mark_used(thread_id)
+        context_budget.record_run(thread_id, message_tokens, answer)
+    
+    async def _wait_for_run(self, client, thread_id: str, run, max_wait: float):
+        """
+        Ждет завершения run, опрашивая его с экспоненциально растущим интервалом
+        (короткие ответы забираются быстрее; run на 60 с стоит около 34 запросов статуса
+        вместо 30 при опросе раз в 2 с)
+        
+        Args:
+            client: OpenAI клиент
+            thread_id: ID thread
+            run: объект run
+            max_wait: максимальное время ожидания в секундах
+            
+        Returns:
+            tuple: (run с последним статусом, истек ли timeout)
+        """
+        deadline = time.monotonic() + max_wait
+        delay = RUN_POLL_INITIAL_DELAY
+        
+        while run.status in ['queued', 'in_progress', 'cancelling']:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return run, True
+            
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * RUN_POLL_BACKOFF, RUN_POLL_MAX_DELAY)
+            
+            run = await asyncio.to_thread(
+                client.beta.threads.runs.retrieve,
+                thread_id=thread_id,
+                run_id=run.id
+            )
+            self.poll_stats['polls'] += 1
+        
+        self.poll_stats['runs'] += 1
+        return run, False
+    
+    def format_poll_stats(self) -> str:
+        """Текстовый отчет по опросу статуса run"""
+        runs = self.poll_stats['runs']
+        average = self.poll_stats['polls'] / runs if runs else 0.0
+        return f"⏱ Опрос OpenAI run: завершено {runs}, запросов статуса {self.poll_stats['polls']} (в среднем {average:.1f} на run)"
+    
+    async def _rotate_user_thread(self, user_id: int) -> Optional[str]:
+        """
+        Заменяет thread пользователя новым (из пула или созданным)
+        
+        Returns:
+            str: ID нового thread или None при ошибке
+        """
+        from core.database import db
+        await self._reset_user_thread(user_id)
+        new_thread_id = await self.create_thread(user_id)
+        if new_thread_id:
+            db.save_openai_thread(user_id, new_thread_id)
+        return new_thread_id
+    
     async def _reset_user_thread(self, user_id: int):
         """Сбрасывает OpenAI thread пользователя"""
         try:
             from core.database import db
+            thread_info = db.get_openai_thread(user_id)
+            if thread_info:
+                context_budget.forget(thread_info['thread_id'])
             db.delete_openai_thread(user_id)
             logger.info(f"Thread сброшен для пользователя {user_id}")
         except Exception as e:
             logger.error(f"Ошибка сброса thread для пользователя {user_id}: {e}")
     
     
-    async def transcribe_audio(self, user_id: int, audio_file_path: str) -> Optional[str]:
+    async def delete_remote_thread(self, thread_id: str, measure: bool = True) -> int:
         """
-        Расшифровывает аудио файл в текст через OpenAI Whisper
+        Удаляет thread на стороне OpenAI
+        
+        Args:
+            thread_id: ID thread в OpenAI
+            measure: перед удалением посчитать объем сообщений thread'а
+            
+        Returns:
+            int: объем текста сообщений в байтах (0, если thread уже удален)
+            
+        Raises:
+            Exception: ошибка API, кроме "не найден"
+        """
+        import openai
+        
+        client = self._get_client()
+        if not client:
+            raise RuntimeError("OpenAI клиент не инициализирован")
+        
+        size = 0
+        try:
+            if measure:
+                messages = await asyncio.to_thread(client.beta.threads.messages.list, thread_id=thread_id, limit=100)
+                for item in messages.data:
+                    for content in item.content:
+                        text = getattr(content, 'text', None)
+                        if text is not None:
+                            size += len(text.value.encode('utf-8'))
+            
+            await asyncio.to_thread(client.beta.threads.delete, thread_id)
+        except openai.NotFoundError:
+            # Уже удален - считаем освобожденным
+            return 0
+        
+        return size
+    
+    async def transcribe_audio(self, user_id: int, audio, filename: str = "audio.ogg") -> Optional[str]:
+        """
+        Расшифровывает аудио в текст через OpenAI Whisper
         
         Args:
             user_id: ID пользователя
-            audio_file_path: путь к аудио файлу
+            audio: путь к аудио файлу или открытый бинарный буфер (BytesIO, SpooledTemporaryFile)
+            filename: имя файла для буфера - по расширению Whisper определяет формат
             
         Returns:
             str: расшифрованный текст или None при ошибке
@@ -315,12 +489,21 @@ class OpenAIClient:
             return None
             
         try:
-            with open(audio_file_path, "rb") as audio_file:
+            if isinstance(audio, (str, os.PathLike)):
+                with open(audio, "rb") as audio_file:
+                    transcript = await asyncio.to_thread(
+                        client.audio.transcriptions.create,
+                        model="whisper-1",
+                        file=audio_file,
+                        language="ru"  # Указываем русский язык для лучшего качества
+                    )
+            else:
+                # Буфер передаем без копирования, имя файла - отдельно
                 transcript = await asyncio.to_thread(
                     client.audio.transcriptions.create,
                     model="whisper-1",
-                    file=audio_file,
-                    language="ru"  # Указываем русский язык для лучшего качества
+                    file=(filename, audio),
+                    language="ru"
                 )
             
             transcribed_text = transcript.text
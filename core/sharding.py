@@ -0,0 +1,108 @@
+"""
+Шардирование пользователей между процессами и аренда фоновых задач
+
+В многопроцессном режиме (sharded.py) каждый воркер обслуживает пользователей своего шарда:
+все апдейты пользователя попадают в один процесс, поэтому кэши и FSM в памяти остаются
+согласованными. Глобальные фоновые задачи выполняет только держатель аренды в таблице
+job_leases - без внешнего брокера, на одной машине.
+В обычном режиме (main.py) шард один и все проверки пропускают любого пользователя.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+
+from core.config import JOB_LEASE_TTL
+from core.database import db
+
+logger = logging.getLogger(__name__)
+
+# Заполняются лаунчером sharded.py для каждого процесса воркера
+SHARD_COUNT = int(os.getenv("BOT_SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("BOT_SHARD_INDEX", "0"))
+
+# Уникальный владелец аренды: хост, процесс и случайный суффикс
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def configure_shard(index: int, count: int):
+    """
+    Назначает текущему процессу шард (вызывается в процессе воркера до запуска бота)
+
+    Args:
+        index: номер шарда
+        count: всего шардов
+    """
+    global SHARD_INDEX, SHARD_COUNT
+    SHARD_INDEX = index
+    SHARD_COUNT = count
+
+
+def shard_for(user_id: int, count: int = None) -> int:
+    """Номер шарда пользователя"""
+    count = count or SHARD_COUNT
+    return user_id % count if user_id else 0
+
+
+def owns_user(user_id: int) -> bool:
+    """Обслуживает ли текущий процесс пользователя"""
+    return SHARD_COUNT <= 1 or shard_for(user_id) == SHARD_INDEX
+
+
+def update_user_id(update) -> int:
+    """
+    ID пользователя (или чата), по которому апдейт направляется в шард
+
+    Args:
+        update: aiogram Update
+
+    Returns:
+        int: ID или 0, если апдейт не связан с пользователем
+    """
+    event = getattr(update, update.event_type, None) if update.event_type else None
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    return 0
+
+
+async def run_with_lease(name: str, job_factory, ttl: float = JOB_LEASE_TTL):
+    """
+    Выполняет фоновую задачу только пока процесс держит ее аренду.
+    Если лидер пропал, аренду через TTL подхватит другой процесс.
+
+    Args:
+        name: имя задачи (ключ аренды)
+        job_factory: функция без аргументов, возвращающая корутину задачи
+        ttl: время жизни аренды в секундах
+    """
+    renew_interval = ttl / 3
+    job_task = None
+
+    try:
+        while True:
+            acquired = db.acquire_job_lease(name, LEASE_OWNER, ttl)
+
+            if acquired and job_task is None:
+                logger.info(f"Аренда задачи {name} получена ({LEASE_OWNER})")
+                job_task = asyncio.create_task(job_factory())
+            elif not acquired and job_task is not None:
+                logger.warning(f"Аренда задачи {name} потеряна, задача остановлена")
+                job_task.cancel()
+                job_task = None
+
+            if job_task is not None and job_task.done():
+                # Задача завершилась (в том числе с ошибкой) - перезапустим на следующем шаге
+                if not job_task.cancelled() and job_task.exception():
+                    logger.error(f"Задача {name} завершилась с ошибкой: {job_task.exception()}")
+                job_task = None
+
+            await asyncio.sleep(renew_interval)
+    finally:
+        if job_task is not None:
+            job_task.cancel()
+        db.release_job_lease(name, LEASE_OWNER)
@@ -0,0 +1,350 @@
+"""
+Единый диспетчер исходящих запросов к Telegram
+
+Все отправки бота проходят через request middleware сессии: запрос ждет своей очереди
+с учетом приоритета, глобального лимита и лимита на чат, а retry_after обрабатывается здесь же.
+Интерактивные ответы идут раньше автоворонок и рассылок.
+Части одного длинного сообщения встают в очередь сразу, но уходят в Telegram по порядку (OrderedSend).
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from core.config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST,
+    TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_RETRY_ATTEMPTS
+)
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов (меньше - важнее)
+PRIORITY_INTERACTIVE = 0   # ответы на действия пользователя
+PRIORITY_NOTIFICATION = 1  # уведомления об оплате, админам
+PRIORITY_FUNNEL = 2        # автоспам, купи-видео
+PRIORITY_BROADCAST = 3     # рассылки новостей
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_NOTIFICATION: "notification",
+    PRIORITY_FUNNEL: "funnel",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+# Методы Bot API, которые расходуют лимиты Telegram на отправку
+RATE_LIMITED_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendVideoNote", "sendDocument",
+    "sendAudio", "sendVoice", "sendAnimation", "sendMediaGroup", "sendSticker",
+    "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption",
+    "editMessageReplyMarkup", "editMessageMedia",
+}
+
+# Приоритет текущей задачи; фоновые задачи и рассылки понижают его через sender_priority()
+current_priority = contextvars.ContextVar("telegram_sender_priority", default=PRIORITY_INTERACTIVE)
+
+# Упорядоченная отправка и номер части, к которым относится запрос текущей задачи
+current_order = contextvars.ContextVar("telegram_sender_order", default=None)
+
+# Через сколько секунд простоя удаляется бакет чата
+CHAT_BUCKET_IDLE_TTL = 300
+
+
+@contextmanager
+def sender_priority(priority: int):
+    """
+    Устанавливает приоритет исходящих запросов для кода внутри блока
+
+    Args:
+        priority: один из PRIORITY_*
+    """
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class OrderedSend:
+    """
+    Упорядоченная отправка частей одного сообщения конвейером.
+
+    Все части сразу ждут лимитов в очереди диспетчера, не дожидаясь ответа Telegram
+    на предыдущую часть, но запрос части уходит только после запроса предыдущей.
+    Повтор после retry_after сохраняет место части в очереди.
+    """
+
+    def __init__(self, size: int):
+        self.dispatched = [asyncio.Event() for _ in range(size)]
+
+    @contextmanager
+    def part(self, index: int):
+        """Отмечает запросы кода внутри блока как часть index"""
+        token = current_order.set((self, index))
+        try:
+            yield
+        finally:
+            current_order.reset(token)
+
+    async def wait_turn(self, index: int):
+        """Ждет, пока уйдет запрос предыдущей части"""
+        if index > 0:
+            await self.dispatched[index - 1].wait()
+
+    def mark_dispatched(self, index: int):
+        self.dispatched[index].set()
+
+
+class TokenBucket:
+    """Токен-бакет с возможностью временной блокировки (retry_after)"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now > self.blocked_until + CHAT_BUCKET_IDLE_TTL
+
+
+class TelegramSender:
+    """
+    Очередь исходящих запросов с приоритетами и токен-бакетами
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.waiters = []  # [priority, seq, chat_id, future, enqueued_at]
+        self.seq = 0
+        self.wakeup = None
+        self.scheduler_task = None
+        self.loop = None
+        self.bot = None
+        self.stats = {
+            "sent": {name: 0 for name in PRIORITY_NAMES.values()},
+            "wait_total": {name: 0.0 for name in PRIORITY_NAMES.values()},
+            "wait_max": {name: 0.0 for name in PRIORITY_NAMES.values()},
+            "retry_after": 0,
+            "errors": 0,
+            "max_queue": 0,
+        }
+
+    def attach(self, bot, rate_share: float = 1.0):
+        """
+        Подключает диспетчер к сессии бота. Вызывается один раз при запуске внутри event loop.
+
+        Args:
+            bot: экземпляр бота
+            rate_share: доля глобального лимита Telegram для этого процесса (в многопроцессном режиме)
+        """
+        if rate_share != 1.0:
+            self.global_bucket = TokenBucket(
+                TELEGRAM_GLOBAL_RATE * rate_share, max(1.0, TELEGRAM_GLOBAL_BURST * rate_share)
+            )
+        self.bot = bot
+        self.loop = asyncio.get_running_loop()
+        bot.session.middleware(SenderMiddleware(self))
+        logger.info("Диспетчер исходящих запросов Telegram подключен")
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _ensure_scheduler(self):
+        if self.scheduler_task is None or self.scheduler_task.done():
+            self.wakeup = asyncio.Event()
+            self.scheduler_task = asyncio.create_task(self._scheduler())
+
+    async def acquire(self, chat_id, priority: int, seq: int = None) -> int:
+        """
+        Ждет разрешения на отправку в чат с учетом приоритета и лимитов
+
+        Args:
+            chat_id: ID чата получателя
+            priority: приоритет запроса
+            seq: место в очереди, полученное при прошлой попытке (повтор не уходит в конец)
+
+        Returns:
+            int: место запроса в очереди
+        """
+        self._ensure_scheduler()
+        future = asyncio.get_running_loop().create_future()
+        if seq is None:
+            self.seq += 1
+            seq = self.seq
+        entry = [priority, seq, chat_id, future, time.monotonic()]
+        self.waiters.append(entry)
+        self.stats["max_queue"] = max(self.stats["max_queue"], len(self.waiters))
+        self.wakeup.set()
+        try:
+            await future
+        finally:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        waited = time.monotonic() - entry[4]
+        self.stats["sent"][name] = self.stats["sent"].get(name, 0) + 1
+        self.stats["wait_total"][name] = self.stats["wait_total"].get(name, 0.0) + waited
+        self.stats["wait_max"][name] = max(self.stats["wait_max"].get(name, 0.0), waited)
+        return seq
+
+    async def _scheduler(self):
+        """Выдает разрешения ожидающим запросам по приоритету, не блокируясь на занятых чатах"""
+        last_cleanup = time.monotonic()
+
+        while True:
+            self.waiters = [entry for entry in self.waiters if not entry[3].done()]
+            if not self.waiters:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            sleep_for = self.global_bucket.delay(now)
+
+            if sleep_for == 0:
+                sleep_for = float("inf")
+                for entry in sorted(self.waiters, key=lambda item: (item[0], item[1])):
+                    chat_delay = self._chat_bucket(entry[2]).delay(now)
+                    if chat_delay == 0:
+                        self.global_bucket.consume(now)
+                        self._chat_bucket(entry[2]).consume(now)
+                        self.waiters.remove(entry)
+                        entry[3].set_result(None)
+                        sleep_for = 0
+                        break
+                    sleep_for = min(sleep_for, chat_delay)
+
+            if now - last_cleanup > CHAT_BUCKET_IDLE_TTL:
+                self.chat_buckets = {
+                    chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+                    if not bucket.is_idle(now)
+                }
+                last_cleanup = now
+                logger.info(self.format_stats())
+
+            if sleep_for == 0:
+                continue
+
+            # Ждем освобождения лимита или появления нового запроса
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    def on_retry_after(self, chat_id, retry_after: float):
+        """Блокирует чат на время, указанное Telegram"""
+        self.stats["retry_after"] += 1
+        self._chat_bucket(chat_id).block(retry_after)
+        logger.warning(f"Flood control для чата {chat_id}: пауза {retry_after} сек")
+
+    def run_threadsafe(self, coro, priority: int = PRIORITY_NOTIFICATION, timeout: float = 30):
+        """
+        Выполняет корутину отправки в event loop бота из другого потока (вебхук GetCourse в потоке исполнителя)
+
+        Args:
+            coro: корутина, например bot.send_message(...)
+            priority: приоритет запросов внутри корутины
+            timeout: максимальное время ожидания результата
+
+        Returns:
+            результат корутины
+        """
+        async def with_priority():
+            with sender_priority(priority):
+                return await coro
+
+        future = asyncio.run_coroutine_threadsafe(with_priority(), self.loop)
+        return future.result(timeout)
+
+    def is_running(self) -> bool:
+        """Подключен ли диспетчер к работающему боту"""
+        return self.bot is not None and self.loop is not None and self.loop.is_running()
+
+    def get_stats(self) -> dict:
+        """Статистика диспетчера"""
+        stats = dict(self.stats)
+        stats["queue"] = len(self.waiters)
+        stats["chats"] = len(self.chat_buckets)
+        return stats
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по исходящим запросам"""
+        lines = ["📤 Исходящие запросы Telegram:"]
+        for name in PRIORITY_NAMES.values():
+            sent = self.stats["sent"].get(name, 0)
+            avg_wait = self.stats["wait_total"].get(name, 0.0) / sent if sent else 0.0
+            lines.append(
+                f"  • {name}: {sent}, ожидание ср. {avg_wait * 1000:.0f} мс, "
+                f"макс. {self.stats['wait_max'].get(name, 0.0) * 1000:.0f} мс"
+            )
+        lines.append(f"  • retry_after: {self.stats['retry_after']}, ошибок: {self.stats['errors']}")
+        lines.append(f"  • очередь: {len(self.waiters)} (макс. {self.stats['max_queue']}), чатов: {len(self.chat_buckets)}")
+        return "\n".join(lines)
+
+
+class SenderMiddleware(BaseRequestMiddleware):
+    """Request middleware сессии бота: пропускает отправки через TelegramSender"""
+
+    def __init__(self, sender: TelegramSender):
+        self.sender = sender
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if method.__api_method__ not in RATE_LIMITED_METHODS or chat_id is None:
+            return await make_request(bot, method)
+
+        priority = current_priority.get()
+        order = current_order.get()
+        seq = None
+        for attempt in range(TELEGRAM_RETRY_ATTEMPTS):
+            seq = await self.sender.acquire(chat_id, priority, seq)
+            try:
+                if order is not None:
+                    chain, index = order
+                    await chain.wait_turn(index)
+                    chain.mark_dispatched(index)
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.sender.on_retry_after(chat_id, e.retry_after)
+                if attempt == TELEGRAM_RETRY_ATTEMPTS - 1:
+                    self.sender.stats["errors"] += 1
+                    raise
+            except Exception:
+                self.sender.stats["errors"] += 1
+                raise
+
+
+# Глобальный экземпляр диспетчера исходящих запросов
+telegram_sender = TelegramSender()
@@ -0,0 +1,144 @@
+"""
+Пул заранее созданных пустых OpenAI threads
+
+После ежедневного сброса у всех пользователей нет thread'а, и первое сообщение дня ждало
+создания thread'а в OpenAI. Пул держит готовые thread'ы: create_thread берет thread отсюда,
+а фоновая задача пополняет пул до размера, рассчитанного по активности прошлого дня.
+Пул хранится в БД, чтобы созданные thread'ы не терялись при перезапуске.
+"""
+import asyncio
+import logging
+import math
+from collections import deque
+from typing import Optional
+
+from core.config import (
+    THREAD_POOL_FRACTION, THREAD_POOL_MIN_SIZE, THREAD_POOL_MAX_SIZE, THREAD_POOL_CONCURRENCY
+)
+from core.database import db
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadPool:
+    """
+    Пул готовых thread'ов с фоновым пополнением
+    """
+
+    def __init__(self):
+        self.threads = None  # deque thread_id, загружается из БД при первом обращении
+        self.target_size = THREAD_POOL_MIN_SIZE
+        self.refill_needed = None
+        self.stats = {"taken": 0, "misses": 0, "created": 0, "errors": 0}
+
+    def _load(self):
+        if self.threads is None:
+            self.threads = deque(db.get_pooled_threads())
+
+    def _wake(self):
+        if self.refill_needed is not None:
+            self.refill_needed.set()
+
+    def take(self) -> Optional[str]:
+        """
+        Выдает готовый thread из пула
+
+        Returns:
+            str: thread_id или None, если пул пуст
+        """
+        self._load()
+        self._wake()
+        if not self.threads:
+            # Пул могли пополнить другие процессы
+            self.threads = deque(db.get_pooled_threads())
+
+        while self.threads:
+            thread_id = self.threads.popleft()
+            # Thread выдается, только если удален из БД этим вызовом (его не забрал другой процесс)
+            if db.remove_pooled_thread(thread_id):
+                self.stats["taken"] += 1
+                return thread_id
+
+        self.stats["misses"] += 1
+        return None
+
+    def resize(self, active_users: int):
+        """
+        Пересчитывает целевой размер пула
+
+        Args:
+            active_users: количество пользователей чата за прошлый день
+        """
+        target = math.ceil(active_users * THREAD_POOL_FRACTION)
+        self.target_size = max(THREAD_POOL_MIN_SIZE, min(THREAD_POOL_MAX_SIZE, target))
+        logger.info(f"Размер пула thread'ов: {self.target_size} (активных пользователей: {active_users})")
+        self._wake()
+
+    async def refill(self, create_func) -> int:
+        """
+        Создает недостающие thread'ы
+
+        Args:
+            create_func: корутина без аргументов, возвращающая thread_id
+
+        Returns:
+            int: сколько thread'ов создано
+        """
+        self._load()
+        missing = self.target_size - len(self.threads)
+        if missing <= 0:
+            return 0
+
+        semaphore = asyncio.Semaphore(THREAD_POOL_CONCURRENCY)
+
+        async def create_one():
+            async with semaphore:
+                try:
+                    thread_id = await create_func()
+                except Exception as e:
+                    logger.warning(f"Не удалось создать thread для пула: {e}")
+                    thread_id = None
+                if not thread_id:
+                    self.stats["errors"] += 1
+                    return 0
+                db.add_pooled_thread(thread_id)
+                self.threads.append(thread_id)
+                self.stats["created"] += 1
+                return 1
+
+        created = sum(await asyncio.gather(*(create_one() for _ in range(missing))))
+        logger.info(f"Пул thread'ов пополнен: +{created}, в пуле {len(self.threads)}/{self.target_size}")
+        return created
+
+    async def run(self, create_func, interval: float):
+        """
+        Фоновое пополнение пула: сразу после выдачи thread'а и не реже раза в interval секунд
+
+        Args:
+            create_func: корутина создания thread'а
+            interval: период проверки в секундах
+        """
+        self.refill_needed = asyncio.Event()
+        while True:
+            self.refill_needed.clear()
+            errors_before = self.stats["errors"]
+            created = await self.refill(create_func)
+            # Если OpenAI не создает thread'ы, не пытаемся снова сразу после выдачи
+            if created == 0 and self.stats["errors"] > errors_before:
+                await asyncio.sleep(interval)
+            try:
+                await asyncio.wait_for(self.refill_needed.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по пулу"""
+        self._load()
+        return (
+            f"🧵 Пул thread'ов: {len(self.threads)}/{self.target_size}, выдано {self.stats['taken']}, "
+            f"пул был пуст {self.stats['misses']} раз, создано {self.stats['created']}, ошибок {self.stats['errors']}"
+        )
+
+
+# Глобальный пул thread'ов
+thread_pool = ThreadPool()
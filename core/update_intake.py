@@ -0,0 +1,133 @@
+"""
+Прием апдейтов Telegram через webhook
+
+Telegram присылает апдейты POST-запросами на aiohttp-сервер. Обработчик запроса только
+проверяет секрет, разбирает апдейт и кладет его в ограниченную очередь - ответ уходит
+сразу, не дожидаясь OpenAI и отправки сообщений. Апдейты из очереди обрабатывает
+фиксированное число задач, поэтому одновременно выполняется не больше WEBHOOK_CONCURRENCY
+хендлеров. Если очередь заполнена дольше WEBHOOK_ENQUEUE_TIMEOUT, запрос получает 503
+и Telegram повторит его позже - это и есть backpressure.
+"""
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from core.config import (
+    WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE, WEBHOOK_CONCURRENCY, WEBHOOK_ENQUEUE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Через сколько секунд Telegram стоит повторить запрос, отклоненный из-за переполнения
+RETRY_AFTER = 1
+
+
+class UpdateIntake:
+    """
+    Очередь апдейтов из webhook и пул задач, передающих их в диспетчер
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, secret: str = WEBHOOK_SECRET,
+                 concurrency: int = WEBHOOK_CONCURRENCY, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 enqueue_timeout: float = WEBHOOK_ENQUEUE_TIMEOUT):
+        self.bot = bot
+        self.dp = dp
+        self.secret = secret
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.enqueue_timeout = enqueue_timeout
+        self.queue = None  # asyncio.Queue, создается в start() внутри event loop
+        self.workers = []
+        self.started_at = None
+        self.stats = {
+            "accepted": 0, "processed": 0, "errors": 0,
+            "rejected": 0, "invalid": 0, "unauthorized": 0, "max_queue": 0,
+        }
+
+    def start(self):
+        """Создает очередь и задачи обработки"""
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.started_at = time.monotonic()
+
+    def is_running(self) -> bool:
+        return self.queue is not None
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                self.stats["processed"] += 1
+                self.queue.task_done()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """aiohttp-обработчик POST-запроса Telegram"""
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            self.stats["unauthorized"] += 1
+            return web.Response(status=401)
+
+        if self.queue is None:
+            # Webhook еще не запущен или бот переключился на polling
+            return web.Response(status=503, headers={"Retry-After": str(RETRY_AFTER)})
+
+        try:
+            payload = await request.json()
+            update = Update.model_validate(payload, context={"bot": self.bot})
+        except Exception as e:
+            # Повтор того же апдейта не поможет - подтверждаем, чтобы Telegram его не присылал снова
+            self.stats["invalid"] += 1
+            logger.error(f"Некорректный апдейт из webhook: {e}")
+            return web.Response()
+
+        try:
+            await asyncio.wait_for(self.queue.put(update), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            logger.warning(f"Очередь апдейтов заполнена, апдейт {update.update_id} отклонен до повтора")
+            return web.Response(status=503, headers={"Retry-After": str(RETRY_AFTER)})
+
+        self.stats["accepted"] += 1
+        self.stats["max_queue"] = max(self.stats["max_queue"], self.queue.qsize())
+        return web.Response()
+
+    async def stop(self, drain_timeout: float = 10):
+        """
+        Дожидается обработки принятых апдейтов и останавливает задачи
+
+        Args:
+            drain_timeout: сколько секунд ждать опустошения очереди
+        """
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Остановка webhook: не обработано апдейтов: {self.queue.qsize()}")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queue = None
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по приему апдейтов"""
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        rate = self.stats["processed"] / elapsed if elapsed > 0 else 0
+        return (
+            f"📥 Webhook: принято {self.stats['accepted']}, обработано {self.stats['processed']} "
+            f"({rate:.1f}/с), ошибок {self.stats['errors']}, отклонено при переполнении {self.stats['rejected']}, "
+            f"некорректных {self.stats['invalid']}, без секрета {self.stats['unauthorized']}, "
+            f"макс. очередь {self.stats['max_queue']}/{self.queue_size}"
+        )
@@ -0,0 +1,95 @@
+"""
+Контекст пользователя на время обработки одного апдейта
+
+Outer-middleware (middlewares/user_context.py) один раз загружает подписку, реферальный
+профиль, UTM метки и статус автоспама и кладет контекст в data хендлера
+и в ContextVar - так его видят клавиатуры и вспомогательные функции без лишних
+параметров. Повторяющиеся записи (например, отключение автоспама на каждое нажатие)
+откладываются и выполняются одним разом в конце апдейта, и только если что-то изменилось.
+"""
+import contextvars
+import logging
+from typing import Optional
+
+from core.config import PERMANENT_ACCESS_IDS
+from core.database import db
+
+logger = logging.getLogger(__name__)
+
+current_user_context = contextvars.ContextVar("current_user_context", default=None)
+
+
+class UserContext:
+    """
+    Снимок данных пользователя и отложенные записи
+    """
+
+    def __init__(self, user_id: int, data: dict):
+        self.user_id = user_id
+        # Версия пользователя на момент загрузки: после оплаты или бонуса снимок устаревает
+        self.version = db.get_user_version(user_id)
+        self.subscription = data['subscription']
+        self.referral = data['referral']
+        self.utm = data['utm']
+        self.spam_completed = data['spam_completed']
+        self.pending_spam_completed = False
+        self.closed = False
+
+    @classmethod
+    def load(cls, user_id: int) -> "UserContext":
+        return cls(user_id, db.load_user_context(user_id))
+
+    def is_fresh(self) -> bool:
+        """Не изменились ли подписка и реферальный профиль после загрузки"""
+        return db.get_user_version(self.user_id) == self.version
+
+    @property
+    def subscribed(self) -> bool:
+        """Активная подписка или вечный доступ (как db.is_user_subscribed)"""
+        return self.user_id in PERMANENT_ACCESS_IDS or self.subscription.get('is_active', False)
+
+    @property
+    def referral_registered(self) -> bool:
+        return self.referral is not None
+
+    @property
+    def referral_balance(self) -> int:
+        return (self.referral or {}).get('referral_balance') or 0
+
+    def mark_spam_completed(self):
+        """Отключает автоспам; запись в БД - в конце апдейта и только при изменении"""
+        if self.spam_completed and not self.pending_spam_completed:
+            return
+        if self.closed:
+            # Апдейт уже обработан (например, запись из фоновой задачи хендлера)
+            db.mark_spam_completed(self.user_id)
+            self.spam_completed = True
+            return
+        self.spam_completed = True
+        self.pending_spam_completed = True
+
+    def flush(self):
+        """Выполняет отложенные записи"""
+        self.closed = True
+        if self.pending_spam_completed:
+            self.pending_spam_completed = False
+            try:
+                db.mark_spam_completed(self.user_id)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения статуса автоспама пользователя {self.user_id}: {e}")
+
+
+def get_user_context(user_id: int) -> Optional[UserContext]:
+    """
+    Контекст текущего апдейта, если он относится к этому пользователю
+
+    Args:
+        user_id: ID пользователя
+
+    Returns:
+        UserContext или None (вне апдейта или для другого пользователя)
+    """
+    context = current_user_context.get()
+    if context is not None and context.user_id == user_id:
+        return context
+    return None
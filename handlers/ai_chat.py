@@ -3,16 +3,20 @@ from aiogram.types import Message, Voice, Audio
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 import logging
-import os
-import tempfile
+from typing import Optional
 
 from core.openai_client import openai_client
 from core.database import db
+from services.transcription import transcription_pool
+from utils.audio_utils import audio_filename
 from utils.message_utils import answer_split_text
+from middlewares.throttling import ai_throttling
 
 logger = logging.getLogger(__name__)
 
 router = Router()
+# Частота сообщений подписчиков ограничивается до обращения к OpenAI
+router.message.middleware(ai_throttling)
 
 class AIChat(StatesGroup):
     waiting_for_message = State()
@@ -60,19 +64,8 @@ async def handle_voice_message(message: Message, state: FSMContext):
         except Exception:
             pass  # Игнорируем ошибки flood control
         
-        # Скачиваем голосовое сообщение
-        voice_file = await message.bot.get_file(message.voice.file_id)
-        
-        # Создаем временный файл
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_file:
-            temp_path = temp_file.name
-            await message.bot.download_file(voice_file.file_path, temp_path)
-        
-        # Расшифровываем аудио в текст
-        transcribed_text = await openai_client.transcribe_audio(user_id, temp_path)
-        
-        # Удаляем временный файл
-        os.unlink(temp_path)
+        # Скачиваем и расшифровываем голосовое сообщение без записи на диск
+        transcribed_text = await transcribe_message_audio(message, user_id, message.voice, "voice.ogg")
         
         if not transcribed_text:
             await answer_split_text(message, "❌ Не удалось распознать голосовое сообщение. Попробуйте еще раз.")
@@ -102,20 +95,10 @@ async def handle_audio_message(message: Message, state: FSMContext):
         except Exception:
             pass  # Игнорируем ошибки flood control
         
-        # Скачиваем аудио файл
-        audio_file = await message.bot.get_file(message.audio.file_id)
-        
-        # Создаем временный файл с правильным расширением
-        file_extension = ".mp3" if message.audio.mime_type == "audio/mpeg" else ".ogg"
-        with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as temp_file:
-            temp_path = temp_file.name
-            await message.bot.download_file(audio_file.file_path, temp_path)
-        
-        # Расшифровываем аудио в текст
-        transcribed_text = await openai_client.transcribe_audio(user_id, temp_path)
-        
-        # Удаляем временный файл
-        os.unlink(temp_path)
+        # Скачиваем и расшифровываем аудио файл, имя с расширением по MIME типу
+        transcribed_text = await transcribe_message_audio(
+            message, user_id, message.audio, audio_filename(message.audio.mime_type)
+        )
         
         if not transcribed_text:
             await answer_split_text(message, "❌ Не удалось распознать аудио файл. Попробуйте еще раз.")
@@ -128,6 +111,28 @@ async def handle_audio_message(message: Message, state: FSMContext):
         logger.error(f"Ошибка обработки аудио файла для пользователя {user_id}: {e}")
         await answer_split_text(message, "❌ Ошибка обработки аудио файла. Попробуйте еще раз.")
 
+async def transcribe_message_audio(message: Message, user_id: int, media, filename: str) -> Optional[str]:
+    """
+    Расшифровывает голосовое или аудио через общий пул (с кэшем по file_unique_id)
+    
+    Args:
+        message: сообщение пользователя
+        user_id: ID пользователя
+        media: message.voice или message.audio
+        filename: имя файла для Whisper
+        
+    Returns:
+        str: расшифрованный текст или None
+    """
+    return await transcription_pool.transcribe(
+        message.bot, user_id,
+        file_id=media.file_id,
+        file_unique_id=media.file_unique_id,
+        file_size=media.file_size,
+        filename=filename,
+        duration=media.duration or 0
+    )
+
 @router.message(F.photo)
 async def handle_photo_message(message: Message, state: FSMContext):
     """Обработчик фотографий"""
@@ -1,4 +1,3 @@
-import asyncio
 import logging
 from datetime import datetime
 from aiogram import Router, F
@@ -10,6 +9,9 @@ from aiogram.fsm.state import State, StatesGroup
 from core.config import NEWS_ADMIN_IDS
 from core.database import db
 from utils.message_utils import answer_split_text
+from core.telegram_sender import sender_priority, PRIORITY_BROADCAST
+from services.answer_cache import answer_cache
+from services.usage_ledger import usage_ledger
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -56,6 +58,40 @@ async def news_command(message: Message, state: FSMContext):
     await message.answer(text, reply_markup=get_audience_menu())
     await state.set_state(NewsStates.choosing_audience)
 
+@router.message(Command("answer_cache"))
+async def answer_cache_command(message: Message):
+    """Команда /answer_cache для админов: статистика кэша ответов ИИ, /answer_cache clear - очистка"""
+    if message.from_user.id not in NEWS_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав доступа к этой функции")
+        return
+    
+    args = (message.text or "").split()
+    if len(args) > 1 and args[1] == "clear":
+        from core.openai_client import ASSISTANT_ID
+        removed = answer_cache.invalidate(ASSISTANT_ID)
+        await message.answer(f"🧹 Кэш ответов очищен: удалено {removed} записей")
+        return
+    
+    await message.answer(answer_cache.format_stats())
+
+@router.message(Command("usage"))
+async def usage_command(message: Message):
+    """Команда /usage для админов: расход OpenAI за сегодня, /usage YYYY-MM-DD - за другой день"""
+    if message.from_user.id not in NEWS_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав доступа к этой функции")
+        return
+    
+    args = (message.text or "").split()
+    day = None
+    if len(args) > 1:
+        try:
+            day = datetime.strptime(args[1], '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            await message.answer("❌ Укажите дату в формате YYYY-MM-DD")
+            return
+    
+    await answer_split_text(message, usage_ledger.format_report(day))
+
 @router.callback_query(F.data.startswith("news_"))
 async def handle_news_callbacks(callback: CallbackQuery, state: FSMContext):
     """Обработка всех callback'ов для рассылки новостей"""
@@ -239,30 +275,32 @@ async def send_broadcast_messages(recipients: list, message_data: dict, progress
             # Отправляем сообщение в зависимости от типа контента
             bot = progress_message.bot
             
-            if message_data.get("photo"):
-                await bot.send_photo(
-                    user_id, 
-                    message_data["photo"], 
-                    caption=message_data.get("caption")
-                )
-            elif message_data.get("video"):
-                await bot.send_video(
-                    user_id, 
-                    message_data["video"], 
-                    caption=message_data.get("caption")
-                )
-            elif message_data.get("document"):
-                await bot.send_document(
-                    user_id, 
-                    message_data["document"], 
-                    caption=message_data.get("caption")
-                )
-            elif message_data.get("voice"):
-                await bot.send_voice(user_id, message_data["voice"])
-            elif message_data.get("video_note"):
-                await bot.send_video_note(user_id, message_data["video_note"])
-            else:
-                await bot.send_message(user_id, message_data.get("text", ""))
+            # Рассылка идет с низшим приоритетом, темп задает диспетчер исходящих запросов
+            with sender_priority(PRIORITY_BROADCAST):
+                if message_data.get("photo"):
+                    await bot.send_photo(
+                        user_id, 
+                        message_data["photo"], 
+                        caption=message_data.get("caption")
+                    )
+                elif message_data.get("video"):
+                    await bot.send_video(
+                        user_id, 
+                        message_data["video"], 
+                        caption=message_data.get("caption")
+                    )
+                elif message_data.get("document"):
+                    await bot.send_document(
+                        user_id, 
+                        message_data["document"], 
+                        caption=message_data.get("caption")
+                    )
+                elif message_data.get("voice"):
+                    await bot.send_voice(user_id, message_data["voice"])
+                elif message_data.get("video_note"):
+                    await bot.send_video_note(user_id, message_data["video_note"])
+                else:
+                    await bot.send_message(user_id, message_data.get("text", ""))
             
             sent_count += 1
             
@@ -280,9 +318,6 @@ async def send_broadcast_messages(recipients: list, message_data: dict, progress
                 )
             except:
                 pass  # Игнорируем ошибки обновления прогресса
-        
-        # Небольшая пауза для избежания flood control
-        await asyncio.sleep(0.05)
     
     return sent_count, error_count
 
@@ -291,7 +326,7 @@ def get_recipients_count(audience_type: str) -> int:
     if audience_type == "all_users":
         return db.get_all_users_count()
     elif audience_type == "active_subscribers":
-        return len(db.get_active_subscribers())
+        return db.get_active_subscribers_count()
     elif audience_type == "course_users":
         return db.get_course_users_count()
     elif audience_type == "paid_subscribers":
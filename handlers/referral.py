@@ -1,5 +1,7 @@
 import re
 import logging
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
@@ -7,6 +9,7 @@ from aiogram.fsm.state import State, StatesGroup
 
 from core.config import PERMANENT_ACCESS_IDS, REFERRAL_BONUS
 from core.database import db
+from core.user_context import get_user_context
 from services.referral_getcourse import send_referral_data_to_getcourse
 from utils.message_utils import answer_split_text
 
@@ -24,16 +27,19 @@ def get_referral_keyboard():
     ])
     return keyboard
 
-def get_referral_main_keyboard(user_id: int):
-    """Главная клавиатура реферальной программы"""
+def get_referral_main_keyboard(referral_info: Optional[dict]):
+    """
+    Главная клавиатура реферальной программы
+    
+    Args:
+        referral_info: реферальный профиль пользователя (None - не зарегистрирован)
+    """
     buttons = []
     
     # Проверяем статус регистрации
-    if db.is_referral_user_registered(user_id):
-        referral_info = db.get_referral_info(user_id)
-        
+    if referral_info is not None:
         # Если email не указан - показываем кнопку для указания email
-        if not referral_info or not referral_info.get('email'):
+        if not referral_info.get('email'):
             buttons.append([InlineKeyboardButton(text="📧 Указать email", callback_data="referral_register")])
         # Если email указан - пользователь полностью зарегистрирован, кнопок не нужно
     else:
@@ -45,9 +51,18 @@ def get_referral_main_keyboard(user_id: int):
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     return keyboard
 
+def get_referral_profile(user_id: int) -> Optional[dict]:
+    """Реферальный профиль из контекста апдейта (из БД - если контекст устарел или не загружен)"""
+    context = get_user_context(user_id)
+    if context is not None and context.is_fresh():
+        return context.referral
+    return db.get_referral_info(user_id)
+
 def has_referral_access(user_id: int) -> bool:
     """Проверяет, есть ли у пользователя доступ к реферальной программе"""
-    from core.database import db
+    context = get_user_context(user_id)
+    if context is not None and context.is_fresh():
+        return context.subscribed
     return db.is_user_subscribed(user_id)
 
 @router.callback_query(F.data == "referral_main")
@@ -63,11 +78,10 @@ async def referral_main_menu(callback: CallbackQuery):
     await callback.answer()
     
     # Проверяем, зарегистрирован ли пользователь и указан ли email
-    if db.is_referral_user_registered(user_id):
-        referral_info = db.get_referral_info(user_id)
-        
+    referral_info = get_referral_profile(user_id)
+    if referral_info is not None:
         # Если email не указан, запрашиваем его
-        if not referral_info or not referral_info.get('email'):
+        if not referral_info.get('email'):
             text = """🎁 <b>Реферальная программа</b>
 
 ✨ Добро пожаловать в реферальную программу!
@@ -77,11 +91,11 @@ async def referral_main_menu(callback: CallbackQuery):
 
 ⚠️ <b>Важно:</b> Укажите тот же email, который использовали при регистрации на GetCourse платформе"""
             
-            await callback.message.answer(text, reply_markup=get_referral_main_keyboard(user_id))
+            await callback.message.answer(text, reply_markup=get_referral_main_keyboard(referral_info))
             return
         
         # Пользователь полностью зарегистрирован - показываем полную информацию
-        balance = referral_info['referral_balance'] if referral_info else 0
+        balance = referral_info['referral_balance']
         
         # Получаем реферальную ссылку
         bot_username = "ai_tatyana_solo_bot"
@@ -116,7 +130,7 @@ async def referral_main_menu(callback: CallbackQuery):
 
 📝 <b>Для участия необходима регистрация с указанием email</b>"""
     
-    await callback.message.answer(text, reply_markup=get_referral_main_keyboard(user_id))
+    await callback.message.answer(text, reply_markup=get_referral_main_keyboard(referral_info))
 
 @router.callback_query(F.data == "referral_register")
 async def referral_register_start(callback: CallbackQuery, state: FSMContext):
@@ -130,12 +144,11 @@ async def referral_register_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
     # Проверяем, есть ли уже email у пользователя
-    if db.is_referral_user_registered(user_id):
-        referral_info = db.get_referral_info(user_id)
-        if referral_info and referral_info.get('email'):
-            await callback.message.answer("✅ Вы уже зарегистрированы в реферальной программе!", 
-                                            reply_markup=get_referral_main_keyboard(user_id))
-            return
+    referral_info = get_referral_profile(user_id)
+    if referral_info and referral_info.get('email'):
+        await callback.message.answer("✅ Вы уже зарегистрированы в реферальной программе!", 
+                                        reply_markup=get_referral_main_keyboard(referral_info))
+        return
     
     text = """📝 <b>Регистрация в реферальной программе</b>
 
@@ -159,14 +172,14 @@ async def process_email_registration(message: Message, state: FSMContext):
         return
     
     # Проверяем, зарегистрирован ли уже пользователь
-    if db.is_referral_user_registered(user_id):
-        referral_info = db.get_referral_info(user_id)
-        
+    referral_info = get_referral_profile(user_id)
+    if referral_info is not None:
         # Обновляем email для существующего пользователя
         db.update_referral_user_email(user_id, email)
+        referral_info = {**referral_info, 'email': email}
         
         # Отправляем данные в GetCourse с текущим балансом
-        current_balance = referral_info.get('referral_balance', 0) if referral_info else 0
+        current_balance = referral_info.get('referral_balance') or 0
         await send_referral_data_to_getcourse(email, current_balance)
         
         text = f"""✅ <b>Email обновлен!</b>
@@ -178,6 +191,7 @@ async def process_email_registration(message: Message, state: FSMContext):
     else:
         # Регистрируем нового пользователя
         db.register_referral_user(user_id, email)
+        referral_info = {'email': email, 'referrer_user_id': None, 'referral_balance': 0}
         
         # Отправляем начальные данные в GetCourse
         await send_referral_data_to_getcourse(email, 0)
@@ -190,62 +204,25 @@ async def process_email_registration(message: Message, state: FSMContext):
 🎉 Теперь вы можете получать реферальную ссылку и приглашать друзей!"""
     
     await state.clear()
-    await message.answer(text, reply_markup=get_referral_main_keyboard(user_id))
+    await message.answer(text, reply_markup=get_referral_main_keyboard(referral_info))
 
 
 # Функция для добавления реферального бонуса (вызывается из payment handler)
 async def add_referral_bonus_if_needed(user_id: int):
-    """Добавляет реферальный бонус, если это первая оплата приглашенного пользователя"""
+    """
+    Добавляет реферальный бонус, если это первая оплата приглашенного пользователя.
+    Новый баланс реферера отправляется в GetCourse фоновой задачей пачкой
+    (background/referral_settlement.py), а не при каждом начислении.
+    """
     try:
         logger.info(f"Проверяем начисление реферального бонуса для пользователя {user_id}")
         
-        referral_info = db.get_referral_info(user_id)
-        if not referral_info or not referral_info['referrer_user_id']:
-            logger.info(f"Пользователь {user_id} не был приглашен по реферальной программе")
-            return  # Пользователь не был приглашен
-        
-        referrer_id = referral_info['referrer_user_id']
-        logger.info(f"Найден рефер {referrer_id} для пользователя {user_id}")
-        
-        # Проверяем, не начислялся ли уже бонус за этого пользователя
-        conn = db._Database__get_connection() if hasattr(db, '_Database__get_connection') else None
-        if not conn:
-            import sqlite3
-            conn = sqlite3.connect(db.db_path)
-        
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 1 FROM referral_bonuses 
-            WHERE referrer_user_id = ? AND referred_user_id = ?
-        ''', (referrer_id, user_id))
-        
-        if cursor.fetchone():
-            conn.close()
-            logger.info(f"Бонус уже был начислен реферу {referrer_id} за пользователя {user_id}")
-            return  # Бонус уже начислялся
-        
-        conn.close()
-        
-        # Начисляем бонус
-        logger.info(f"Начисляем бонус {REFERRAL_BONUS} руб. реферу {referrer_id} за пользователя {user_id}")
-        if db.add_referral_bonus(referrer_id, user_id, REFERRAL_BONUS):
-            logger.info(f"Бонус успешно начислен реферу {referrer_id}")
-            
-            # Отправляем обновленный баланс в GetCourse
-            referrer_info = db.get_referral_info(referrer_id)
-            if referrer_info and referrer_info['email']:
-                logger.info(f"Отправляем обновленный баланс в GetCourse для {referrer_info['email']}")
-                await send_referral_data_to_getcourse(
-                    referrer_info['email'], 
-                    referrer_info['referral_balance']
-                )
-            else:
-                logger.warning(f"Email не найден для рефера {referrer_id}")
-                
-        else:
-            logger.error(f"Ошибка начисления бонуса реферу {referrer_id}")
-            
-        logger.info(f"Завершено начисление реферального бонуса для пользователя {user_id}")
+        credit = db.credit_referral_bonus(user_id, REFERRAL_BONUS)
+        if credit:
+            logger.info(
+                f"Бонус {REFERRAL_BONUS} руб. начислен реферу {credit['referrer_user_id']} "
+                f"за пользователя {user_id}, баланс {credit['referral_balance']}"
+            )
         
     except Exception as e:
-        logger.error(f"Ошибка начисления реферального бонуса: {e}")
\ No newline at end of file
+        logger.error(f"Ошибка начисления реферального бонуса: {e}")
@@ -10,6 +10,7 @@ from services.utm_manager import parse_and_save_utm, is_video_already_sent, mark
 from background.auto_spam import update_user_activity, update_user_activity_start_only
 from utils.message_utils import answer_split_text
 from core.database import db
+from core.user_context import get_user_context
 
 logger = logging.getLogger(__name__)
 
@@ -68,17 +69,25 @@ async def start_handler(message: Message):
         
         if video_path:
             try:
-                video = FSInputFile(video_path)
+                # Повторно используем file_id, чтобы не загружать видео заново каждому пользователю
+                cached_file_id = db.get_media_file_id(video_path)
+                video = cached_file_id or FSInputFile(video_path)
                 # Отправляем как видеокружок (video note) вместо обычного видео
-                await message.answer_video_note(video, request_timeout=120)
+                sent = await message.answer_video_note(video, request_timeout=120)
+                if not cached_file_id and sent.video_note:
+                    db.save_media_file_id(video_path, sent.video_note.file_id, "video_note", os.path.getsize(video_path))
                 mark_video_as_sent(user_id)
                 logger.info(f"Видеокружок отправлен пользователю {user_id} при первом /start")
             except Exception as e:
                 # Если у пользователя отключены голосовые/видео сообщения, отправляем как обычное видео
                 if "VOICE_MESSAGES_FORBIDDEN" in str(e):
                     try:
-                        video = FSInputFile(video_path)
-                        await message.answer_video(video, request_timeout=120)
+                        video_key = f"{video_path}:video"
+                        cached_file_id = db.get_media_file_id(video_key)
+                        video = cached_file_id or FSInputFile(video_path)
+                        sent = await message.answer_video(video, request_timeout=120)
+                        if not cached_file_id and sent.video:
+                            db.save_media_file_id(video_key, sent.video.file_id, "video", os.path.getsize(video_path))
                         mark_video_as_sent(user_id)
                         logger.info(f"Видео отправлено как обычное видео пользователю {user_id} (видеокружки запрещены)")
                     except Exception as e2:
@@ -132,15 +141,18 @@ async def process_referral_link(user_id: int, referrer_id: int):
             return
         
         # Проверяем, не зарегистрирован ли уже пользователь с другим реферером
-        if db.is_referral_user_registered(user_id):
+        context = get_user_context(user_id)
+        if context is not None and context.is_fresh():
+            current_referral_info = context.referral
+        else:
             current_referral_info = db.get_referral_info(user_id)
-            if current_referral_info and current_referral_info['referrer_user_id']:
-                logger.info(f"Пользователь {user_id} уже имеет реферера {current_referral_info['referrer_user_id']}")
-                return
+        if current_referral_info and current_referral_info['referrer_user_id']:
+            logger.info(f"Пользователь {user_id} уже имеет реферера {current_referral_info['referrer_user_id']}")
+            return
         
         # Временно сохраняем информацию о реферере для пользователя
         # Полная регистрация произойдет, когда пользователь введет свой email
-        if not db.is_referral_user_registered(user_id):
+        if current_referral_info is None:
             # Создаем временную запись без email
             db.register_referral_user(user_id, "", referrer_id)
         else:
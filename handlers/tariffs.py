@@ -7,6 +7,7 @@ from core.config import TEXTS, IMAGES, TARIFF_BASIC_PRICE, TARIFF_VIP_PRICE, PER
 from background.auto_spam import update_user_activity
 from utils.message_utils import answer_split_text
 from core.database import db
+from core.user_context import get_user_context
 
 router = Router()
 
@@ -26,10 +27,11 @@ def get_price_with_referral_discount(user_id: int, original_price: int):
         return original_price, 0, False
     
     # Проверяем, есть ли у пользователя реферальный баланс
-    if not db.is_referral_user_registered(user_id):
-        return original_price, 0, False
-    
-    referral_info = db.get_referral_info(user_id)
+    context = get_user_context(user_id)
+    if context is not None and context.is_fresh():
+        referral_info = context.referral
+    else:
+        referral_info = db.get_referral_info(user_id)
     if not referral_info:
         return original_price, 0, False
     
@@ -1,119 +1,187 @@
+import time
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from services.utm_manager import get_payment_url_with_utm
+from utils.cache import LRUCache
+from core.config import TARIFF_BASIC_PRICE, TARIFF_VIP_PRICE, USER_STATE_CACHE_SIZE, USER_STATE_CACHE_TTL
 
-def get_main_menu(user_id=None):
-    """Главное меню"""
+# Снимок подписки и реферального баланса пользователя для построения клавиатур.
+# Запись действительна, пока не изменилась версия пользователя в БД (оплата, бонус, списание);
+# TTL нужен, чтобы подхватить окончание подписки, которое не меняет версию.
+_user_state_cache = LRUCache(maxsize=USER_STATE_CACHE_SIZE, ttl=USER_STATE_CACHE_TTL)
+
+# Меню тарифов, собранные для конкретного размера реферального баланса
+_tariffs_menu_cache = LRUCache(maxsize=1000)
+
+def _get_user_state(user_id: int) -> dict:
+    """
+    Возвращает подписку и реферальный баланс пользователя из кэша или БД
+
+    Args:
+        user_id: ID пользователя
+
+    Returns:
+        dict: {'subscribed': bool, 'referral_registered': bool, 'referral_balance': int}
+    """
+    from core.database import db
+    from core.user_context import get_user_context
+
+    version = db.get_user_version(user_id)
+    cached = _user_state_cache.get(user_id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    # Контекст апдейта уже загружен middleware - берем из него, если он не устарел
+    context = get_user_context(user_id)
+    if context is not None and context.version == version:
+        state = {
+            'subscribed': context.subscribed,
+            'referral_registered': context.referral_registered,
+            'referral_balance': context.referral_balance
+        }
+    else:
+        referral_info = db.get_referral_info(user_id)
+        state = {
+            'subscribed': db.is_user_subscribed(user_id),
+            'referral_registered': referral_info is not None,
+            'referral_balance': (referral_info or {}).get('referral_balance') or 0
+        }
+    _user_state_cache.set(user_id, (version, state))
+    return state
+
+def _build_main_menu(with_referral: bool) -> InlineKeyboardMarkup:
     # Базовые кнопки
     buttons = [
         [InlineKeyboardButton(text="ОФОРМИТЬ ПОДПИСКУ 🙌🏻", callback_data="subscribe")],
         [InlineKeyboardButton(text="Что такое онлайн-аватар 🤖", callback_data="what_is_avatar")],
     ]
-    
-    # Добавляем кнопку реферальной программы для всех пользователей с активной подпиской
-    if user_id:
-        from core.database import db
-        if db.is_user_subscribed(user_id):
-            buttons.append([InlineKeyboardButton(text="🎁 Реферальная программа", callback_data="referral_main")])
-    
+
+    # Кнопка реферальной программы для пользователей с активной подпиской
+    if with_referral:
+        buttons.append([InlineKeyboardButton(text="🎁 Реферальная программа", callback_data="referral_main")])
+
     # Последний ряд кнопок
     buttons.append([
         InlineKeyboardButton(text="Отдел заботы 💬", url="https://t.me/zabotasolo"),
         InlineKeyboardButton(text="Отменить подписку ❌", url="https://solotatiana.getcourse.ru/user/my/profile")
     ])
-    
+
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_avatar_info_menu():
-    """Меню информации об аватаре"""
+def _format_tariff_button(title: str, price: int, discount: int) -> str:
+    final_price = max(0, price - discount)
+    if final_price == 0:
+        return f"{title} - БЕСПЛАТНО 🎉"
+    elif discount > 0:
+        return f"{title} - {final_price:,} ₽ (-{discount} ₽)".replace(",", " ")
+    return f"{title} - {price:,} руб".replace(",", " ")
+
+def _build_tariffs_menu(balance: int = 0) -> InlineKeyboardMarkup:
+    # Скидка не больше цены товара
+    basic_text = _format_tariff_button("🌷 «Для себя»", TARIFF_BASIC_PRICE, min(balance, TARIFF_BASIC_PRICE))
+    vip_text = _format_tariff_button("🌟 «ВИП Жизнь»", TARIFF_VIP_PRICE, min(balance, TARIFF_VIP_PRICE))
+
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="ХОЧУ ДОСТУП ✨", callback_data="subscribe")],
-        [InlineKeyboardButton(text="С чем помогает онлайн-аватар 🫶🏻", callback_data="what_helps")],
+        [InlineKeyboardButton(text=basic_text, callback_data="tariff_basic")],
+        [InlineKeyboardButton(text=vip_text, callback_data="tariff_vip")],
+        [InlineKeyboardButton(text="💬 Отзывы", callback_data="reviews")],
         [InlineKeyboardButton(text="← Назад", callback_data="back_to_main")]
     ])
 
+# ===== СТАТИЧЕСКИЕ КЛАВИАТУРЫ (собираются один раз при импорте) =====
+
+MAIN_MENU = _build_main_menu(with_referral=False)
+MAIN_MENU_SUBSCRIBED = _build_main_menu(with_referral=True)
+TARIFFS_MENU = _build_tariffs_menu()
+
+AVATAR_INFO_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="ХОЧУ ДОСТУП ✨", callback_data="subscribe")],
+    [InlineKeyboardButton(text="С чем помогает онлайн-аватар 🫶🏻", callback_data="what_helps")],
+    [InlineKeyboardButton(text="← Назад", callback_data="back_to_main")]
+])
+
+HELPS_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="ОФОРМИТЬ ПОДПИСКУ 😍", callback_data="subscribe")],
+    [InlineKeyboardButton(text="Отзывы", callback_data="reviews")],
+    [InlineKeyboardButton(text="← Назад", callback_data="what_is_avatar")]
+])
+
+BACK_TO_TARIFFS_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="← К выбору тарифа", callback_data="subscribe")]
+])
+
+REVIEWS_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="ОФОРМИТЬ ПОДПИСКУ 😍", callback_data="subscribe")],
+    [InlineKeyboardButton(text="← Назад к тарифам", callback_data="subscribe")]
+])
+
+SUPPORT_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Написать в службу заботы", url="https://t.me/zabotasolo")],
+    [InlineKeyboardButton(text="← Назад", callback_data="back_to_main")]
+])
+
+DOCUMENTS_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📄 Политика конфиденциальности", url="https://solotatiana.getcourse.ru/privacysolo")],
+    [InlineKeyboardButton(text="📄 Согласие на рекламные материалы", url="https://solotatiana.getcourse.ru/agreement")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
+])
+
+KUPI_VIDEO_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✨ Выбрать Тариф", callback_data="subscribe")],
+    [InlineKeyboardButton(text="🔥 Служба Заботы", url="https://t.me/zabotasolo")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
+])
+
+# ===== ФУНКЦИИ ДЛЯ ИМПОРТА =====
+
+def get_main_menu(user_id=None):
+    """Главное меню"""
+    # Кнопка реферальной программы - для всех пользователей с активной подпиской
+    if user_id and _get_user_state(user_id)['subscribed']:
+        return MAIN_MENU_SUBSCRIBED
+    return MAIN_MENU
+
+def get_avatar_info_menu():
+    """Меню информации об аватаре"""
+    return AVATAR_INFO_MENU
+
 def get_helps_menu():
     """Меню возможностей"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="ОФОРМИТЬ ПОДПИСКУ 😍", callback_data="subscribe")],
-        [InlineKeyboardButton(text="Отзывы", callback_data="reviews")],
-        [InlineKeyboardButton(text="← Назад", callback_data="what_is_avatar")]
-    ])
+    return HELPS_MENU
 
 def get_tariffs_menu(user_id=None):
     """Меню выбора тарифа"""
-    # Базовые цены
-    basic_price = 5555
-    vip_price = 7777
-    
-    # Если передан user_id, проверяем реферальный баланс
-    if user_id:
-        from core.database import db
-        
-        if db.is_user_subscribed(user_id) and db.is_referral_user_registered(user_id):
-            referral_info = db.get_referral_info(user_id)
-            if referral_info and referral_info['referral_balance'] > 0:
-                balance = referral_info['referral_balance']
-                
-                # Вычисляем цены со скидкой
-                basic_discount = min(balance, basic_price)
-                vip_discount = min(balance, vip_price)
-                
-                basic_final = max(0, basic_price - basic_discount)
-                vip_final = max(0, vip_price - vip_discount)
-                
-                # Форматируем текст кнопок с учетом скидки
-                if basic_final == 0:
-                    basic_text = "🌷 «Для себя» - БЕСПЛАТНО 🎉"
-                elif basic_discount > 0:
-                    basic_text = f"🌷 «Для себя» - {basic_final:,} ₽ (-{basic_discount} ₽)".replace(",", " ")
-                else:
-                    basic_text = f"🌷 «Для себя» - {basic_price:,} руб".replace(",", " ")
-                
-                if vip_final == 0:
-                    vip_text = "🌟 «ВИП Жизнь» - БЕСПЛАТНО 🎉"
-                elif vip_discount > 0:
-                    vip_text = f"🌟 «ВИП Жизнь» - {vip_final:,} ₽ (-{vip_discount} ₽)".replace(",", " ")
-                else:
-                    vip_text = f"🌟 «ВИП Жизнь» - {vip_price:,} руб".replace(",", " ")
-            else:
-                basic_text = f"🌷 «Для себя» - {basic_price:,} руб".replace(",", " ")
-                vip_text = f"🌟 «ВИП Жизнь» - {vip_price:,} руб".replace(",", " ")
-        else:
-            basic_text = f"🌷 «Для себя» - {basic_price:,} руб".replace(",", " ")
-            vip_text = f"🌟 «ВИП Жизнь» - {vip_price:,} руб".replace(",", " ")
-    else:
-        basic_text = f"🌷 «Для себя» - {basic_price:,} руб".replace(",", " ")
-        vip_text = f"🌟 «ВИП Жизнь» - {vip_price:,} руб".replace(",", " ")
-    
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=basic_text, callback_data="tariff_basic")],
-        [InlineKeyboardButton(text=vip_text, callback_data="tariff_vip")],
-        [InlineKeyboardButton(text="💬 Отзывы", callback_data="reviews")],
-        [InlineKeyboardButton(text="← Назад", callback_data="back_to_main")]
-    ])
+    if not user_id:
+        return TARIFFS_MENU
+
+    # Скидка показывается подписчикам, зарегистрированным в реферальной программе
+    state = _get_user_state(user_id)
+    balance = state['referral_balance']
+    if not (state['subscribed'] and state['referral_registered']) or balance <= 0:
+        return TARIFFS_MENU
+
+    menu = _tariffs_menu_cache.get(balance)
+    if menu is None:
+        menu = _build_tariffs_menu(balance)
+        _tariffs_menu_cache.set(balance, menu)
+    return menu
 
 def get_tariff_confirm_menu(tariff_type, user_id=None):
     """Меню подтверждения тарифа с UTM метками пользователя"""
-    import time
-    
     # Получаем реферальный баланс пользователя для включения в payment_id
     referral_discount = 0
     if user_id:
         try:
-            from core.database import db
-            referral_info = db.get_referral_info(user_id)
-            if referral_info and referral_info.get('referral_balance', 0) > 0:
-                referral_discount = referral_info['referral_balance']
+            referral_discount = max(0, _get_user_state(user_id)['referral_balance'])
         except:
             referral_discount = 0
-    
+
     # Генерируем идентификатор платежа с информацией о скидке
     if user_id:
         timestamp = int(time.time())
         payment_id = f"bot_{user_id}_{tariff_type}_{referral_discount}_{timestamp}"
     else:
         payment_id = f"bot_unknown_{tariff_type}_0_{int(time.time())}"
-    
+
     # Определяем базовую ссылку и текст кнопки
     if tariff_type == "basic":
         button_text = "👉 ОФОРМИТЬ ТАРИФ"
@@ -121,14 +189,14 @@ def get_tariff_confirm_menu(tariff_type, user_id=None):
     else:
         button_text = "👉 ОФОРМИТЬ ВИП"
         base_url = "https://solotatiana.getcourse.ru/avatarvip"
-    
+
     # Строим ссылку с UTM метками пользователя
     if user_id:
         url = get_payment_url_with_utm(user_id, base_url, payment_id)
     else:
         # Fallback для случаев без user_id
         url = f"{base_url}?id={payment_id}&utm_source=telegram_bot&utm_medium=button&utm_campaign=avatarai"
-    
+
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=button_text, url=url)],
         [InlineKeyboardButton(text="Получить помощь 💬", url="https://t.me/zabotasolo")],
@@ -137,36 +205,20 @@ def get_tariff_confirm_menu(tariff_type, user_id=None):
 
 def get_back_to_tariffs():
     """Кнопка назад к тарифам"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="← К выбору тарифа", callback_data="subscribe")]
-    ])
+    return BACK_TO_TARIFFS_MENU
 
 def get_reviews_menu():
     """Меню отзывов"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="ОФОРМИТЬ ПОДПИСКУ 😍", callback_data="subscribe")],
-        [InlineKeyboardButton(text="← Назад к тарифам", callback_data="subscribe")]
-    ])
+    return REVIEWS_MENU
 
 def get_support_menu():
     """Меню поддержки"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Написать в службу заботы", url="https://t.me/zabotasolo")],
-        [InlineKeyboardButton(text="← Назад", callback_data="back_to_main")]
-    ])
+    return SUPPORT_MENU
 
 def get_documents_menu():
     """Меню с документами после оплаты"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📄 Политика конфиденциальности", url="https://solotatiana.getcourse.ru/privacysolo")],
-        [InlineKeyboardButton(text="📄 Согласие на рекламные материалы", url="https://solotatiana.getcourse.ru/agreement")],
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
-    ])
+    return DOCUMENTS_MENU
 
 def get_kupi_video_menu():
     """Меню для купи-видео"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✨ Выбрать Тариф", callback_data="subscribe")],
-        [InlineKeyboardButton(text="🔥 Служба Заботы", url="https://t.me/zabotasolo")],
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
-    ])
\ No newline at end of file
+    return KUPI_VIDEO_MENU
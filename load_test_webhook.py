@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест приема апдейтов через webhook
+
+Отправляет синтетические апдейты (текстовые сообщения от разных пользователей) POST-запросами
+и измеряет, сколько апдейтов в секунду принимается и обрабатывается.
+
+Запускать:
+    python3 load_test_webhook.py --local
+        поднимает прием апдейтов в этом же процессе с хендлером-заглушкой (без Telegram и OpenAI)
+    python3 load_test_webhook.py --url http://127.0.0.1:8080/webhook/telegram --secret <WEBHOOK_SECRET>
+        нагружает запущенный бот; апдейты проходят через настоящие хендлеры, поэтому
+        использовать только с тестовым ботом и тестовой базой
+"""
+
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher, Router
+
+from core.config import WEBHOOK_CONCURRENCY, WEBHOOK_QUEUE_SIZE, TELEGRAM_WEBHOOK_PATH
+from core.update_intake import UpdateIntake, SECRET_HEADER
+
+LOCAL_HOST = "127.0.0.1"
+LOCAL_PORT = 8099
+LOCAL_SECRET = "load-test-secret"
+FIRST_USER_ID = 10 ** 9
+
+
+def build_update(update_id: int, users: int) -> dict:
+    """Синтетический апдейт: текстовое сообщение в личном чате"""
+    user_id = FIRST_USER_ID + update_id % users
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Нагрузка"},
+            "text": f"Нагрузочный тест, сообщение {update_id}",
+        },
+    }
+
+
+async def start_local_intake(args) -> tuple:
+    """Прием апдейтов с хендлером, имитирующим работу бота задержкой"""
+    bot = Bot(token="123456:LOAD-TEST")
+    dp = Dispatcher()
+    router = Router()
+
+    @router.message()
+    async def fake_handler(message):
+        await asyncio.sleep(args.handler_delay)
+
+    dp.include_router(router)
+
+    intake = UpdateIntake(bot, dp, secret=LOCAL_SECRET, concurrency=args.concurrency_limit,
+                          queue_size=args.queue_size, enqueue_timeout=args.enqueue_timeout)
+    intake.start()
+
+    app = web.Application()
+    app.router.add_post(TELEGRAM_WEBHOOK_PATH, intake.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, LOCAL_HOST, LOCAL_PORT).start()
+    return intake, runner, bot
+
+
+async def post_updates(url: str, secret: str, total: int, connections: int, users: int) -> tuple:
+    """
+    Отправляет total апдейтов не более чем в connections соединений
+
+    Returns:
+        tuple: (Counter HTTP статусов, список задержек ответа в секундах)
+    """
+    statuses = Counter()
+    latencies = []
+    next_id = iter(range(1, total + 1))
+    headers = {SECRET_HEADER: secret} if secret else {}
+
+    async def client(session: aiohttp.ClientSession):
+        for update_id in next_id:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=build_update(update_id, users), headers=headers) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+            except aiohttp.ClientError:
+                statuses["ошибка соединения"] += 1
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(client(session) for _ in range(connections)))
+
+    return statuses, latencies
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+async def run(args):
+    intake = runner = bot = None
+    url, secret = args.url, args.secret
+    if args.local:
+        intake, runner, bot = await start_local_intake(args)
+        url, secret = f"http://{LOCAL_HOST}:{LOCAL_PORT}{TELEGRAM_WEBHOOK_PATH}", LOCAL_SECRET
+
+    print("📊 НАГРУЗОЧНЫЙ ТЕСТ WEBHOOK")
+    print("=" * 50)
+    print(f"Адрес: {url}")
+    print(f"Апдейтов: {args.total}, соединений: {args.connections}, пользователей: {args.users}")
+
+    started = time.perf_counter()
+    statuses, latencies = await post_updates(url, secret, args.total, args.connections, args.users)
+    sent_elapsed = time.perf_counter() - started
+
+    print(f"Отправлено за {sent_elapsed:.2f} с: {args.total / sent_elapsed:.0f} апдейтов/с")
+    print(f"Ответы: {dict(statuses)}")
+    print(
+        f"Задержка ответа: p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+        f"p95 {percentile(latencies, 0.95) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms"
+    )
+
+    if intake is not None:
+        await intake.queue.join()
+        processed_elapsed = time.perf_counter() - started
+        print(
+            f"Обработано за {processed_elapsed:.2f} с: "
+            f"{intake.stats['processed'] / processed_elapsed:.0f} апдейтов/с"
+        )
+        await intake.stop()
+        print(intake.format_stats())
+        await runner.cleanup()
+        await bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест приема апдейтов через webhook")
+    parser.add_argument("--local", action="store_true", help="поднять прием апдейтов в этом процессе")
+    parser.add_argument("--url", default=f"http://{LOCAL_HOST}:8080{TELEGRAM_WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=None, help="WEBHOOK_SECRET запущенного бота")
+    parser.add_argument("--total", type=int, default=5000, help="сколько апдейтов отправить")
+    parser.add_argument("--connections", type=int, default=40, help="одновременных соединений (как max_connections)")
+    parser.add_argument("--users", type=int, default=500, help="сколько разных пользователей")
+    parser.add_argument("--handler-delay", type=float, default=0.05, help="--local: время работы хендлера, с")
+    parser.add_argument("--concurrency-limit", type=int, default=WEBHOOK_CONCURRENCY, help="--local: WEBHOOK_CONCURRENCY")
+    parser.add_argument("--queue-size", type=int, default=WEBHOOK_QUEUE_SIZE, help="--local: WEBHOOK_QUEUE_SIZE")
+    parser.add_argument("--enqueue-timeout", type=float, default=5, help="--local: WEBHOOK_ENQUEUE_TIMEOUT")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
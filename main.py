@@ -5,19 +5,40 @@ from pathlib import Path
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-import threading
-from flask import Flask, request, jsonify
+from aiohttp import web
 import requests
 from datetime import datetime
 from collections import defaultdict
 import time
 
-from core.config import BOT_TOKEN, ADMIN_IDS
+from core.config import (
+    BOT_TOKEN, ADMIN_IDS, BOT_MODE, WEBHOOK_BASE_URL, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    TELEGRAM_WEBHOOK_PATH, WEBHOOK_MAX_CONNECTIONS
+)
 from handlers import start, info, tariffs, support, payment, subscription, ai_chat, referral, news
 from background.auto_spam import start_auto_spam_task
 from core.database import init_db, db
+from core.telegram_sender import telegram_sender, PRIORITY_NOTIFICATION
+from core.update_intake import UpdateIntake
+from core.fsm_storage import SQLiteStorage
+from middlewares.throttling import ai_throttling
+from services.usage_ledger import usage_ledger
+from middlewares.users import UserTrackingMiddleware
+from middlewares.user_context import UserContextMiddleware
+from services.transcription import transcription_pool
+from services.answer_cache import answer_cache
+from core.thread_pool import thread_pool
+from services.context_budget import context_budget
+from core.openai_client import openai_client
 from background.kupi_video import kupi_video_background_task
 from background.daily_thread_reset import daily_thread_reset_task
+from background.thread_pool import thread_pool_background_task
+from background.thread_gc import thread_gc_background_task
+from background.segment_counters import segment_reconcile_background_task
+from background.subscription_expiry import subscription_expiry_task
+from background.referral_settlement import referral_settlement_background_task
+from background.openai_usage import openai_usage_flush_task
+from core.expiry_scheduler import expiry_scheduler
 
 # Настройка логирования - только критические ошибки
 logging.basicConfig(
@@ -34,27 +55,6 @@ logger = logging.getLogger(__name__)
 
 # =================== WEBHOOK SERVER ===================
 
-# Подавляем лишние логи от werkzeug (Flask)
-class NoBotsLogFilter(logging.Filter):
-    def filter(self, record):
-        if hasattr(record, 'getMessage'):
-            message = record.getMessage()
-            if '404' in message and any(path in message for path in 
-                ['GET /', 'GET /favicon.ico', 'GET /login', 'GET /signin', 'GET /admin']):
-                return False
-            if 'Bad request' in message and ('À' in message or 'SSH-2.0' in message):
-                return False
-            if 'HTTP/2.0' in message:
-                return False
-        return True
-
-# Применяем фильтр к werkzeug logger
-werkzeug_logger = logging.getLogger('werkzeug')
-werkzeug_logger.addFilter(NoBotsLogFilter())
-werkzeug_logger.setLevel(logging.ERROR)
-
-app = Flask(__name__)
-
 # Rate limiting
 request_counts = defaultdict(list)
 RATE_LIMIT_REQUESTS = 10
@@ -111,6 +111,18 @@ def extract_user_id_from_webhook_data(data):
     return None, None
 
 def send_telegram_message(user_id, message):
+    # Если бот запущен - отправляем через общий диспетчер исходящих запросов
+    if telegram_sender.is_running():
+        try:
+            telegram_sender.run_threadsafe(
+                telegram_sender.bot.send_message(user_id, message, parse_mode="HTML"),
+                priority=PRIORITY_NOTIFICATION
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
+            return False
+    
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
     data = {
         "chat_id": user_id,
@@ -124,7 +136,21 @@ def send_telegram_message(user_id, message):
         logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
         return False
 
+def _format_user_info(user_id, username, first_name, last_name):
+    if username:
+        return f"@{username}"
+    elif first_name or last_name:
+        return f"{first_name or ''} {last_name or ''}".strip()
+    return f"ID: {user_id}"
+
 def get_user_info(user_id):
+    if telegram_sender.is_running():
+        try:
+            chat = telegram_sender.run_threadsafe(telegram_sender.bot.get_chat(user_id), timeout=5)
+            return _format_user_info(user_id, chat.username, chat.first_name, chat.last_name)
+        except Exception:
+            return f"ID: {user_id}"
+    
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/getChat"
     data = {"chat_id": user_id}
     try:
@@ -132,22 +158,25 @@ def get_user_info(user_id):
         if response.status_code == 200:
             result = response.json()
             user_data = result.get("result", {})
-            username = user_data.get("username")
-            first_name = user_data.get("first_name", "")
-            last_name = user_data.get("last_name", "")
-            if username:
-                return f"@{username}"
-            elif first_name or last_name:
-                return f"{first_name} {last_name}".strip()
+            return _format_user_info(
+                user_id,
+                user_data.get("username"),
+                user_data.get("first_name", ""),
+                user_data.get("last_name", "")
+            )
         return f"ID: {user_id}"
     except:
         return f"ID: {user_id}"
 
-@app.route('/webhook/getcourse', methods=['POST'])
-def getcourse_webhook():
-    print(f"WEBHOOK: Получен запрос: {request.method} {request.url}")
+def process_getcourse_webhook(data):
+    """
+    Обработка оплаты из вебхука GetCourse.
+    Выполняется в потоке исполнителя: отправка уведомлений ждет результата из event loop бота.
+    
+    Returns:
+        tuple: (тело ответа, HTTP статус)
+    """
     try:
-        data = request.get_json()
         print(f"WEBHOOK: Данные - {data}")
         user_id, payment_id = extract_user_id_from_webhook_data(data)
         
@@ -224,39 +253,95 @@ def getcourse_webhook():
                 except Exception as e:
                     logger.error(f"Ошибка реферальных бонусов: {e}")
                 
-                return jsonify({"status": "success", "message": "Подписка сохранена"})
+                return {"status": "success", "message": "Подписка сохранена"}, 200
         
-        return jsonify({"status": "ignored", "message": "No valid payment data"})
+        return {"status": "ignored", "message": "No valid payment data"}, 200
         
     except Exception as e:
         logger.error(f"Ошибка webhook: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return {"status": "error", "message": str(e)}, 500
 
-@app.route('/', methods=['GET'])
-def index():
-    client_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+async def getcourse_webhook(request):
+    print(f"WEBHOOK: Получен запрос: {request.method} {request.path_qs}")
+    try:
+        data = await request.json()
+    except Exception as e:
+        logger.error(f"Ошибка webhook: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+    
+    loop = asyncio.get_running_loop()
+    result, status = await loop.run_in_executor(None, process_getcourse_webhook, data)
+    return web.json_response(result, status=status)
+
+async def index(request):
+    client_ip = request.headers.get('X-Real-IP', request.remote)
     if is_rate_limited(client_ip):
-        return jsonify({"error": "Rate limit exceeded"}), 429
-    return jsonify({
+        return web.json_response({"error": "Rate limit exceeded"}, status=429)
+    return web.json_response({
         "service": "Tatyana Solo Bot",
         "status": "running"
     })
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({"status": "ok"})
+async def health_check(request):
+    return web.json_response({"status": "ok"})
 
-@app.errorhandler(404)
-def not_found(error):
-    return jsonify({"error": "Not found"}), 404
+@web.middleware
+async def json_not_found(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        return web.json_response({"error": "Not found"}, status=404)
 
-def run_webhook_server():
-    """Запуск webhook сервера в отдельном потоке"""
+def create_web_app(intake: UpdateIntake = None) -> web.Application:
+    """
+    aiohttp-приложение: вебхук GetCourse и, в режиме webhook, прием апдейтов Telegram
+    
+    Args:
+        intake: очередь апдейтов Telegram (None - апдейты получаются polling'ом)
+    """
+    app = web.Application(middlewares=[json_not_found])
+    app.router.add_post('/webhook/getcourse', getcourse_webhook)
+    app.router.add_get('/', index)
+    app.router.add_get('/health', health_check)
+    if intake is not None:
+        app.router.add_post(TELEGRAM_WEBHOOK_PATH, intake.handle)
+    return app
+
+async def start_web_server(app: web.Application) -> web.AppRunner:
+    """Запускает aiohttp-сервер в текущем event loop"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    print(f"Webhook сервер запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    return runner
+
+async def setup_telegram_webhook(bot: Bot, dp: Dispatcher) -> bool:
+    """
+    Регистрирует webhook в Telegram
+    
+    Returns:
+        bool: True, если webhook установлен; иначе бот работает через polling
+    """
+    if not WEBHOOK_BASE_URL:
+        print("⚠️  BOT_MODE=webhook, но WEBHOOK_BASE_URL не задан - используется polling")
+        return False
+    
+    url = WEBHOOK_BASE_URL.rstrip('/') + TELEGRAM_WEBHOOK_PATH
     try:
-        print("Webhook сервер стартует на 0.0.0.0:8080")
-        app.run(host='0.0.0.0', port=8080, debug=False)
+        await bot.set_webhook(
+            url=url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
     except Exception as e:
-        print(f"ОШИБКА webhook сервера: {e}")
+        logger.error(f"Не удалось установить webhook {url}: {e}")
+        print(f"⚠️  Не удалось установить webhook ({e}) - используется polling")
+        return False
+    
+    print(f"Telegram webhook установлен: {url}")
+    return True
 
 # =================== END WEBHOOK SERVER ===================
 
@@ -283,6 +368,9 @@ async def system_check():
     # Проверка базы данных
     try:
         init_db()
+        # Загружаем отметки об отправленном стартовом видео
+        from services.utm_manager import load_video_sent_users
+        load_video_sent_users()
         # Проверяем информацию о последнем сбросе тредов
         reset_info = db.get_last_reset_info()
         if reset_info:
@@ -322,6 +410,29 @@ async def system_check():
         print("Все системные проверки пройдены успешно")
         return True
 
+def create_dispatcher() -> Dispatcher:
+    """Диспетчер со всеми роутерами бота (общий для обычного и многопроцессного режима)"""
+    # Состояния FSM хранятся в БД и переживают перезапуск
+    dp = Dispatcher(storage=SQLiteStorage())
+    
+    # Учет пользователей в таблице users (до роутеров, для любых апдейтов)
+    dp.update.outer_middleware(UserTrackingMiddleware())
+    dp.update.outer_middleware(UserContextMiddleware())
+    
+    # Подключение роутеров
+    dp.include_router(start.router)
+    dp.include_router(info.router)
+    dp.include_router(tariffs.router)
+    dp.include_router(support.router)
+    dp.include_router(payment.router)
+    dp.include_router(subscription.router)
+    dp.include_router(referral.router)
+    dp.include_router(news.router)  # Админ панель для рассылки новостей
+    # AI чат должен быть последним, чтобы перехватывать все остальные сообщения
+    dp.include_router(ai_chat.router)
+    
+    return dp
+
 async def main():
     """Основная функция запуска бота"""
     
@@ -336,30 +447,28 @@ async def main():
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
     
+    # Все исходящие запросы идут через общий диспетчер с лимитами Telegram
+    telegram_sender.attach(bot)
+    
     # Инициализация диспетчера
-    dp = Dispatcher()
+    dp = create_dispatcher()
     
-    # Подключение роутеров
-    dp.include_router(start.router)
-    dp.include_router(info.router)
-    dp.include_router(tariffs.router)
-    dp.include_router(support.router)
-    dp.include_router(payment.router)
-    dp.include_router(subscription.router)
-    dp.include_router(referral.router)
-    dp.include_router(news.router)  # Админ панель для рассылки новостей
-    # AI чат должен быть последним, чтобы перехватывать все остальные сообщения
-    dp.include_router(ai_chat.router)
+    # Прием апдейтов через webhook, если он включен; polling остается запасным вариантом
+    intake = UpdateIntake(bot, dp) if BOT_MODE == "webhook" else None
     
-    # Запуск webhook сервера в отдельном потоке
-    webhook_thread = threading.Thread(target=run_webhook_server, daemon=True)
-    webhook_thread.start()
-    print("Webhook сервер запущен на порту 8080")
+    # Запуск webhook сервера (GetCourse и Telegram) в event loop бота
+    web_runner = await start_web_server(create_web_app(intake))
     
     # Запуск фоновых задач
     auto_spam_task = asyncio.create_task(start_auto_spam_task(bot))
     kupi_video_task = asyncio.create_task(kupi_video_background_task(bot))
     daily_reset_task = asyncio.create_task(daily_thread_reset_task())
+    thread_gc_task = asyncio.create_task(thread_gc_background_task())
+    thread_pool_task = asyncio.create_task(thread_pool_background_task())
+    segment_task = asyncio.create_task(segment_reconcile_background_task())
+    expiry_task = asyncio.create_task(subscription_expiry_task(bot))
+    referral_task = asyncio.create_task(referral_settlement_background_task())
+    usage_task = asyncio.create_task(openai_usage_flush_task())
     
     # Выводим информацию о следующем сбросе
     from background.daily_thread_reset import get_next_reset_time
@@ -367,9 +476,24 @@ async def main():
     print(f"⏰ Следующий сброс тредов: {next_reset.strftime('%Y-%m-%d %H:%M %Z')}")
     
     # Запуск бота
-    print("Telegram бот запущен и работает...")
     try:
-        await dp.start_polling(bot)
+        if intake is not None:
+            intake.start()
+            if not await setup_telegram_webhook(bot, dp):
+                await intake.stop()
+                intake = None
+        
+        if intake is not None:
+            print("Telegram бот запущен и работает (webhook)...")
+            await asyncio.Event().wait()
+        else:
+            # Оставшийся от режима webhook вебхук не дает получать апдейты через getUpdates
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                logger.error(f"Не удалось удалить webhook: {e}")
+            print("Telegram бот запущен и работает (polling)...")
+            await dp.start_polling(bot)
     except KeyboardInterrupt:
         print("Бот остановлен пользователем")
     except Exception as e:
@@ -380,6 +504,12 @@ async def main():
         auto_spam_task.cancel()
         kupi_video_task.cancel()
         daily_reset_task.cancel()
+        thread_gc_task.cancel()
+        thread_pool_task.cancel()
+        segment_task.cancel()
+        expiry_task.cancel()
+        referral_task.cancel()
+        usage_task.cancel()
         try:
             await auto_spam_task
         except asyncio.CancelledError:
@@ -392,6 +522,46 @@ async def main():
             await daily_reset_task
         except asyncio.CancelledError:
             pass
+        try:
+            await thread_gc_task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await thread_pool_task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await segment_task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await expiry_task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await referral_task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await usage_task
+        except asyncio.CancelledError:
+            pass
+        if intake is not None:
+            await intake.stop()
+            print(intake.format_stats())
+        await web_runner.cleanup()
+        await dp.storage.close()
+        print(dp.storage.format_stats())
+        await transcription_pool.stop()
+        print(transcription_pool.format_stats())
+        print(answer_cache.format_stats())
+        print(thread_pool.format_stats())
+        print(context_budget.format_stats())
+        print(expiry_scheduler.format_stats())
+        print(ai_throttling.format_stats())
+        print(usage_ledger.format_stats())
+        print(openai_client.format_poll_stats())
+        print(telegram_sender.format_stats())
         await bot.session.close()
         print("Бот остановлен")
 
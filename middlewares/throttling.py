@@ -0,0 +1,134 @@
+"""
+Ограничение частоты сообщений ИИ-чату
+
+Каждое текстовое, голосовое или аудио сообщение подписчика запускает run ассистента
+OpenAI (и Whisper для аудио), поэтому один пользователь, присылающий сообщения
+без остановки, расходует лимиты организации за всех. Middleware роутера ИИ-чата
+пропускает не больше AI_RATE_LIMITS[тариф] сообщений за скользящее окно и ограничивает
+число одновременно обрабатываемых сообщений, а также проверяет дневную квоту тарифа
+(services/usage_ledger.py, если включена OPENAI_QUOTAS_ENABLED). Отклоненное сообщение не доходит до хендлера и OpenAI;
+пользователь получает ласковое сообщение о паузе (не чаще раза за паузу).
+"""
+import heapq
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject, User
+
+from core.config import (
+    AI_RATE_LIMITS, AI_RATE_LIMIT_DEFAULT, AI_THROTTLE_CACHE_SIZE, PERMANENT_ACCESS_IDS, TEXTS
+)
+from core.database import db
+from services.usage_ledger import usage_ledger, QUOTA_AUDIO
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Как часто повторять сообщение "еще думаю над предыдущим", секунд
+BUSY_NOTICE_INTERVAL = 15
+
+
+class AIThrottlingMiddleware(BaseMiddleware):
+    """
+    Скользящее окно и лимит одновременных сообщений на пользователя по тарифу
+    """
+
+    def __init__(self, limits: dict = AI_RATE_LIMITS, cache_size: int = AI_THROTTLE_CACHE_SIZE):
+        self.limits = limits
+        window = max(limit["window"] for limit in limits.values())
+        # user_id -> deque моментов (time.monotonic) принятых сообщений за окно
+        self.history = LRUCache(maxsize=cache_size, ttl=window)
+        # user_id -> до какого момента не повторять сообщение о паузе
+        self.notified = LRUCache(maxsize=cache_size, ttl=window)
+        self.active = {}
+        # user_id -> число отклоненных сообщений (для отчета о самых частых нарушителях)
+        self.rejections = LRUCache(maxsize=cache_size)
+        self.stats = {"passed": 0, "rate_limited": 0, "busy": 0, "quota": 0}
+
+    def _tariff_for(self, user_id: int, data: Dict[str, Any]) -> Optional[str]:
+        """Тариф пользователя или None, если ограничивать не нужно"""
+        if user_id in PERMANENT_ACCESS_IDS:
+            return None
+        context = data.get("user_context")
+        subscription = context.subscription if context is not None else db.get_user_subscription(user_id) or {}
+        if not subscription.get('is_active'):
+            return None  # Без подписки хендлер ответит сам, не обращаясь к OpenAI
+        return subscription.get('tariff_type') or AI_RATE_LIMIT_DEFAULT
+
+    async def _reject(self, message: Message, user_id: int, reason: str, text: str, pause: float):
+        self.stats[reason] += 1
+        rejections = self.rejections.get(user_id, 0) + 1
+        self.rejections.set(user_id, rejections)
+        logger.info(f"Сообщение ИИ-чату от {user_id} отклонено ({reason}), отклонений: {rejections}")
+
+        now = time.monotonic()
+        notified_until = self.notified.get(user_id)
+        if notified_until is not None and now < notified_until:
+            return
+        self.notified.set(user_id, now + pause)
+        try:
+            await message.answer(text)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сообщение о паузе пользователю {user_id}: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User = data.get("event_from_user")
+        # Фото и прочее не уходит в OpenAI - не ограничиваем
+        if user is None or not isinstance(event, Message) or not (event.text or event.voice or event.audio):
+            return await handler(event, data)
+
+        tariff_type = self._tariff_for(user.id, data)
+        if tariff_type is None:
+            return await handler(event, data)
+        limits = self.limits.get(tariff_type, self.limits[AI_RATE_LIMIT_DEFAULT])
+
+        exceeded = usage_ledger.quota_exceeded(user.id, tariff_type, audio=bool(event.voice or event.audio))
+        if exceeded:
+            text = TEXTS["ai_audio_quota_exceeded"] if exceeded == QUOTA_AUDIO else TEXTS["ai_quota_exceeded"]
+            return await self._reject(event, user.id, "quota", text, limits["window"])
+
+        now = time.monotonic()
+        history = self.history.get(user.id) or deque()
+        while history and now - history[0] >= limits["window"]:
+            history.popleft()
+
+        if len(history) >= limits["messages"]:
+            pause = limits["window"] - (now - history[0])
+            text = TEXTS["ai_rate_limited"].format(seconds=math.ceil(pause))
+            return await self._reject(event, user.id, "rate_limited", text, pause)
+        if self.active.get(user.id, 0) >= limits["concurrency"]:
+            return await self._reject(event, user.id, "busy", TEXTS["ai_busy"], BUSY_NOTICE_INTERVAL)
+
+        history.append(now)
+        self.history.set(user.id, history)
+        self.active[user.id] = self.active.get(user.id, 0) + 1
+        self.stats["passed"] += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.active[user.id] -= 1
+            if not self.active[user.id]:
+                del self.active[user.id]
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по ограничению частоты"""
+        most_rejected = heapq.nlargest(5, self.rejections.items(), key=lambda item: item[1])
+        top = ", ".join(f"{user_id}: {count}" for user_id, count in most_rejected)
+        return (
+            f"🚦 ИИ-чат: пропущено {self.stats['passed']}, отклонено по частоте {self.stats['rate_limited']}, "
+            f"пока занят {self.stats['busy']}, по дневной квоте {self.stats['quota']}; "
+            f"чаще всех отклонены: {top or 'нет'}"
+        )
+
+
+# Общий экземпляр для роутера ИИ-чата
+ai_throttling = AIThrottlingMiddleware()
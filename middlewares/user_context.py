@@ -0,0 +1,45 @@
+"""
+Загрузка контекста пользователя на время апдейта
+
+Контекст передается хендлерам параметром user_context и доступен клавиатурам
+через core.user_context.get_user_context. Отложенные записи выполняются после хендлера.
+"""
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from core.user_context import UserContext, current_user_context
+
+logger = logging.getLogger(__name__)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Один запрос к БД на апдейт вместо отдельных проверок в хендлерах и клавиатурах
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User = data.get("event_from_user")
+        if user is None or user.is_bot:
+            return await handler(event, data)
+
+        try:
+            context = UserContext.load(user.id)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки контекста пользователя {user.id}: {e}")
+            return await handler(event, data)
+
+        data["user_context"] = context
+        token = current_user_context.set(context)
+        try:
+            return await handler(event, data)
+        finally:
+            current_user_context.reset(token)
+            context.flush()
@@ -0,0 +1,52 @@
+"""
+Учет пользователей в каноничной таблице users
+
+Outer-middleware диспетчера добавляет пользователя при первом апдейте и обновляет
+last_seen. Чтобы не писать в БД на каждый апдейт, недавно отмеченные пользователи
+запоминаются в памяти на USER_TOUCH_INTERVAL. Пользователь, снова написавший боту,
+больше не считается заблокировавшим его.
+"""
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+
+from core.config import USER_TOUCH_INTERVAL, USER_TOUCH_CACHE_SIZE
+from core.database import db
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class UserTrackingMiddleware(BaseMiddleware):
+    """
+    Upsert пользователя в users при первом обращении и периодическое обновление last_seen
+    """
+
+    def __init__(self, touch_interval: float = USER_TOUCH_INTERVAL, cache_size: int = USER_TOUCH_CACHE_SIZE):
+        self.recent = LRUCache(maxsize=cache_size, ttl=touch_interval)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User = data.get("event_from_user")
+        if user is not None and not user.is_bot and user.id not in self.recent:
+            try:
+                db.touch_user(user.id, user.username, user.first_name)
+                self.recent.set(user.id, True)
+            except Exception as e:
+                logger.error(f"Ошибка учета пользователя {user.id}: {e}")
+
+        # my_chat_member приходит и при самой блокировке - снимаем ее только по другим апдейтам
+        if (user is not None and not user.is_bot and db.is_user_blocked(user.id)
+                and not (isinstance(event, Update) and event.my_chat_member)):
+            try:
+                db.unblock_user(user.id)
+            except Exception as e:
+                logger.error(f"Ошибка снятия блокировки пользователя {user.id}: {e}")
+
+        return await handler(event, data)
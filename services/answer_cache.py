@@ -0,0 +1,251 @@
+"""
+Кэш ответов ассистента на похожие вопросы
+
+Вопрос нормализуется и разбивается на символьные 3-граммы. По ним строится MinHash сигнатура,
+а LSH индекс (полосы сигнатуры) находит кандидатов без перебора всех записей. Кандидат
+принимается, только если точное сходство Жаккара не ниже ANSWER_CACHE_SIMILARITY.
+Записи живут ANSWER_CACHE_TTL и хранятся отдельно для каждого ассистента.
+"""
+import logging
+import random
+import re
+import time
+import zlib
+from collections import Counter, OrderedDict
+from typing import Optional
+
+from core.config import (
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_MIN_LENGTH, ANSWER_CACHE_MAX_LENGTH,
+    OPENAI_INPUT_PRICE_PER_1M, OPENAI_OUTPUT_PRICE_PER_1M
+)
+
+logger = logging.getLogger(__name__)
+
+SHINGLE_SIZE = 3
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 полос по 4 значения: кандидаты находятся при сходстве примерно от 0.5
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+MAX_CANDIDATES = 20  # сколько кандидатов проверять точным сходством
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Коэффициенты хэш-функций фиксированы, чтобы сигнатуры не зависели от запуска
+_rnd = random.Random(20250730)
+_PERMUTATIONS = [
+    (_rnd.randrange(1, _MERSENNE_PRIME), _rnd.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """Нижний регистр, ё -> е, без знаков препинания, эмодзи и лишних пробелов"""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+def shingles(text: str) -> frozenset:
+    """Символьные n-граммы нормализованного текста"""
+    if len(text) <= SHINGLE_SIZE:
+        return frozenset([text])
+    return frozenset(text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1))
+
+
+def minhash(shingle_set: frozenset) -> tuple:
+    """MinHash сигнатура множества n-грамм"""
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingle_set]
+    return tuple(
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    )
+
+
+def jaccard(first: frozenset, second: frozenset) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+class AnswerCache:
+    """
+    Кэш ответов ассистента с поиском по похожести вопросов
+    """
+
+    def __init__(self, enabled: bool = ANSWER_CACHE_ENABLED, maxsize: int = ANSWER_CACHE_SIZE,
+                 ttl: float = ANSWER_CACHE_TTL, threshold: float = ANSWER_CACHE_SIMILARITY):
+        self.enabled = enabled
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()  # id -> запись, от старых к новым
+        self.buckets = {}  # (assistant_id, номер полосы, значения полосы) -> set(id)
+        self.next_id = 0
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "stored": 0,
+            "saved_prompt_tokens": 0,
+            "saved_completion_tokens": 0,
+        }
+
+    def _band_keys(self, assistant_id: str, signature: tuple):
+        for band in range(LSH_BANDS):
+            yield (assistant_id, band, signature[band * LSH_ROWS:(band + 1) * LSH_ROWS])
+
+    def _remove(self, entry_id: int):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in self._band_keys(entry["assistant_id"], entry["signature"]):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[key]
+
+    def _expire(self, now: float):
+        while self.entries:
+            entry_id, entry = next(iter(self.entries.items()))
+            if entry["expires_at"] > now and len(self.entries) <= self.maxsize:
+                break
+            self._remove(entry_id)
+
+    def _prepare(self, question: str):
+        """Нормализованный вопрос и его n-граммы или None, если вопрос не подходит для кэша"""
+        if not self.enabled or not question:
+            return None
+        normalized = normalize_question(question)
+        if not ANSWER_CACHE_MIN_LENGTH <= len(normalized) <= ANSWER_CACHE_MAX_LENGTH:
+            return None
+        return normalized, shingles(normalized)
+
+    def lookup(self, assistant_id: str, question: str) -> Optional[str]:
+        """
+        Ищет сохраненный ответ на похожий вопрос
+
+        Args:
+            assistant_id: ID ассистента OpenAI
+            question: текст вопроса пользователя
+
+        Returns:
+            str: сохраненный ответ или None
+        """
+        prepared = self._prepare(question)
+        if prepared is None:
+            return None
+        normalized, shingle_set = prepared
+
+        now = time.monotonic()
+        self._expire(now)
+        self.stats["lookups"] += 1
+
+        # Кандидаты с большим числом совпавших полос проверяются первыми
+        signature = minhash(shingle_set)
+        band_matches = Counter()
+        for key in self._band_keys(assistant_id, signature):
+            band_matches.update(self.buckets.get(key, ()))
+
+        best, best_score = None, 0.0
+        for entry_id, _ in band_matches.most_common(MAX_CANDIDATES):
+            entry = self.entries[entry_id]
+            score = 1.0 if entry["question"] == normalized else jaccard(shingle_set, entry["shingles"])
+            if score > best_score:
+                best, best_score = entry, score
+
+        if best is None or best_score < self.threshold:
+            return None
+
+        best["hits"] += 1
+        self.stats["hits"] += 1
+        self.stats["saved_prompt_tokens"] += best["prompt_tokens"]
+        self.stats["saved_completion_tokens"] += best["completion_tokens"]
+        logger.info(f"Ответ из кэша (сходство {best_score:.2f}): '{normalized[:80]}'")
+        return best["answer"]
+
+    def store(self, assistant_id: str, question: str, answer: str,
+              prompt_tokens: int = 0, completion_tokens: int = 0):
+        """
+        Сохраняет ответ ассистента
+
+        Args:
+            assistant_id: ID ассистента OpenAI
+            question: текст вопроса пользователя
+            answer: ответ ассистента
+            prompt_tokens: токены запроса, потраченные на ответ (для оценки экономии)
+            completion_tokens: токены ответа
+        """
+        prepared = self._prepare(question)
+        if prepared is None or not answer:
+            return
+        normalized, shingle_set = prepared
+
+        signature = minhash(shingle_set)
+        self.next_id += 1
+        entry_id = self.next_id
+        self.entries[entry_id] = {
+            "assistant_id": assistant_id,
+            "question": normalized,
+            "shingles": shingle_set,
+            "signature": signature,
+            "answer": answer,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "expires_at": time.monotonic() + self.ttl,
+            "hits": 0,
+        }
+        for key in self._band_keys(assistant_id, signature):
+            self.buckets.setdefault(key, set()).add(entry_id)
+        self.stats["stored"] += 1
+        self._expire(time.monotonic())
+
+    def invalidate(self, assistant_id: Optional[str] = None) -> int:
+        """
+        Удаляет ответы ассистента (например, после смены инструкций или базы знаний)
+
+        Args:
+            assistant_id: ID ассистента, None - очистить весь кэш
+
+        Returns:
+            int: количество удаленных записей
+        """
+        to_remove = [
+            entry_id for entry_id, entry in self.entries.items()
+            if assistant_id is None or entry["assistant_id"] == assistant_id
+        ]
+        for entry_id in to_remove:
+            self._remove(entry_id)
+        logger.info(f"Кэш ответов очищен для {assistant_id or 'всех ассистентов'}: {len(to_remove)} записей")
+        return len(to_remove)
+
+    def get_stats(self) -> dict:
+        """Статистика кэша и оценка сэкономленных расходов OpenAI"""
+        stats = dict(self.stats)
+        stats["size"] = len(self.entries)
+        stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        stats["saved_usd"] = (
+            stats["saved_prompt_tokens"] * OPENAI_INPUT_PRICE_PER_1M
+            + stats["saved_completion_tokens"] * OPENAI_OUTPUT_PRICE_PER_1M
+        ) / 1_000_000
+        return stats
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по кэшу ответов"""
+        if not self.enabled:
+            return "💾 Кэш ответов ИИ: выключен"
+        stats = self.get_stats()
+        return "\n".join([
+            "💾 Кэш ответов ИИ:",
+            f"  • запросов: {stats['lookups']}, попаданий: {stats['hits']} ({stats['hit_rate'] * 100:.1f}%)",
+            f"  • записей: {stats['size']}, сохранено всего: {stats['stored']}",
+            f"  • сэкономлено токенов: {stats['saved_prompt_tokens'] + stats['saved_completion_tokens']}, "
+            f"≈ ${stats['saved_usd']:.2f}",
+        ])
+
+
+# Глобальный кэш ответов
+answer_cache = AnswerCache()
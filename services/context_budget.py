@@ -0,0 +1,150 @@
+"""
+Бюджет контекста OpenAI thread'ов
+
+Для каждого thread'а хранится оценка токенов его сообщений и фактический размер промпта
+последнего run (run.usage.prompt_tokens). По ним до запуска ассистента решается,
+уложится ли запрос в бюджет, и если нет - контекст обрезается до последних сообщений
+(truncation_strategy) или thread заменяется новым. Так запрос не падает с
+"Request too large", а пользователь не теряет весь диалог.
+"""
+import logging
+
+from core.config import (
+    OPENAI_CONTEXT_TOKEN_BUDGET, OPENAI_MESSAGE_TOKEN_LIMIT, OPENAI_CONTEXT_OVERHEAD_TOKENS
+)
+from utils.cache import LRUCache
+from utils.token_estimator import estimate_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# Thread'ы живут не дольше суток (ежедневный сброс)
+THREAD_BUDGET_CACHE_SIZE = 50000
+THREAD_BUDGET_TTL = 24 * 60 * 60
+
+# Меньше этого числа последних сообщений обрезать нет смысла - thread заменяется
+MIN_TRUNCATED_MESSAGES = 3
+
+ACTION_OK = "ok"
+ACTION_TRUNCATE = "truncate"
+ACTION_ROTATE = "rotate"
+ACTION_REJECT = "reject"
+
+
+class ContextBudget:
+    """
+    Учет токенов по thread'ам и план запуска ассистента
+    """
+
+    def __init__(self, budget: int = OPENAI_CONTEXT_TOKEN_BUDGET,
+                 message_limit: int = OPENAI_MESSAGE_TOKEN_LIMIT,
+                 default_overhead: int = OPENAI_CONTEXT_OVERHEAD_TOKENS):
+        self.budget = budget
+        self.message_limit = message_limit
+        self.default_overhead = default_overhead
+        # thread_id -> {'messages': [токены по порядку], 'overhead': int или None, 'new': bool}
+        self.threads = LRUCache(maxsize=THREAD_BUDGET_CACHE_SIZE, ttl=THREAD_BUDGET_TTL)
+        self.stats = {ACTION_OK: 0, ACTION_TRUNCATE: 0, ACTION_ROTATE: 0, ACTION_REJECT: 0}
+
+    def _state(self, thread_id: str) -> dict:
+        state = self.threads.get(thread_id)
+        if state is None:
+            state = {'messages': [], 'overhead': None}
+            self.threads.set(thread_id, state)
+        return state
+
+    def mark_new(self, thread_id: str):
+        """Отмечает только что выданный пустой thread"""
+        self.threads.set(thread_id, {'messages': [], 'overhead': None, 'new': True})
+
+    def mark_used(self, thread_id: str):
+        """В thread добавлено сообщение - он больше не пустой"""
+        self._state(thread_id)['new'] = False
+
+    def is_new(self, thread_id: str) -> bool:
+        """Известно ли, что в thread'е еще нет сообщений (после перезапуска - нет)"""
+        state = self.threads.get(thread_id)
+        return bool(state and state.get('new'))
+
+    def plan(self, thread_id: str, message: str) -> dict:
+        """
+        Решает, как запускать ассистента для нового сообщения
+
+        Args:
+            thread_id: ID thread в OpenAI
+            message: текст сообщения пользователя
+
+        Returns:
+            dict: {'action': ok|truncate|rotate|reject, 'last_messages': int или None,
+                   'message_tokens': int, 'estimated_tokens': int}
+        """
+        message_tokens = estimate_message_tokens(message)
+        state = self._state(thread_id)
+        # Инструкции ассистента и найденные фрагменты базы знаний, откалиброванные по прошлым run
+        overhead = state['overhead'] if state['overhead'] is not None else self.default_overhead
+        estimated = overhead + sum(state['messages']) + message_tokens
+
+        result = {'action': ACTION_OK, 'last_messages': None,
+                  'message_tokens': message_tokens, 'estimated_tokens': estimated}
+
+        if message_tokens > self.message_limit or overhead + message_tokens > self.budget:
+            result['action'] = ACTION_REJECT
+        elif estimated > self.budget:
+            # Сколько последних сообщений (вместе с новым) помещается в бюджет
+            available = self.budget - overhead - message_tokens
+            kept = 1
+            for tokens in reversed(state['messages']):
+                if tokens > available:
+                    break
+                available -= tokens
+                kept += 1
+
+            if kept >= MIN_TRUNCATED_MESSAGES:
+                result['action'] = ACTION_TRUNCATE
+                result['last_messages'] = kept
+            else:
+                result['action'] = ACTION_ROTATE
+
+        self.stats[result['action']] += 1
+        if result['action'] != ACTION_OK:
+            logger.info(
+                f"Бюджет контекста thread {thread_id}: ~{estimated} токенов из {self.budget}, "
+                f"решение: {result['action']} (последних сообщений: {result['last_messages']})"
+            )
+        return result
+
+    def record_run(self, thread_id: str, message_tokens: int, answer: str,
+                   prompt_tokens: int = 0, last_messages: int = None):
+        """
+        Учитывает завершенный run: новое сообщение, ответ и фактический размер промпта
+
+        Args:
+            thread_id: ID thread в OpenAI
+            message_tokens: оценка токенов сообщения пользователя
+            answer: ответ ассистента
+            prompt_tokens: run.usage.prompt_tokens (0, если неизвестно)
+            last_messages: сколько последних сообщений было в контексте при обрезке
+        """
+        state = self._state(thread_id)
+        state['messages'].append(message_tokens)
+
+        if prompt_tokens:
+            # Калибруем постоянную часть промпта по фактическому размеру
+            included = state['messages'][-last_messages:] if last_messages else state['messages']
+            state['overhead'] = max(0, prompt_tokens - sum(included))
+
+        state['messages'].append(estimate_message_tokens(answer))
+
+    def forget(self, thread_id: str):
+        """Удаляет учет thread'а (после сброса или замены)"""
+        self.threads.pop(thread_id)
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по решениям бюджета"""
+        return (
+            f"📏 Бюджет контекста: в норме {self.stats[ACTION_OK]}, обрезано {self.stats[ACTION_TRUNCATE]}, "
+            f"заменено thread'ов {self.stats[ACTION_ROTATE]}, отклонено длинных сообщений {self.stats[ACTION_REJECT]}"
+        )
+
+
+# Глобальный учет бюджета контекста
+context_budget = ContextBudget()
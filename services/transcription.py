@@ -0,0 +1,167 @@
+"""
+Пул расшифровки голосовых и аудио
+
+Задания ставятся в ограниченную очередь и обрабатываются фиксированным числом воркеров.
+Расшифровки кэшируются по file_unique_id: пересланное или повторно отправленное голосовое
+расшифровывается один раз, а одновременные запросы одного файла ждут общий результат.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from core.config import (
+    TRANSCRIPTION_WORKERS, TRANSCRIPTION_QUEUE_SIZE,
+    TRANSCRIPT_CACHE_SIZE, TRANSCRIPT_CACHE_TTL
+)
+from core.openai_client import openai_client
+from services.usage_ledger import usage_ledger
+from utils.audio_utils import download_audio, AudioTooLargeError
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptionPool:
+    """
+    Ограниченный пул воркеров расшифровки с кэшем и объединением одинаковых запросов
+    """
+
+    def __init__(self, workers: int = TRANSCRIPTION_WORKERS, queue_size: int = TRANSCRIPTION_QUEUE_SIZE):
+        self.workers_count = workers
+        self.queue_size = queue_size
+        self.queue = None
+        self.workers = []
+        self.in_flight = {}  # file_unique_id -> Future с текстом
+        self.cache = LRUCache(maxsize=TRANSCRIPT_CACHE_SIZE, ttl=TRANSCRIPT_CACHE_TTL)
+        self.stats = {
+            "jobs": 0,
+            "failed": 0,
+            "deduplicated": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "audio_seconds": 0,
+            "busy_seconds": 0.0,
+        }
+
+    def _ensure_workers(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.workers = [task for task in self.workers if not task.done()]
+        while len(self.workers) < self.workers_count:
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    async def transcribe(self, bot, user_id: int, file_id: str, file_unique_id: str,
+                         file_size: Optional[int], filename: str, duration: int = 0) -> Optional[str]:
+        """
+        Возвращает расшифровку аудио из кэша или через очередь воркеров
+
+        Args:
+            bot: экземпляр бота
+            user_id: ID пользователя (для логов и проверки доступа)
+            file_id: ID файла для скачивания
+            file_unique_id: постоянный ID файла - ключ кэша
+            file_size: размер файла из сообщения
+            filename: имя файла для Whisper
+            duration: длительность в секундах (для метрик)
+
+        Returns:
+            str: расшифрованный текст или None при ошибке
+        """
+        cached = self.cache.get(file_unique_id)
+        if cached is not None:
+            return cached
+
+        future = self.in_flight.get(file_unique_id)
+        if future is not None:
+            self.stats["deduplicated"] += 1
+        else:
+            self._ensure_workers()
+            future = asyncio.get_running_loop().create_future()
+            self.in_flight[file_unique_id] = future
+            job = (future, bot, user_id, file_id, file_unique_id, file_size, filename, duration, time.monotonic())
+            try:
+                await self.queue.put(job)
+            except BaseException:
+                self.in_flight.pop(file_unique_id, None)
+                raise
+
+        # shield: отмена одного ожидающего не отменяет общий результат для остальных
+        return await asyncio.shield(future)
+
+    async def _worker(self):
+        while True:
+            future, bot, user_id, file_id, file_unique_id, file_size, filename, duration, enqueued_at = await self.queue.get()
+            started = time.monotonic()
+            waited = started - enqueued_at
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+
+            text = None
+            try:
+                audio_buffer = await download_audio(bot, file_id, file_size)
+                with audio_buffer:
+                    text = await openai_client.transcribe_audio(user_id, audio_buffer, filename)
+            except AudioTooLargeError as e:
+                logger.warning(f"Слишком большое аудио от пользователя {user_id}: {e}")
+            except asyncio.CancelledError:
+                self.in_flight.pop(file_unique_id, None)
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка расшифровки аудио для пользователя {user_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+            self.stats["jobs"] += 1
+            elapsed = time.monotonic() - started
+            self.stats["busy_seconds"] += elapsed
+            if text:
+                self.stats["audio_seconds"] += duration or 0
+                usage_ledger.record_transcription(user_id, duration or 0, int(elapsed * 1000))
+                self.cache.set(file_unique_id, text)
+            else:
+                self.stats["failed"] += 1
+
+            self.in_flight.pop(file_unique_id, None)
+            if not future.done():
+                future.set_result(text)
+
+    async def stop(self):
+        """Останавливает воркеров"""
+        for task in self.workers:
+            task.cancel()
+        for task in self.workers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.workers = []
+
+    def get_stats(self) -> dict:
+        """Метрики пула"""
+        stats = dict(self.stats)
+        jobs = stats["jobs"]
+        stats["queue"] = self.queue.qsize() if self.queue else 0
+        stats["wait_avg"] = stats["wait_total"] / jobs if jobs else 0.0
+        # Секунд аудио на секунду работы воркеров (на одного воркера)
+        stats["audio_per_wall_second"] = stats["audio_seconds"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0
+        stats["cache_hit_rate"] = self.cache.hit_rate
+        stats["cache_size"] = len(self.cache)
+        return stats
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по расшифровкам"""
+        stats = self.get_stats()
+        return "\n".join([
+            "🎙 Расшифровка аудио:",
+            f"  • заданий: {stats['jobs']}, ошибок: {stats['failed']}, объединено: {stats['deduplicated']}",
+            f"  • ожидание в очереди ср. {stats['wait_avg'] * 1000:.0f} мс, макс. {stats['wait_max'] * 1000:.0f} мс",
+            f"  • аудио: {stats['audio_seconds']} сек, {stats['audio_per_wall_second']:.1f} сек аудио/сек работы",
+            f"  • кэш: {stats['cache_size']} записей, попаданий {stats['cache_hit_rate'] * 100:.1f}%",
+        ])
+
+
+# Глобальный пул расшифровки
+transcription_pool = TranscriptionPool()
@@ -0,0 +1,179 @@
+"""
+Учет расхода OpenAI по пользователям и дневные квоты по тарифу
+
+Раньше в traffic_log попадали только размеры сообщений в байтах, а токены из run.usage
+и длительность аудио для Whisper терялись. Здесь расход (токены, секунды аудио, время
+ответа) копится в памяти по пользователю за текущий день по Москве и записывается в БД
+пачкой раз в OPENAI_USAGE_FLUSH_INTERVAL. Квоты проверяются по этой же сумме в памяти,
+без запросов к БД (кроме первого обращения к пользователю за день). Пока квоты не сверены
+с реальным расходом, они выключены (OPENAI_QUOTAS_ENABLED) и расход только записывается.
+
+В многопроцессном режиме ИИ-чат пользователя обрабатывает один воркер, поэтому его
+дневная сумма в памяти воркера точная; отчет для админа читает БД и может отставать
+от других воркеров на интервал записи.
+"""
+import logging
+from typing import Optional
+
+from core.config import (
+    OPENAI_QUOTAS_ENABLED, OPENAI_DAILY_QUOTAS, OPENAI_DAILY_QUOTA_DEFAULT,
+    OPENAI_INPUT_PRICE_PER_1M, OPENAI_OUTPUT_PRICE_PER_1M, OPENAI_WHISPER_PRICE_PER_MINUTE
+)
+from core.database import db
+
+logger = logging.getLogger(__name__)
+
+USAGE_FIELDS = (
+    "requests", "prompt_tokens", "completion_tokens", "chat_latency_ms",
+    "transcriptions", "audio_seconds", "transcription_latency_ms",
+)
+
+QUOTA_TOKENS = "tokens"
+QUOTA_AUDIO = "audio_seconds"
+
+
+def estimate_cost(usage: dict) -> float:
+    """Оценка стоимости расхода в долларах"""
+    return (
+        usage['prompt_tokens'] * OPENAI_INPUT_PRICE_PER_1M / 1_000_000
+        + usage['completion_tokens'] * OPENAI_OUTPUT_PRICE_PER_1M / 1_000_000
+        + usage['audio_seconds'] / 60 * OPENAI_WHISPER_PRICE_PER_MINUTE
+    )
+
+
+class UsageLedger:
+    """
+    Дневной расход OpenAI по пользователям: сумма в памяти и отложенная запись в БД
+    """
+
+    def __init__(self, quotas: dict = OPENAI_DAILY_QUOTAS, enforce: bool = OPENAI_QUOTAS_ENABLED):
+        self.quotas = quotas
+        self.enforce = enforce
+        self.day = None
+        # user_id -> расход за self.day (записанный в БД + еще не записанный)
+        self.totals = {}
+        # (day, user_id) -> расход, еще не записанный в БД
+        self.pending = {}
+        self.stats = {"flushes": 0, "errors": 0, "quota_exceeded": 0}
+
+    def _usage(self, user_id: int) -> dict:
+        day = db.get_moscow_day()
+        if day != self.day:
+            # Новый день по Москве - квоты начинаются заново
+            self.day = day
+            self.totals = {}
+        usage = self.totals.get(user_id)
+        if usage is None:
+            usage = db.get_openai_usage(day, user_id)
+            self.totals[user_id] = usage
+        return usage
+
+    def _record(self, user_id: int, **deltas):
+        usage = self._usage(user_id)
+        pending = self.pending.setdefault((self.day, user_id), dict.fromkeys(USAGE_FIELDS, 0))
+        for field, value in deltas.items():
+            usage[field] += value
+            pending[field] += value
+
+    def record_chat(self, user_id: int, prompt_tokens: int, completion_tokens: int, latency_ms: int):
+        """Учитывает run ассистента (токены из run.usage)"""
+        self._record(user_id, requests=1, prompt_tokens=prompt_tokens,
+                     completion_tokens=completion_tokens, chat_latency_ms=latency_ms)
+
+    def record_transcription(self, user_id: int, audio_seconds: int, latency_ms: int):
+        """Учитывает расшифровку аудио через Whisper"""
+        self._record(user_id, transcriptions=1, audio_seconds=audio_seconds,
+                     transcription_latency_ms=latency_ms)
+
+    def quota_exceeded(self, user_id: int, tariff_type: str, audio: bool = False) -> Optional[str]:
+        """
+        Проверяет дневную квоту тарифа
+
+        Args:
+            user_id: ID пользователя
+            tariff_type: тариф пользователя
+            audio: сообщение требует расшифровки аудио
+
+        Returns:
+            str: исчерпанная квота (QUOTA_TOKENS или QUOTA_AUDIO) или None
+                 (всегда None, если квоты выключены)
+        """
+        if not self.enforce:
+            return None
+        quota = self.quotas.get(tariff_type, self.quotas[OPENAI_DAILY_QUOTA_DEFAULT])
+        usage = self._usage(user_id)
+        exceeded = None
+        if usage['prompt_tokens'] + usage['completion_tokens'] >= quota[QUOTA_TOKENS]:
+            exceeded = QUOTA_TOKENS
+        elif audio and usage['audio_seconds'] >= quota[QUOTA_AUDIO]:
+            exceeded = QUOTA_AUDIO
+        if exceeded:
+            self.stats["quota_exceeded"] += 1
+        return exceeded
+
+    def flush(self):
+        """Записывает накопленный расход в БД"""
+        if not self.pending:
+            return
+        records, self.pending = self.pending, {}
+        try:
+            db.add_openai_usage([
+                (day, user_id, *(usage[field] for field in USAGE_FIELDS))
+                for (day, user_id), usage in records.items()
+            ])
+            self.stats["flushes"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка записи расхода OpenAI ({len(records)} пользователей): {e}")
+            # Возвращаем в очередь, прибавляя к расходу, накопленному за время записи
+            for key, usage in records.items():
+                pending = self.pending.setdefault(key, dict.fromkeys(USAGE_FIELDS, 0))
+                for field in USAGE_FIELDS:
+                    pending[field] += usage[field]
+
+    def format_report(self, day: str = None, limit: int = 10) -> str:
+        """
+        Отчет для админа: расход по тарифам и пользователи с наибольшим расходом
+
+        Args:
+            day: дата YYYY-MM-DD (по умолчанию - сегодня по Москве)
+            limit: сколько пользователей показать
+        """
+        self.flush()
+        day = day or db.get_moscow_day()
+
+        lines = [f"📈 <b>Расход OpenAI за {day}</b>", ""]
+        by_tariff = db.get_openai_usage_by_tariff(day)
+        if not by_tariff:
+            lines.append("Расхода не было")
+            return "\n".join(lines)
+
+        lines.append("<b>По тарифам:</b>")
+        for row in by_tariff:
+            latency = row['chat_latency_ms'] / row['requests'] / 1000 if row['requests'] else 0
+            lines.append(
+                f"• {row['tariff_type'] or 'без подписки'}: {row['users']} польз., "
+                f"{row['requests']} запросов, токенов {row['prompt_tokens']} + {row['completion_tokens']}, "
+                f"аудио {row['audio_seconds'] // 60} мин, ответ ср. {latency:.1f} с, ≈${estimate_cost(row):.2f}"
+            )
+
+        lines.extend(["", f"<b>Топ-{limit} пользователей:</b>"])
+        for number, row in enumerate(db.get_top_openai_consumers(day, limit), 1):
+            lines.append(
+                f"{number}. {row['user_id']} ({row['tariff_type'] or 'без подписки'}): "
+                f"{row['requests']} запросов, токенов {row['prompt_tokens']} + {row['completion_tokens']}, "
+                f"аудио {row['audio_seconds']} с, ≈${estimate_cost(row):.2f}"
+            )
+        return "\n".join(lines)
+
+    def format_stats(self) -> str:
+        """Текстовый отчет по учету расхода"""
+        return (
+            f"📈 Учет расхода OpenAI: пользователей сегодня {len(self.totals)}, записей в БД {self.stats['flushes']}, "
+            f"ошибок записи {self.stats['errors']}, "
+            + (f"отказов по квоте {self.stats['quota_exceeded']}" if self.enforce else "квоты выключены (только учет)")
+        )
+
+
+# Глобальный учет расхода
+usage_ledger = UsageLedger()
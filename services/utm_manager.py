@@ -2,13 +2,20 @@
 """
 Менеджер UTM меток пользователей - работа с базой данных и памятью
 """
+import logging
+
+from core.config import UTM_CACHE_SIZE, UTM_CACHE_TTL
 from core.database import db
+from core.user_context import get_user_context
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
 
-# Кеш UTM меток в памяти для быстрого доступа
-utm_cache = {}
+# Кеш UTM меток в памяти для быстрого доступа (ограничен по размеру и времени жизни)
+utm_cache = LRUCache(maxsize=UTM_CACHE_SIZE, ttl=UTM_CACHE_TTL)
 
-# Кеш отправленных видео
-video_sent_cache = {}
+# Пользователи, которым уже отправлено стартовое видео (загружается из БД при первом обращении)
+video_sent_users = None
 
 def parse_utm_from_start(start_param: str) -> dict:
     """
@@ -96,7 +103,7 @@ def save_utm_to_cache_and_db(user_id: int, utm_data: dict):
         return
     
     # Сохраняем в кеш
-    utm_cache[user_id] = utm_data
+    utm_cache.set(user_id, utm_data)
     
     # Сохраняем в базу данных
     try:
@@ -115,18 +122,17 @@ def get_utm_from_cache_or_db(user_id: int) -> dict:
         dict: UTM метки или пустой словарь
     """
     # Сначала проверяем в кеше
-    if user_id in utm_cache:
-        return utm_cache[user_id]
+    utm_data = utm_cache.get(user_id)
+    if utm_data is not None:
+        return utm_data
     
-    # Если в кеше нет, загружаем из БД
+    # Если в кеше нет, берем из контекста апдейта или загружаем из БД
     try:
-        utm_data = db.get_user_utm(user_id)
-        if utm_data:
-            # Кешируем для следующих обращений
-            utm_cache[user_id] = utm_data
-            return utm_data
-        else:
-            return {}
+        context = get_user_context(user_id)
+        utm_data = context.utm if context is not None else db.get_user_utm(user_id)
+        # Кешируем и пустой результат, чтобы не ходить в БД за пользователями без меток
+        utm_cache.set(user_id, utm_data)
+        return utm_data
     except Exception as e:
         return {}
 
@@ -168,6 +174,28 @@ def get_utm_url_params_for_user(user_id: int) -> str:
 
 # ===== ФУНКЦИИ ДЛЯ ВИДЕО =====
 
+def load_video_sent_users() -> set:
+    """
+    Загружает из БД множество пользователей, которым уже отправлено видео.
+    Вызывается при запуске, дальше множество обновляется при записи.
+    При ошибке БД множество остается пустым, чтобы не повторять запрос на каждом вызове.
+    
+    Returns:
+        set: множество user_id
+    """
+    global video_sent_users
+    try:
+        video_sent_users = db.get_start_video_sent_users()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки пользователей, получивших стартовое видео: {e}")
+        video_sent_users = set()
+    return video_sent_users
+
+def _get_video_sent_users() -> set:
+    if video_sent_users is None:
+        return load_video_sent_users()
+    return video_sent_users
+
 def is_video_already_sent(user_id: int) -> bool:
     """
     Проверяет, было ли уже отправлено видео пользователю
@@ -178,16 +206,21 @@ def is_video_already_sent(user_id: int) -> bool:
     Returns:
         bool: True если видео уже отправлялось
     """
-    return video_sent_cache.get(user_id, False)
+    return user_id in _get_video_sent_users()
 
 def mark_video_as_sent(user_id: int):
     """
-    Отмечает, что видео было отправлено пользователю
+    Отмечает, что видео было отправлено пользователю (в памяти и в БД)
     
     Args:
         user_id: ID пользователя
     """
-    video_sent_cache[user_id] = True
+    _get_video_sent_users().add(user_id)
+    try:
+        db.mark_start_video_sent(user_id)
+    except Exception as e:
+        # В памяти отметка есть, но после перезапуска видео уйдет повторно
+        logger.error(f"Ошибка сохранения отправки стартового видео пользователю {user_id}: {e}")
 
 # ===== ОСНОВНЫЕ ФУНКЦИИ ДЛЯ ИМПОРТА =====
 
@@ -215,7 +248,6 @@ def get_payment_url_with_utm(user_id: int, base_url: str, payment_id: str) -> st
     Returns:
         str: полная ссылка с UTM метками
     """
-    utm_data = get_utm_from_cache_or_db(user_id)
     utm_params = get_utm_url_params_for_user(user_id)
     full_url = f"{base_url}?id={payment_id}&{utm_params}"
     
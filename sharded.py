@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Многопроцессный запуск бота на одной машине
+
+Координатор получает апдейты Telegram, принимает вебхуки GetCourse и держит аренду
+глобальных фоновых задач (сброс, удаление и пул OpenAI threads, окончания подписок и т.п.). Апдейты раздаются
+воркерам по шардам user_id через ограниченные очереди multiprocessing; каждый воркер
+запускает свой диспетчер, ИИ-чат и автоворонки только для своих пользователей.
+
+Запускать: python3 sharded.py [число воркеров]   (по умолчанию BOT_WORKERS из конфигурации)
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import sys
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.types import Update
+
+from core.config import BOT_TOKEN, BOT_WORKERS, SHARD_QUEUE_SIZE, SHARD_WORKER_CONCURRENCY
+from core.database import db
+from core.sharding import configure_shard, shard_for, update_user_id, run_with_lease
+from core.telegram_sender import telegram_sender
+
+logger = logging.getLogger(__name__)
+
+POLLING_TIMEOUT = 30
+
+# =================== ВОРКЕР ===================
+
+def worker_process(index: int, count: int, updates: multiprocessing.Queue):
+    """Точка входа процесса воркера"""
+    configure_shard(index, count)
+    try:
+        asyncio.run(run_worker(index, count, updates))
+    except KeyboardInterrupt:
+        pass
+
+async def run_worker(index: int, count: int, updates: multiprocessing.Queue):
+    """Диспетчер и фоновые задачи воркера для пользователей его шарда"""
+    from main import create_dispatcher
+    from background.auto_spam import start_auto_spam_task
+    from background.kupi_video import kupi_video_background_task
+    from background.openai_usage import openai_usage_flush_task
+    from services.transcription import transcription_pool
+
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Глобальный лимит Telegram делится между воркерами и координатором
+    telegram_sender.attach(bot, rate_share=1 / (count + 1))
+    dp = create_dispatcher()
+
+    background_tasks = [
+        asyncio.create_task(start_auto_spam_task(bot)),
+        asyncio.create_task(kupi_video_background_task(bot)),
+        asyncio.create_task(openai_usage_flush_task()),
+    ]
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(SHARD_WORKER_CONCURRENCY)
+    running = set()
+
+    async def handle(update: Update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Воркер {index}: ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            semaphore.release()
+
+    def next_item():
+        # Таймаут, чтобы поток исполнителя не зависал в get при остановке процесса
+        try:
+            return updates.get(timeout=1)
+        except queue.Empty:
+            return None, None
+
+    print(f"Воркер {index}/{count} запущен")
+    try:
+        while True:
+            kind, payload = await loop.run_in_executor(None, next_item)
+            if kind is None:
+                continue
+
+            if kind == "stop":
+                break
+            if kind == "user_changed":
+                # Оплата или бонус пришли в координатор - сбрасываем кэши пользователя здесь
+                db._bump_user_version(payload, notify=False)
+                continue
+
+            # Не берем новые апдейты, пока заняты все слоты обработки
+            await semaphore.acquire()
+            try:
+                update = Update.model_validate(payload, context={"bot": bot})
+            except Exception as e:
+                semaphore.release()
+                logger.error(f"Воркер {index}: некорректный апдейт: {e}")
+                continue
+            task = asyncio.create_task(handle(update))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        await dp.storage.close()
+        await transcription_pool.stop()
+        await bot.session.close()
+        print(f"Воркер {index} остановлен")
+
+# =================== КООРДИНАТОР ===================
+
+async def route_updates(bot: Bot, queues: list):
+    """Получает апдейты long polling'ом и раздает их воркерам по шардам"""
+    loop = asyncio.get_running_loop()
+    offset = None
+
+    # Установленный в режиме webhook вебхук не дает получать апдейты через getUpdates
+    try:
+        await bot.delete_webhook()
+    except Exception as e:
+        logger.error(f"Не удалось удалить webhook: {e}")
+
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(5)
+            continue
+
+        for update in updates:
+            shard = shard_for(update_user_id(update), len(queues))
+            payload = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+            # put блокируется при полной очереди воркера - это и есть backpressure
+            await loop.run_in_executor(None, queues[shard].put, ("update", payload))
+            offset = update.update_id + 1
+
+async def run_coordinator(count: int):
+    """Координатор: прием апдейтов, вебхуки GetCourse и глобальные фоновые задачи"""
+    from main import system_check, create_web_app, start_web_server
+    from background.daily_thread_reset import daily_thread_reset_task
+    from background.thread_pool import thread_pool_background_task
+    from background.thread_gc import thread_gc_background_task
+    from background.segment_counters import segment_reconcile_background_task
+    from background.subscription_expiry import subscription_expiry_task
+    from background.referral_settlement import referral_settlement_background_task
+
+    if not await system_check():
+        print("Запуск прерван из-за ошибок системы")
+        return
+
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(count)]
+    workers = [
+        context.Process(target=worker_process, args=(index, count, queues[index]), name=f"bot-worker-{index}")
+        for index in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Изменения подписки из вебхука GetCourse передаются воркеру пользователя
+    def notify_worker(user_id: int):
+        try:
+            queues[shard_for(user_id, count)].put_nowait(("user_changed", user_id))
+        except queue.Full:
+            logger.warning(f"Очередь воркера переполнена, кэш пользователя {user_id} обновится по TTL")
+    db.version_listeners.append(notify_worker)
+
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    telegram_sender.attach(bot, rate_share=1 / (count + 1))
+
+    # Вебхуки GetCourse принимает координатор; апдейты Telegram он получает polling'ом
+    web_runner = await start_web_server(create_web_app())
+
+    # Глобальные задачи выполняются только держателем аренды
+    tasks = [
+        asyncio.create_task(run_with_lease("daily_thread_reset", daily_thread_reset_task)),
+        asyncio.create_task(run_with_lease("thread_gc", thread_gc_background_task)),
+        asyncio.create_task(run_with_lease("thread_pool", thread_pool_background_task)),
+        asyncio.create_task(run_with_lease("segment_reconcile", segment_reconcile_background_task)),
+        asyncio.create_task(run_with_lease("subscription_expiry", lambda: subscription_expiry_task(bot))),
+        asyncio.create_task(run_with_lease("referral_settlement", referral_settlement_background_task)),
+        asyncio.create_task(route_updates(bot, queues)),
+    ]
+
+    print(f"Координатор запущен, воркеров: {count}")
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for worker_queue in queues:
+            worker_queue.put(("stop", None))
+        for worker in workers:
+            worker.join(timeout=30)
+        await web_runner.cleanup()
+        print(telegram_sender.format_stats())
+        await bot.session.close()
+        print("Бот остановлен")
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else BOT_WORKERS
+    try:
+        asyncio.run(run_coordinator(max(1, count)))
+    except KeyboardInterrupt:
+        print("Бот остановлен пользователем")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Стресс-тест параллельных оплат одного пользователя
+
+Несколько процессов (как воркеры sharded.py) и потоков в каждом (как вебхуки GetCourse)
+одновременно вызывают save_subscription для одного user_id с разными payment_id.
+После теста проверяется, что ни одна оплата не потерялась: счетчики покупок равны числу
+оплат, подписка продлена на 30 дней за каждую, а счетчики сегментов сходятся с таблицами.
+Работает на копии базы во временной папке, рабочая база не меняется.
+
+Запускать: python3 stress_save_subscription.py [процессов] [оплат в процессе]
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+USER_ID = 999000111
+TARIFFS = ("basic", "vip", "course")
+THREADS_PER_PROCESS = 8
+
+
+def open_database(work_dir: str):
+    """Подключает core.database к базе во временной папке (путь к БД относительный)"""
+    os.chdir(work_dir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from core.database import db
+    return db
+
+
+def fire_payments(work_dir: str, process_index: int, payments: int) -> int:
+    """Оплаты одного процесса в несколько потоков"""
+    db = open_database(work_dir)
+
+    def pay(number: int):
+        tariff = TARIFFS[number % len(TARIFFS)]
+        db.save_subscription(USER_ID, tariff, f"bot_{USER_ID}_{tariff}_0_p{process_index}n{number}")
+
+    with ThreadPoolExecutor(max_workers=THREADS_PER_PROCESS) as executor:
+        list(executor.map(pay, range(payments)))
+    return payments
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    payments = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    total = processes * payments
+
+    work_dir = tempfile.mkdtemp(prefix="stress_subscription_")
+    source_db = os.path.join(ROOT, "bot_database.db")
+    if os.path.exists(source_db):
+        shutil.copy(source_db, work_dir)
+
+    try:
+        db = open_database(work_dir)
+
+        print("📊 СТРЕСС-ТЕСТ ПАРАЛЛЕЛЬНЫХ ОПЛАТ")
+        print("=" * 50)
+        print(f"Процессов: {processes}, потоков в процессе: {THREADS_PER_PROCESS}, оплат: {total}")
+
+        started_at = datetime.now()
+        started = time.perf_counter()
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes) as pool:
+            pool.starmap(fire_payments, [(work_dir, index, payments) for index in range(processes)])
+        elapsed = time.perf_counter() - started
+
+        subscription = db.get_user_subscription(USER_ID)
+        counts = {tariff: subscription[f"{tariff}_count"] for tariff in TARIFFS}
+        expected_counts = {
+            tariff: sum(1 for number in range(payments) if TARIFFS[number % len(TARIFFS)] == tariff) * processes
+            for tariff in TARIFFS
+        }
+        expires_at = datetime.fromisoformat(subscription["expires_at"])
+        days = (expires_at - started_at).total_seconds() / 86400
+        drift = db.reconcile_segment_counters()
+
+        print(f"Время: {elapsed:.2f} с ({total / elapsed:.0f} оплат/с)")
+        print(f"Счетчики покупок: {counts} (ожидалось {expected_counts})")
+        print(f"Подписка продлена на {days:.2f} дней (ожидалось {total * 30})")
+        print(f"Расхождения счетчиков сегментов: {drift or 'нет'}")
+
+        ok = counts == expected_counts and abs(days - total * 30) < 1 and not drift
+        print("✅ Оплаты не потеряны" if ok else "❌ Обнаружены потерянные оплаты")
+        return 0 if ok else 1
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Регрессионные тесты разбивки длинных сообщений (utils/message_utils.py)
+Запускать: python -m pytest -q tests
+"""
+import re
+import threading
+
+from utils.message_utils import split_text_message, StreamingTextSplitter
+
+# Разбивка идет в event loop бота - зависание останавливает всех пользователей
+SPLIT_TIMEOUT = 5
+
+_TAG_RE = re.compile(r"<(/?)(b|i|a|code)(?:\s[^>]*)?>")
+
+
+def split_with_timeout(text: str, max_length: int) -> list:
+    """split_text_message, который падает, а не зависает"""
+    result = []
+    worker = threading.Thread(target=lambda: result.append(split_text_message(text, max_length)), daemon=True)
+    worker.start()
+    worker.join(SPLIT_TIMEOUT)
+    assert not worker.is_alive(), "Разбивка не завершилась"
+    return result[0]
+
+
+def check_parts(parts: list, max_length: int) -> None:
+    """Лимит длины, непустой текст и сбалансированные теги в каждой части"""
+    for part in parts:
+        assert len(part) <= max_length, f"Часть длиннее лимита: {len(part)}"
+        assert _TAG_RE.sub("", part).strip(), f"Пустая часть: {part!r}"
+        stack = []
+        for m in _TAG_RE.finditer(part):
+            if m.group(1):
+                assert stack and stack[-1] == m.group(2), f"Закрывающий тег без пары: {part!r}"
+                stack.pop()
+            else:
+                stack.append(m.group(2))
+        assert not stack, f"Незакрытый тег в части: {part!r}"
+
+
+def test_tag_longer_than_message():
+    text = '<a href="https://x/' + "h" * 5000 + '">link</a> text'
+    parts = split_with_timeout(text, 4096)
+    check_parts(parts, 4096)
+    assert parts == ["link text"]
+
+
+def test_tags_longer_than_small_limit():
+    text = '<a href="https://example.com/a/b/c/d/e/f/g">link</a> ' * 10
+    parts = split_with_timeout(text, 40)
+    check_parts(parts, 40)
+    assert " ".join(parts).split() == ["link"] * 10
+
+
+def test_open_tags_closed_in_last_part():
+    text = "<b>" + "слово " * 30
+    parts = split_with_timeout(text, 50)
+    check_parts(parts, 50)
+    assert parts[-1].startswith("<b>") and parts[-1].endswith("</b>")
+
+
+def test_streaming_matches_tags_across_pieces():
+    text = ("<b>" + "слово " * 40 + '<a href="https://x/' + "h" * 300 + '">ссылка</a>' + "</b>. ") * 20
+    splitter = StreamingTextSplitter(200)
+    parts = []
+    for i in range(0, len(text), 7):
+        parts.extend(splitter.feed(text[i:i + 7]))
+    parts.extend(splitter.close())
+    check_parts(parts, 200)
+    assert sum(part.count("ссылка") for part in parts) == 20
@@ -0,0 +1,83 @@
+"""
+Скачивание голосовых и аудио из Telegram в буфер для расшифровки
+
+Небольшие файлы остаются в памяти, крупные сбрасываются во временный файл
+(SpooledTemporaryFile), который удаляется при закрытии буфера.
+"""
+import logging
+import tempfile
+from typing import Optional
+
+from core.config import AUDIO_MAX_SIZE, AUDIO_SPOOL_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+
+class AudioTooLargeError(Exception):
+    """Размер аудио превышает AUDIO_MAX_SIZE"""
+
+
+async def download_audio(bot, file_id: str, file_size: Optional[int] = None) -> tempfile.SpooledTemporaryFile:
+    """
+    Скачивает файл Telegram в буфер, не создавая файлов на диске для небольших сообщений
+
+    Args:
+        bot: экземпляр бота
+        file_id: ID файла в Telegram
+        file_size: размер из сообщения, если известен (проверяется до запроса к API)
+
+    Returns:
+        SpooledTemporaryFile: буфер, перемотанный в начало. Закрывать вызывающему.
+
+    Raises:
+        AudioTooLargeError: если файл больше AUDIO_MAX_SIZE
+    """
+    if file_size and file_size > AUDIO_MAX_SIZE:
+        raise AudioTooLargeError(f"Аудио {file_size} байт больше лимита {AUDIO_MAX_SIZE}")
+
+    telegram_file = await bot.get_file(file_id)
+    if telegram_file.file_size and telegram_file.file_size > AUDIO_MAX_SIZE:
+        raise AudioTooLargeError(f"Аудио {telegram_file.file_size} байт больше лимита {AUDIO_MAX_SIZE}")
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_THRESHOLD)
+    try:
+        # download_file пишет в буфер частями и перематывает его в начало
+        await bot.download_file(telegram_file.file_path, destination=buffer)
+
+        size = buffer.seek(0, 2)
+        buffer.seek(0)
+        if size > AUDIO_MAX_SIZE:
+            raise AudioTooLargeError(f"Аудио {size} байт больше лимита {AUDIO_MAX_SIZE}")
+    except BaseException:
+        buffer.close()
+        raise
+
+    logger.debug(f"Аудио {file_id} скачано: {size} байт, {'на диске' if size > AUDIO_SPOOL_THRESHOLD else 'в памяти'}")
+    return buffer
+
+
+def audio_filename(mime_type: Optional[str], default: str = "audio.ogg") -> str:
+    """
+    Имя файла для API расшифровки: Whisper определяет формат по расширению
+
+    Args:
+        mime_type: MIME тип из сообщения
+        default: имя для неизвестных типов
+
+    Returns:
+        str: имя файла с подходящим расширением
+    """
+    extensions = {
+        "audio/mpeg": "mp3",
+        "audio/mp3": "mp3",
+        "audio/mp4": "m4a",
+        "audio/x-m4a": "m4a",
+        "audio/m4a": "m4a",
+        "audio/wav": "wav",
+        "audio/x-wav": "wav",
+        "audio/webm": "webm",
+        "audio/ogg": "ogg",
+        "audio/opus": "ogg",
+    }
+    extension = extensions.get((mime_type or "").lower())
+    return f"audio.{extension}" if extension else default
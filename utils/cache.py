@@ -0,0 +1,80 @@
+"""
+Ограниченный по размеру кэш в памяти с вытеснением LRU и временем жизни записей
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    LRU кэш с TTL
+
+    Args:
+        maxsize: максимальное количество записей
+        ttl: время жизни записи в секундах (None - без ограничения)
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default: Any = None) -> Any:
+        """Возвращает значение по ключу или default, если записи нет или она устарела"""
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value: Any, ttl: Optional[float] = None):
+        """Сохраняет значение, вытесняя самые давние записи при переполнении"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default: Any = None) -> Any:
+        """Удаляет запись и возвращает ее значение"""
+        item = self._data.pop(key, _MISSING)
+        if item is _MISSING:
+            return default
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self) -> list:
+        """Неустаревшие записи (key, value) без изменения порядка вытеснения"""
+        now = time.monotonic()
+        return [
+            (key, value) for key, (value, expires_at) in self._data.items()
+            if expires_at is None or expires_at >= now
+        ]
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
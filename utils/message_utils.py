@@ -1,101 +1,456 @@
-def split_text_message(text: str, max_length: int = 4096) -> list[str]:
+import re
+import asyncio
+from bisect import bisect_right
+from typing import Iterator
+
+from core.telegram_sender import OrderedSend, telegram_sender
+
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MAX_LENGTH = 4096
+
+# Теги, которые Telegram понимает в parse_mode=HTML
+HTML_TAGS = (
+    'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del',
+    'a', 'code', 'pre', 'span', 'tg-spoiler', 'tg-emoji', 'blockquote'
+)
+
+_TAG_RE = re.compile(
+    r'<(/?)(' + '|'.join(sorted((re.escape(tag) for tag in HTML_TAGS), key=len, reverse=True)) + r')(?=[\s>/])[^<>]*>',
+    re.IGNORECASE
+)
+_ENTITY_RE = re.compile(r'&(?:[a-zA-Z]+|#\d+|#x[0-9a-fA-F]+);')
+
+# Запас в конце буфера при потоковой разбивке, чтобы не резать недописанный тег
+_STREAM_TAIL_MARGIN = 256
+
+# Тег длиннее этой доли сообщения (например, ссылка с огромным URL) теряет разметку:
+# иначе он не помещается в часть вместе с текстом и переносимыми тегами
+_MAX_TAG_SHARE = 4
+
+
+def _find_break(text: str, start: int, end: int) -> int:
+    """
+    Ищет лучшую точку разрыва в окне text[start:end]:
+    абзац, затем строка, затем конец предложения, затем пробел.
+    Слишком ранние разрывы (меньше половины окна) пропускаются, чтобы не плодить короткие части.
+    """
+    min_cut = start + (end - start) // 2
+
+    cut = text.rfind('\n\n', start, end)
+    if cut > min_cut:
+        return cut
+
+    cut = text.rfind('\n', start, end)
+    if cut > min_cut:
+        return cut
+
+    cut = text.rfind('. ', start, end)
+    if cut > min_cut:
+        return cut + 1
+
+    cut = text.rfind(' ', start, end)
+    if cut > start:
+        return cut
+
+    return end
+
+
+def _index_markup(text: str, max_length: int, open_tags=()) -> tuple:
+    """
+    Находит теги и HTML-сущности текста со смещениями.
+
+    Открывающий тег длиннее max_length // _MAX_TAG_SHARE теряет разметку вместе со своим
+    закрывающим тегом, как и закрывающий тег без пары: в части они не попадают,
+    а в стеке открытых тегов такой тег лежит с пустой разметкой.
+
+    Returns:
+        tuple: (теги, их начала, сущности, их начала, тексты без разметки, их начала)
+    """
+    limit = max_length // _MAX_TAG_SHARE
+    stack = list(open_tags)
+    tags = []
+    dropped = []
+    for m in _TAG_RE.finditer(text):
+        is_closing = bool(m.group(1))
+        name = m.group(2).lower()
+        raw = m.group(0)
+        if not is_closing:
+            if len(raw) + len(name) + 3 > limit:
+                raw = ''
+            stack.append((name, raw))
+        else:
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    if not stack[i][1]:
+                        raw = ''
+                    del stack[i]
+                    break
+            else:
+                raw = ''
+        if not raw:
+            dropped.append((m.start(), m.end()))
+        tags.append((m.start(), m.end(), is_closing, name, raw))
+
+    entities = [(m.start(), m.end()) for m in _ENTITY_RE.finditer(text)]
+    return (
+        tags, [tag[0] for tag in tags],
+        entities, [entity[0] for entity in entities],
+        dropped, [span[0] for span in dropped],
+    )
+
+
+def _slice(text: str, start: int, end: int, dropped: list, dropped_starts: list) -> str:
+    """text[start:end] без тегов, потерявших разметку"""
+    i = bisect_right(dropped_starts, start - 1)
+    if i == len(dropped) or dropped[i][0] >= end:
+        return text[start:end]
+    pieces = []
+    while i < len(dropped) and dropped[i][0] < end:
+        pieces.append(text[start:dropped[i][0]])
+        start = dropped[i][1]
+        i += 1
+    pieces.append(text[start:end])
+    return ''.join(pieces)
+
+
+def _hidden_suffix(dropped: list) -> list:
+    """hidden[k] - сколько символов занимают теги dropped[k:]"""
+    hidden = [0] * (len(dropped) + 1)
+    for k in range(len(dropped) - 1, -1, -1):
+        hidden[k] = hidden[k + 1] + dropped[k][1] - dropped[k][0]
+    return hidden
+
+
+def _closing_tags(stack: list) -> str:
+    return ''.join(f'</{name}>' for name, raw in reversed(stack) if raw)
+
+
+def _has_content(chunk: str) -> bool:
+    """Есть ли в части текст, кроме тегов и пробелов (пустое сообщение Telegram не примет)"""
+    return bool(_TAG_RE.sub('', chunk).strip())
+
+
+def _apply_tags(stack: list, tags: list, index: int, limit: int) -> int:
+    """
+    Применяет к стеку открытых тегов все теги, которые целиком лежат до позиции limit.
+
+    Returns:
+        int: индекс первого непримененного тега
+    """
+    while index < len(tags) and tags[index][1] <= limit:
+        _, _, is_closing, name, raw = tags[index]
+        if is_closing:
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    del stack[i]
+                    break
+        else:
+            stack.append((name, raw))
+        index += 1
+    return index
+
+
+def _split_text(text: str, max_length: int, open_tags=(), final: bool = True):
+    """
+    Однопроходная разбивка текста по смещениям.
+
+    Части собираются один раз через срезы, строки не склеиваются повторно.
+    Открытые HTML теги закрываются в конце части и открываются заново в начале следующей,
+    разрезы внутри тегов и HTML-сущностей (&amp; и т.п.) не допускаются.
+    Каждый проход продвигается хотя бы на символ: слишком длинные теги теряют разметку,
+    а если перенесенная разметка не оставляет места, остаток текста отправляется без нее.
+
+    Args:
+        text: Текст для разбивки
+        max_length: Максимальная длина одной части
+        open_tags: Теги, открытые до начала text (для потоковой разбивки)
+        final: Если False, хвост короче max_length не отдается и остается для следующего вызова
+
+    Returns:
+        tuple: (части, необработанный хвост, открытые на нем теги)
+    """
+    tags, tag_starts, entities, entity_starts, dropped, dropped_starts = _index_markup(text, max_length, open_tags)
+    hidden = _hidden_suffix(dropped)
+
+    stack = list(open_tags)
+    tag_index = 0
+    parts = []
+    length = len(text)
+
+    pos = 0
+    while pos < length and text[pos].isspace():
+        pos += 1
+
+    drop_markup = False
+    while pos < length:
+        if drop_markup:
+            # Вложенность тегов не помещается в сообщение - остаток отправляется без разметки
+            text = text[:pos] + _TAG_RE.sub('', text[pos:])
+            length = len(text)
+            tags, tag_starts, entities, entity_starts, dropped, dropped_starts = _index_markup(text, max_length)
+            hidden = _hidden_suffix(dropped)
+            tag_index = len(tags)
+            stack = []
+            drop_markup = False
+
+        prefix = ''.join(raw for _, raw in stack)
+        remaining = length - pos - hidden[bisect_right(dropped_starts, pos - 1)]
+
+        if final:
+            # Теги, оставшиеся открытыми в конце текста, закрываются в последней части
+            end_stack = list(stack)
+            _apply_tags(end_stack, tags, tag_index, length)
+            closing = _closing_tags(end_stack)
+            if len(prefix) + remaining + len(closing) <= max_length:
+                tail = _slice(text, pos, length, dropped, dropped_starts).rstrip()
+                if _has_content(tail):
+                    parts.append(prefix + tail + closing)
+                pos = length
+                break
+        if not final and len(prefix) + remaining <= max_length + _STREAM_TAIL_MARGIN:
+            break
+
+        budget = max_length - len(prefix) - len(_closing_tags(stack))
+        if budget < 1:
+            drop_markup = True
+            continue
+
+        while True:
+            # Теги без разметки не занимают места в части - окно расширяется на их длину
+            end = pos + budget
+            k = bisect_right(dropped_starts, pos - 1)
+            while k < len(dropped) and dropped[k][0] < end:
+                end += dropped[k][1] - dropped[k][0]
+                k += 1
+            end = min(end, length)
+            cut = _find_break(text, pos, end)
+
+            # Не режем внутри тега или сущности и не оставляем открывающий тег в конце части
+            moved = True
+            while moved and cut > pos:
+                moved = False
+                i = bisect_right(tag_starts, cut - 1) - 1
+                if i >= 0 and tags[i][1] > cut:
+                    cut = tags[i][0]
+                    moved = True
+                elif i >= 0 and tags[i][1] == cut and not tags[i][2]:
+                    cut = tags[i][0]
+                    moved = True
+                j = bisect_right(entity_starts, cut - 1) - 1
+                if j >= 0 and entities[j][1] > cut:
+                    cut = entities[j][0]
+                    moved = True
+
+            if cut <= pos:
+                # Разумной точки разрыва нет - жесткий разрез по ближайшей границе тега или сущности
+                cut = end
+                i = bisect_right(tag_starts, cut - 1) - 1
+                if i >= 0 and tags[i][1] > cut:
+                    cut = tags[i][0] if tags[i][0] > pos else tags[i][1]
+                j = bisect_right(entity_starts, cut - 1) - 1
+                if j >= 0 and entities[j][1] > cut:
+                    cut = entities[j][0] if entities[j][0] > pos else entities[j][1]
+
+            cut_stack = list(stack)
+            next_tag_index = _apply_tags(cut_stack, tags, tag_index, cut)
+            closing = _closing_tags(cut_stack)
+            body = _slice(text, pos, cut, dropped, dropped_starts).rstrip()
+            chunk_length = len(prefix) + len(body) + len(closing)
+
+            if chunk_length <= max_length or budget <= 1:
+                break
+            budget = max(1, budget - (chunk_length - max_length))
+
+        if chunk_length > max_length and stack:
+            drop_markup = True
+            continue
+
+        if _has_content(body):
+            parts.append(''.join((prefix, body, closing)))
+
+        stack = cut_stack
+        tag_index = next_tag_index
+        pos = cut
+        while pos < length and text[pos].isspace():
+            pos += 1
+
+    return parts, text[pos:], stack
+
+
+def iter_text_parts(text: str, max_length: int = TELEGRAM_MAX_LENGTH) -> Iterator[str]:
+    """
+    Генератор частей длинного текста, каждая не длиннее max_length символов.
+
+    Args:
+        text: Текст для разбивки (может содержать HTML разметку Telegram)
+        max_length: Максимальная длина одного сообщения
+
+    Yields:
+        str: очередная часть текста с корректно закрытыми тегами
+    """
+    if len(text) <= max_length:
+        yield text
+        return
+
+    parts, _, _ = _split_text(text, max_length)
+    yield from parts
+
+
+def split_text_message(text: str, max_length: int = TELEGRAM_MAX_LENGTH) -> list[str]:
     """
     Разбивает длинный текст на части, не превышающие лимит Telegram.
-    
+
     Args:
         text: Текст для разбивки
         max_length: Максимальная длина одного сообщения (по умолчанию 4096 символов)
-    
+
     Returns:
         Список строк, каждая не длиннее max_length символов
     """
-    if len(text) <= max_length:
-        return [text]
-    
-    parts = []
-    current_part = ""
-    
-    # Разбиваем по абзацам
-    paragraphs = text.split('\n\n')
-    
-    for paragraph in paragraphs:
-        # Если абзац сам по себе длинный
-        if len(paragraph) > max_length:
-            # Разбиваем по предложениям
-            sentences = paragraph.split('. ')
-            for i, sentence in enumerate(sentences):
-                if i < len(sentences) - 1:
-                    sentence += '. '
-                
-                if len(current_part + sentence) > max_length:
-                    if current_part:
-                        parts.append(current_part.strip())
-                        current_part = ""
-                    
-                    # Если предложение само слишком длинное, разбиваем по словам
-                    if len(sentence) > max_length:
-                        words = sentence.split(' ')
-                        for word in words:
-                            if len(current_part + word + ' ') > max_length:
-                                if current_part:
-                                    parts.append(current_part.strip())
-                                    current_part = ""
-                            current_part += word + ' '
-                    else:
-                        current_part = sentence
-                else:
-                    current_part += sentence
-        else:
-            # Проверяем, поместится ли абзац в текущую часть
-            if len(current_part + '\n\n' + paragraph) > max_length:
-                if current_part:
-                    parts.append(current_part.strip())
-                    current_part = paragraph
-                else:
-                    current_part = paragraph
-            else:
-                if current_part:
-                    current_part += '\n\n' + paragraph
-                else:
-                    current_part = paragraph
-    
-    if current_part:
-        parts.append(current_part.strip())
-    
-    return parts
+    return list(iter_text_parts(text, max_length))
+
+
+class StreamingTextSplitter:
+    """
+    Инкрементальная разбивка текста, который приходит кусками (потоковый ответ ИИ).
+
+    feed() возвращает готовые части, как только их можно отдать,
+    close() возвращает остаток. Открытые теги переносятся между частями.
+    """
+
+    def __init__(self, max_length: int = TELEGRAM_MAX_LENGTH):
+        self.max_length = max_length
+        self._pieces = []
+        self._size = 0
+        self._open_tags = []
+
+    def feed(self, piece: str) -> list[str]:
+        """
+        Добавляет кусок текста и возвращает части, готовые к отправке
+
+        Args:
+            piece: очередной кусок текста
+
+        Returns:
+            list: готовые части (может быть пустым)
+        """
+        if not piece:
+            return []
+
+        self._pieces.append(piece)
+        self._size += len(piece)
+
+        # Копим буфер, чтобы у разбивки был выбор точки разрыва
+        if self._size <= 2 * self.max_length + _STREAM_TAIL_MARGIN:
+            return []
+
+        text = ''.join(self._pieces)
+        # Недописанный тег в конце буфера ждет продолжения
+        unfinished = text.rfind('<')
+        held = ''
+        if unfinished > text.rfind('>'):
+            text, held = text[:unfinished], text[unfinished:]
+        parts, tail, self._open_tags = _split_text(text, self.max_length, self._open_tags, final=False)
+        tail += held
+        self._pieces = [tail] if tail else []
+        self._size = len(tail)
+        return parts
+
+    def close(self) -> list[str]:
+        """
+        Завершает поток и возвращает оставшиеся части
+
+        Returns:
+            list: оставшиеся части
+        """
+        text = ''.join(self._pieces)
+        self._pieces = []
+        self._size = 0
+
+        if not text.strip():
+            return []
+
+        parts, _, _ = _split_text(text, self.max_length, self._open_tags)
+        self._open_tags = []
+        return parts
+
+
+async def _send_parts(send, parts: list, reply_markup=None, **kwargs) -> list:
+    """
+    Отправляет части одного сообщения конвейером: следующая часть встает в очередь
+    core.telegram_sender, не дожидаясь ответа Telegram на предыдущую, а порядок
+    запросов соблюдает сам диспетчер (OrderedSend). Без диспетчера части уходят по одной.
+    Клавиатура прикрепляется только к последней части.
+
+    Returns:
+        list: отправленные сообщения в порядке частей
+    """
+    last = len(parts) - 1
+    if last == 0 or not telegram_sender.is_running():
+        return [
+            await send(part, reply_markup=reply_markup if i == last else None, **kwargs)
+            for i, part in enumerate(parts)
+        ]
+
+    chain = OrderedSend(len(parts))
+
+    async def send_part(index: int, part: str):
+        with chain.part(index):
+            return await send(part, reply_markup=reply_markup if index == last else None, **kwargs)
+
+    tasks = [asyncio.create_task(send_part(i, part)) for i, part in enumerate(parts)]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        # Части, которые еще не ушли, не отправляем: иначе сообщение придет с дырой
+        for task in tasks:
+            task.cancel()
+        raise
 
 
 async def send_split_message(bot_or_message, text: str, chat_id: int = None, **kwargs):
     """
     Отправляет сообщение, автоматически разбивая его на части если оно слишком длинное.
-    
+    Части отправляются конвейером по порядку, клавиатура - только на последней части.
+
     Args:
         bot_or_message: Bot instance или Message instance
         text: Текст для отправки
         chat_id: ID чата (нужен если передан bot)
         **kwargs: Дополнительные параметры для send_message
+
+    Returns:
+        list: отправленные сообщения
     """
     parts = split_text_message(text)
-    
-    for part in parts:
-        if hasattr(bot_or_message, 'send_message'):
-            # Это bot instance
-            await bot_or_message.send_message(chat_id, part, **kwargs)
-        else:
-            # Это message instance
-            await bot_or_message.answer(part, **kwargs)
+    reply_markup = kwargs.pop('reply_markup', None)
+
+    if hasattr(bot_or_message, 'send_message'):
+        # Это bot instance
+        bot = bot_or_message
+
+        async def send(part, **send_kwargs):
+            return await bot.send_message(chat_id, part, **send_kwargs)
+    else:
+        # Это message instance
+        send = bot_or_message.answer
+
+    return await _send_parts(send, parts, reply_markup, **kwargs)
 
 
 async def answer_split_text(message, text: str, **kwargs):
     """
     Удобная функция для ответа на сообщение с автоматической разбивкой длинного текста.
-    
+
     Args:
         message: Message instance
         text: Текст для отправки
         **kwargs: Дополнительные параметры для answer
+
+    Returns:
+        list: отправленные сообщения
     """
     parts = split_text_message(text)
-    
-    for part in parts:
-        await message.answer(part, **kwargs)
\ No newline at end of file
+    reply_markup = kwargs.pop('reply_markup', None)
+
+    return await _send_parts(message.answer, parts, reply_markup, **kwargs)
@@ -0,0 +1,54 @@
+"""
+Оценка количества токенов текста без обращения к API
+
+Если установлен tiktoken, используется он. Иначе - эвристика по классам символов,
+откалиброванная на русских текстах для токенизаторов OpenAI (кириллица дробится
+заметно сильнее латиницы).
+"""
+import re
+
+# Символов на токен для разных алфавитов
+CYRILLIC_CHARS_PER_TOKEN = 2.5
+LATIN_CHARS_PER_TOKEN = 4.0
+# Служебные токены на одно сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_CYRILLIC_RE = re.compile(r"[а-яёА-ЯЁ]")
+_LATIN_RE = re.compile(r"[a-zA-Z0-9]")
+_SPACE_RE = re.compile(r"\s")
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценивает количество токенов в тексте
+
+    Args:
+        text: текст сообщения
+
+    Returns:
+        int: примерное количество токенов (с запасом в большую сторону)
+    """
+    if not text:
+        return 0
+
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+
+    cyrillic = len(_CYRILLIC_RE.findall(text))
+    latin = len(_LATIN_RE.findall(text))
+    spaces = len(_SPACE_RE.findall(text))
+    # Знаки препинания, эмодзи и прочие символы - примерно по токену
+    other = len(text) - cyrillic - latin - spaces
+
+    return int(cyrillic / CYRILLIC_CHARS_PER_TOKEN + latin / LATIN_CHARS_PER_TOKEN + other) + 1
+
+
+def estimate_message_tokens(text: str) -> int:
+    """Токены сообщения в thread'е вместе со служебными"""
+    return estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS